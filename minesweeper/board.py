@@ -0,0 +1,210 @@
+"""
+Moonsweeper's game state, kept apart from the widgets which show it.
+
+Each property of the cells is a numpy array over the whole board, indexed [y, x]:
+where the mines are, which cells are revealed or flagged, and how many mines
+surround each cell. Setting up a board is a handful of array passes however big
+it is, and the widgets only ever read from it.
+"""
+import numpy as np
+
+# Board size and number of mines for each difficulty.
+LEVELS = [
+    (8, 10),
+    (16, 40),
+    (24, 99)
+]
+
+
+def adjacent_counts(mines):
+    """
+    The number of mines around each cell, counting the eight neighbours.
+
+    The 3x3 neighbourhood sum is a box filter, done as two passes of shifted slices
+    over a zero-padded copy, less the cell itself.
+    :param mines: (height, width) bool array.
+    :return: (height, width) uint8 array.
+    """
+    h, w = mines.shape
+    padded = np.zeros((h + 2, w + 2), dtype=np.uint8)
+    padded[1:-1, 1:-1] = mines
+    rows = padded[:-2] + padded[1:-1] + padded[2:]
+    box = rows[:, :-2] + rows[:, 1:-1] + rows[:, 2:]
+    return box - mines
+
+
+def connected_region(cells, x, y):
+    """
+    The region of cells connected to (x, y), diagonals included, as the empty area a
+    reveal spreads through.
+
+    Cells are grouped into runs along each row, and each run is linked to the runs on
+    the next row which touch it, corners included. All the links are found at once:
+    with the board laid out flat, run starts and ends both come out in order, so two
+    searchsorted calls give the range of touching runs for every run. The regions are
+    then the connected parts of that graph of runs. Every run starts as its own region,
+    each round joins the regions at the ends of every link which differ, and following
+    labels to their ends flattens the joins again. Both are whole-array operations, and
+    the number of rounds grows with how winding a region is rather than with its size.
+    :param cells: (height, width) bool array.
+    :return: (height, width) bool array, all False if (x, y) is not one of cells.
+    """
+    h, w = cells.shape
+    if not cells[y, x]:
+        return np.zeros((h, w), dtype=bool)
+
+    # Flat board, with a blank cell after every row so no run carries on into the next.
+    row_length = w + 1
+    flat = np.zeros(h * row_length + 1, dtype=bool)
+    flat[:-1].reshape(h, row_length)[:, :w] = cells
+    begins = np.flatnonzero(flat[1:] & ~flat[:-1]) + 1
+    if flat[0]:
+        begins = np.concatenate(([0], begins))
+    # One past the last cell of each run.
+    ends = np.flatnonzero(flat[:-1] & ~flat[1:]) + 1
+
+    # Runs one row down which touch each run: ending no more than a column before it
+    # starts, and starting no more than a column after it ends.
+    lo = np.searchsorted(ends, begins + row_length, 'left')
+    hi = np.searchsorted(begins, ends + row_length, 'right')
+    counts = np.maximum(hi - lo, 0)
+    above = np.repeat(np.arange(len(begins)), counts)
+    below = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - lo, counts)
+
+    # Region of each run, as the lowest numbered run in it once no link crosses regions.
+    labels = np.arange(len(begins))
+    while True:
+        a, b = labels[above], labels[below]
+        crossing = a != b
+        if not crossing.any():
+            break
+        a, b = a[crossing], b[crossing]
+        labels[np.maximum(a, b)] = np.minimum(a, b)
+        while True:
+            followed = labels[labels]
+            if (followed == labels).all():
+                break
+            labels = followed
+
+    seed = np.searchsorted(begins, y * row_length + x, 'right') - 1
+    chosen = np.flatnonzero(labels == labels[seed])
+    # Flat index of every cell of the chosen runs.
+    lengths = ends[chosen] - begins[chosen]
+    found = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - begins[chosen], lengths)
+    region = np.zeros(h * row_length, dtype=bool)
+    region[found] = True
+    return region.reshape(h, row_length)[:, :w]
+
+
+class Board:
+    """
+    The cells of one game: mines, adjacency counts, and what the player has revealed
+    and flagged so far.
+    """
+
+    def __init__(self, width, height=None, seed=None):
+        """
+        :param seed: seed for laying out mines, so the same sequence of games can be
+            played again, or None for a random one.
+        """
+        self.width = width
+        self.height = width if height is None else height
+        self.rng = np.random.default_rng(seed)
+        self.reset()
+
+    def reset(self):
+        shape = (self.height, self.width)
+        self.mines = np.zeros(shape, dtype=bool)
+        self.adjacent = np.zeros(shape, dtype=np.uint8)
+        self.revealed = np.zeros(shape, dtype=bool)
+        self.flagged = np.zeros(shape, dtype=bool)
+        # The starting cell, as (x, y), once chosen.
+        self.start = None
+
+    def set_mines(self, mines):
+        """
+        :param mines: (height, width) bool array, True where there is a mine.
+        """
+        self.mines[:] = mines
+        self.adjacent = adjacent_counts(self.mines)
+
+    def generate(self, n_mines, start=None, safe=1):
+        """
+        Lay out a new game: the starting cell, and mines placed anywhere outside a zone
+        around it, so the first move can never hit one.
+
+        Mines are drawn without replacement from the flat indices of the cells left
+        once the zone is taken out, a single draw however many mines there are.
+        :param n_mines: number of mines to place.
+        :param start: (x, y) of the starting cell, or None to pick one at random.
+        :param safe: how many cells around the start to keep clear, 0 for only the start.
+        """
+        self.reset()
+        if start is None:
+            start = int(self.rng.integers(self.width)), int(self.rng.integers(self.height))
+        x, y = start
+
+        rows = np.arange(max(0, y - safe), min(y + safe + 1, self.height))
+        cols = np.arange(max(0, x - safe), min(x + safe + 1, self.width))
+        excluded = (rows[:, None] * self.width + cols).ravel()
+        cells = np.delete(np.arange(self.width * self.height), excluded)
+        if n_mines > len(cells):
+            raise ValueError("%d mines do not fit on a %dx%d board" % (n_mines, self.width, self.height))
+
+        mines = np.zeros(self.width * self.height, dtype=bool)
+        mines[self.rng.choice(cells, n_mines, replace=False)] = True
+        self.set_mines(mines.reshape(self.height, self.width))
+        self.start = (x, y)
+
+    @property
+    def n_mines(self):
+        return int(np.count_nonzero(self.mines))
+
+    def contains(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def surrounding(self, x, y):
+        """
+        The cells around (x, y) and the cell itself, as (x, y), clipped to the board.
+        """
+        return [
+            (xi, yi)
+            for xi in range(max(0, x - 1), min(x + 2, self.width))
+            for yi in range(max(0, y - 1), min(y + 2, self.height))
+        ]
+
+    def is_mine(self, x, y):
+        return bool(self.mines[y, x])
+
+    def reveal_area(self, x, y):
+        """
+        Reveal a cell and, if no mines surround it, everything reachable from it through
+        other such cells, out to the numbered cells bordering the area. Flagged cells
+        are left alone.
+
+        The whole area is worked out before anything is revealed: the empty cells
+        connected to the start (see connected_region), grown by one cell all round.
+        :return: (n,) array of the flat indices (y * width + x) of the newly revealed cells.
+        """
+        if self.revealed[y, x]:
+            return np.empty(0, dtype=np.intp)
+
+        if self.adjacent[y, x] or self.mines[y, x] or self.flagged[y, x]:
+            # Only this cell, no need to look any further.
+            self.revealed[y, x] = True
+            return np.array([y * self.width + x], dtype=np.intp)
+
+        blocked = self.revealed | self.flagged
+        spreads = (self.adjacent == 0) & ~self.mines & ~blocked
+        area = connected_region(spreads, x, y)
+        reveal = (area | (adjacent_counts(area) > 0)) & ~blocked
+
+        found = np.flatnonzero(reveal)
+        self.revealed.ravel()[found] = True
+        return found
+
+    def flag(self, x, y):
+        self.flagged[y, x] = True
+
+    def reveal_all(self):
+        self.revealed[:] = True
@@ -1,10 +1,14 @@
 
-import random
 import time
 
-from PySide2.QtCore import (QCoreApplication, QMetaObject, QObject, QRunnable, QSize,  Qt, QThreadPool, QTimer, Signal, Slot)
+import numpy as np
+
+from PySide2.QtCore import (QCoreApplication, QEvent, QMetaObject, QObject, QRect, QRunnable, QSize,  Qt, QThreadPool, QTimer, Signal, Slot)
 from PySide2.QtGui import (QBrush, QColor, QFont, QIcon, QImage, QPainter, QPalette, QPen, QPixmap)
-from PySide2.QtWidgets import (QAction, QApplication, QComboBox, QFormLayout, QGridLayout, QHBoxLayout, QLabel, QLineEdit, QMainWindow, QMessageBox, QPushButton, QSizePolicy, QStatusBar, QToolBar, QVBoxLayout, QWidget)
+from PySide2.QtWidgets import (QAction, QApplication, QComboBox, QFormLayout, QFrame, QGridLayout, QHBoxLayout, QLabel, QLineEdit, QMainWindow, QMessageBox, QPushButton, QScrollArea, QSizePolicy, QStatusBar, QToolBar, QVBoxLayout, QWidget)
+
+from board import Board, LEVELS
+from solver import Solver
 
 
 IMG_BOMB = QImage("./images/bug.png")
@@ -23,12 +27,6 @@ NUM_COLORS = {
     8: QColor('#FF9800')
 }
 
-LEVELS = [
-    (8, 10),
-    (16, 40),
-    (24, 99)
-]
-
 STATUS_READY = 0
 STATUS_PLAYING = 1
 STATUS_FAILED = 2
@@ -42,100 +40,258 @@ STATUS_ICONS = {
 }
 
 
-class Pos(QWidget):
-    expandable = Signal(int, int)
-    clicked = Signal()
-    ohno = Signal()
+# Cells are this many pixels across by default, with a gap of a quarter of that between them.
+CELL_SIZE = 20
+MIN_CELL_SIZE = 8
+MAX_CELL_SIZE = 64
+
+# Cell sprites: 0-8 are revealed cells showing that many adjacent mines.
+CELL_HIDDEN = 9
+CELL_FLAG = 10
+CELL_MINE = 11
+CELL_START = 12
+N_CELL_SPRITES = 13
+
+
+def cell_states(board, rows, cols):
+    """
+    The sprite showing each cell in an area of the board, worked out for the whole area at once.
+    :param rows: slice of rows.
+    :param cols: slice of columns.
+    :return: 2D int array over the area.
+    """
+    revealed, adjacent = board.revealed[rows, cols], board.adjacent[rows, cols]
+    states = np.where(board.flagged[rows, cols], CELL_FLAG, CELL_HIDDEN)
+    states = np.where(revealed, np.where(board.mines[rows, cols], CELL_MINE, adjacent), states)
+    if board.start is not None:
+        x, y = board.start
+        if rows.start <= y < rows.stop and cols.start <= x < cols.stop and revealed[y - rows.start, x - cols.start]:
+            states[y - rows.start, x - cols.start] = CELL_START
+    return states
+
+
+def render_atlas(size, palette):
+    """
+    Draw every cell sprite, side by side in one pixmap, sprite n at x = n * size.
+    The icons are scaled and the pens and font set up once for the lot.
+    :param size: cell size in pixels.
+    :param palette: QPalette for the revealed background.
+    :return: QPixmap
+    """
+    atlas = QPixmap(N_CELL_SPRITES * size, size)
+    atlas.fill(Qt.transparent)
+    r = QRect(0, 0, size, size)
+
+    icons = {
+        state: QPixmap.fromImage(image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        for state, image in ((CELL_START, IMG_START), (CELL_MINE, IMG_BOMB), (CELL_FLAG, IMG_FLAG))
+    }
+    background = palette.color(QPalette.Background)
+    hidden_pen = QPen(Qt.gray)
+    hidden_pen.setWidth(1)
+    revealed_pen = QPen(background)
+    revealed_pen.setWidth(1)
+
+    p = QPainter(atlas)
+    p.setRenderHint(QPainter.Antialiasing)
+    f = p.font()
+    f.setBold(True)
+    f.setPixelSize(max(size * 3 // 5, 1))
+    p.setFont(f)
+
+    for state in range(N_CELL_SPRITES):
+        p.save()
+        p.translate(state * size, 0)
+        p.setClipRect(r)
+
+        if state in (CELL_HIDDEN, CELL_FLAG):
+            p.fillRect(r, Qt.lightGray)
+            p.setPen(hidden_pen)
+        else:
+            p.fillRect(r, background)
+            p.setPen(revealed_pen)
+        p.drawRect(r)
 
-    def __init__(self, x, y, *args, **kwargs):
-        super(Pos, self).__init__(*args, **kwargs)
+        if state in icons:
+            icon = icons[state]
+            p.drawPixmap((size - icon.width()) // 2, (size - icon.height()) // 2, icon)
 
-        self.setFixedSize(QSize(20, 20))
+        elif 0 < state < CELL_HIDDEN:
+            p.setPen(NUM_COLORS[state])
+            p.drawText(r, Qt.AlignHCenter | Qt.AlignVCenter, str(state))
 
-        self.x = x
-        self.y = y
+        p.restore()
 
-    def reset(self):
-        self.is_start = False
-        self.is_mine = False
-        self.adjacent_n = 0
+    p.end()
+    return atlas
 
-        self.is_revealed = False
-        self.is_flagged = False
 
-        self.update()
+class CellAtlas:
+    '''
+    The cell sprites, drawn for one cell size and palette and kept until either
+    changes.
+    '''
 
-    def paintEvent(self, event):
-        p = QPainter(self)
-        p.setRenderHint(QPainter.Antialiasing)
+    def __init__(self):
+        self.key = None
+        self.pixmap = None
 
-        r = event.rect()
+    def get(self, size, palette):
+        key = (size, palette.color(QPalette.Background).rgba())
+        if key != self.key:
+            self.pixmap = render_atlas(size, palette)
+            self.key = key
+        return self.pixmap
 
-        if self.is_revealed:
-            color = self.palette().color(QPalette.Background)
-            outer, inner = color, color
-        else:
-            outer, inner = Qt.gray, Qt.lightGray
 
-        p.fillRect(r, QBrush(inner))
-        pen = QPen(outer)
-        pen.setWidth(1)
-        p.setPen(pen)
-        p.drawRect(r)
+class BoardView(QWidget):
+    '''
+    The whole board in one widget. Cells are copied from a sprite atlas, and only
+    the cells which have changed are repainted. Ctrl+wheel changes the cell size.
+    '''
+    expandable = Signal(int, int)
+    clicked = Signal()
+    ohno = Signal()
 
-        if self.is_revealed:
-            if self.is_start:
-                p.drawPixmap(r, QPixmap(IMG_START))
+    # Past this many changed cells, repaint the whole board rather than each cell.
+    MAX_CELL_UPDATES = 256
 
-            elif self.is_mine:
-                p.drawPixmap(r, QPixmap(IMG_BOMB))
+    # Cell suggested by the solver, as (x, y, chance of a mine), outlined until the next click.
+    hint = None
 
-            elif self.adjacent_n > 0:
-                pen = QPen(NUM_COLORS[self.adjacent_n])
-                p.setPen(pen)
-                f = p.font()
-                f.setBold(True)
-                p.setFont(f)
-                p.drawText(r, Qt.AlignHCenter | Qt.AlignVCenter, str(self.adjacent_n))
+    def __init__(self, board, *args, **kwargs):
+        super(BoardView, self).__init__(*args, **kwargs)
 
-        elif self.is_flagged:
-            p.drawPixmap(r, QPixmap(IMG_FLAG))
+        self.board = board
+        self.atlas = CellAtlas()
+        self.set_cell_size(CELL_SIZE)
 
-    def flag(self):
-        self.is_flagged = True
+    def set_cell_size(self, size):
+        self.cell_size = min(max(size, MIN_CELL_SIZE), MAX_CELL_SIZE)
+        self.spacing = self.cell_size // 4
+        self.pitch = self.cell_size + self.spacing
+        self.setFixedSize(QSize(
+            self.board.width * self.pitch - self.spacing, self.board.height * self.pitch - self.spacing
+        ))
         self.update()
 
-        self.clicked.emit()
+    def cell_rect(self, x, y):
+        return QRect(x * self.pitch, y * self.pitch, self.cell_size, self.cell_size)
+
+    def set_hint(self, hint):
+        """
+        :param hint: (x, y, chance of a mine) of the cell to outline, or None to clear it.
+        """
+        for cell in (self.hint, hint):
+            if cell:
+                self.update(self.cell_rect(*cell[:2]))
+        self.hint = hint
+
+    def cell_at(self, pos):
+        """
+        :param pos: QPoint in the widget.
+        :return: (x, y) of the cell there, or None between cells or off the board.
+        """
+        (x, dx), (y, dy) = divmod(pos.x(), self.pitch), divmod(pos.y(), self.pitch)
+        if dx >= self.cell_size or dy >= self.cell_size or not self.board.contains(x, y):
+            return None
+        return x, y
+
+    def update_cells(self, cells):
+        """
+        Repaint cells after the board has changed.
+        :param cells: flat cell indices (y * width + x).
+        """
+        if len(cells) > self.MAX_CELL_UPDATES:
+            self.update()
+            return
+
+        for n in cells:
+            y, x = divmod(int(n), self.board.width)
+            self.update(self.cell_rect(x, y))
 
-    def reveal(self):
-        self.is_revealed = True
-        self.update()
-
-    def click(self):
-        if not self.is_revealed:
-            self.reveal()
-            if self.adjacent_n == 0:
-                self.expandable.emit(self.x, self.y)
+    def paintEvent(self, event):
+        size, pitch = self.cell_size, self.pitch
+        atlas = self.atlas.get(size, self.palette())
+        p = QPainter(self)
 
-        self.clicked.emit()
+        # Only the cells overlapping the area being repainted.
+        r = event.rect()
+        cols = slice(max(r.left() // pitch, 0), min(r.right() // pitch + 1, self.board.width))
+        rows = slice(max(r.top() // pitch, 0), min(r.bottom() // pitch + 1, self.board.height))
+        states = cell_states(self.board, rows, cols)
+
+        for (y, x), state in np.ndenumerate(states):
+            p.drawPixmap((cols.start + x) * pitch, (rows.start + y) * pitch, atlas, state * size, 0, size, size)
+
+        if self.hint:
+            # Green for a certainly safe cell, orange for the best guess.
+            x, y, chance = self.hint
+            pen = QPen(QColor('#4CAF50') if chance == 0 else QColor('#FF9800'))
+            pen.setWidth(2)
+            p.setPen(pen)
+            p.drawRect(self.cell_rect(x, y).adjusted(1, 1, -1, -1))
+
+    def changeEvent(self, e):
+        # The atlas notices the new palette when it is next drawn.
+        if e.type() == QEvent.PaletteChange:
+            self.update()
+        super(BoardView, self).changeEvent(e)
+
+    def wheelEvent(self, e):
+        if e.modifiers() == Qt.ControlModifier:
+            self.set_cell_size(self.cell_size + (4 if e.angleDelta().y() > 0 else -4))
+        else:
+            super(BoardView, self).wheelEvent(e)
 
     def mouseReleaseEvent(self, e):
-
-        if (e.button() == Qt.RightButton and not self.is_revealed):
-            self.flag()
+        cell = self.cell_at(e.pos())
+        if cell is None:
+            return
+
+        x, y = cell
+        revealed = self.board.revealed[y, x]
+        self.set_hint(None)
+        if (e.button() == Qt.RightButton and not revealed):
+            self.board.flag(x, y)
+            self.update(self.cell_rect(x, y))
+            self.clicked.emit()
 
         elif (e.button() == Qt.LeftButton):
-            self.click()
+            if not revealed:
+                # Revealed by the window, along with any empty area it opens up.
+                self.expandable.emit(x, y)
+            self.clicked.emit()
 
-            if self.is_mine:
+            if self.board.is_mine(x, y):
                 self.ohno.emit()
 
 
+class BoardScrollArea(QScrollArea):
+    '''
+    Holds the board view, scrolling it when the board is bigger than there is room
+    for on screen. Smaller boards are shown whole, in the middle.
+    '''
+
+    def __init__(self, view, *args, **kwargs):
+        super(BoardScrollArea, self).__init__(*args, **kwargs)
+        self.setWidget(view)
+        self.setAlignment(Qt.AlignCenter)
+        self.setFrameShape(QFrame.NoFrame)
+
+    def sizeHint(self):
+        # Room for the whole board, up to the 2/3 of the screen a new window is given.
+        frame = 2 * self.frameWidth()
+        size = self.widget().size() + QSize(frame, frame)
+        return size.boundedTo(QApplication.primaryScreen().availableSize() * 2 / 3)
+
+
 class MainWindow(QMainWindow):
     def __init__(self, *args, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
 
         self.b_size, self.n_mines = LEVELS[1]
+        self.board = Board(self.b_size)
 
         w = QWidget()
         hb = QHBoxLayout()
@@ -167,6 +323,12 @@ class MainWindow(QMainWindow):
 
         self.button.pressed.connect(self.button_pressed)
 
+        # Ask the solver for the best cell to reveal next.
+        self.hint_action = QAction("Hint", self)
+        self.hint_action.setShortcut("H")
+        self.hint_action.triggered.connect(self.show_hint)
+        self.addAction(self.hint_action)
+
         l = QLabel()
         l.setPixmap(QPixmap.fromImage(IMG_BOMB))
         l.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
@@ -184,10 +346,8 @@ class MainWindow(QMainWindow):
         vb = QVBoxLayout()
         vb.addLayout(hb)
 
-        self.grid = QGridLayout()
-        self.grid.setSpacing(5)
-
-        vb.addLayout(self.grid)
+        self.view = BoardView(self.board)
+        vb.addWidget(BoardScrollArea(self.view))
         w.setLayout(vb)
         self.setCentralWidget(w)
 
@@ -200,67 +360,27 @@ class MainWindow(QMainWindow):
         self.show()
 
     def init_map(self):
-        # Add positions to the map
-        for x in range(0, self.b_size):
-            for y in range(0, self.b_size):
-                w = Pos(x, y)
-                self.grid.addWidget(w, y, x)
-                # Connect signal to handle expansion.
-                w.clicked.connect(self.trigger_start)
-                w.expandable.connect(self.expand_reveal)
-                w.ohno.connect(self.game_over)
+        # Connect signals to handle clicks and expansion.
+        self.view.clicked.connect(self.trigger_start)
+        self.view.expandable.connect(self.expand_reveal)
+        self.view.ohno.connect(self.game_over)
 
     def reset_map(self):
-        # Clear all mine positions
-        for x in range(0, self.b_size):
-            for y in range(0, self.b_size):
-                w = self.grid.itemAtPosition(y, x).widget()
-                w.reset()
-
-        # Add mines to the positions
-        positions = []
-        while len(positions) < self.n_mines:
-            x, y = random.randint(0, self.b_size - 1), random.randint(0, self.b_size - 1)
-            if (x, y) not in positions:
-                w = self.grid.itemAtPosition(y, x).widget()
-                w.is_mine = True
-                positions.append((x, y))
-
-        def get_adjacency_n(x, y):
-            positions = self.get_surrounding(x, y)
-            n_mines = sum(1 if w.is_mine else 0 for w in positions)
-
-            return n_mines
-
-        # Add adjacencies to the positions
-        for x in range(0, self.b_size):
-            for y in range(0, self.b_size):
-                w = self.grid.itemAtPosition(y, x).widget()
-                w.adjacent_n = get_adjacency_n(x, y)
-
-        # Place starting marker
-        while True:
-            x, y = random.randint(0, self.b_size - 1), random.randint(0, self.b_size - 1)
-            w = self.grid.itemAtPosition(y, x).widget()
-            # We don't want to start on a mine.
-            if (x, y) not in positions:
-                w = self.grid.itemAtPosition(y, x).widget()
-                w.is_start = True
-
-                # Reveal all positions around this, if they are not mines either.
-                for w in self.get_surrounding(x, y):
-                    if not w.is_mine:
-                        w.click()
-                break
-
-    def get_surrounding(self, x, y):
-        positions = []
-
-        for xi in range(max(0, x - 1), min(x + 2, self.b_size)):
-            for yi in range(max(0, y - 1), min(y + 2, self.b_size)):
-                positions.append(self.grid.itemAtPosition(yi, xi).widget())
-
-        return positions
+        # Lay out the mines, keeping clear of the starting marker.
+        self.board.generate(self.n_mines)
+
+        # Reveal the area around the start, none of which are mines.
+        self.board.reveal_area(*self.board.start)
+        self.view.set_hint(None)
+        self.update_map()
+
+    def show_hint(self):
+        if self.status != STATUS_FAILED:
+            self.view.set_hint(Solver(self.board).hint())
+
+    def update_map(self):
+        # Repaint every cell, after the board has changed underneath them.
+        self.view.update()
 
     def button_pressed(self):
         if self.status == STATUS_PLAYING:
@@ -272,17 +392,12 @@ class MainWindow(QMainWindow):
             self.reset_map()
 
     def reveal_map(self):
-        for x in range(0, self.b_size):
-            for y in range(0, self.b_size):
-                w = self.grid.itemAtPosition(y, x).widget()
-                w.reveal()
+        self.board.reveal_all()
+        self.update_map()
 
     def expand_reveal(self, x, y):
-        for xi in range(max(0, x - 1), min(x + 2, self.b_size)):
-            for yi in range(max(0, y - 1), min(y + 2, self.b_size)):
-                w = self.grid.itemAtPosition(yi, xi).widget()
-                if not w.is_mine:
-                    w.click()
+        # The board finds the whole area to reveal, then only those cells are repainted.
+        self.view.update_cells(self.board.reveal_area(x, y))
 
     def trigger_start(self, *args):
         if self.status != STATUS_PLAYING:
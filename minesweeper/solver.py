@@ -0,0 +1,413 @@
+"""
+A Moonsweeper solver and auto-player, working on the board model with no UI.
+
+    python solver.py -n 10000 -j 4          # play games at every level, report win rates
+    python solver.py -n 1000000 --seed 1    # the same games every run
+
+The solver only looks at what a player could see: the revealed cells and their
+numbers, and how many mines there are in all. It tries, in order:
+
+- the single-cell rules, over the whole board at once in array passes: a number
+  with all its mines found makes its other hidden neighbours safe, and a number
+  with as many hidden neighbours as mines still to find makes them all mines;
+- the subset rule, with each number's hidden neighbours as a bitset: where one
+  number's cells are a subset of another's, the cells left over hold the
+  difference in their mines, which may make them all safe or all mines;
+- failing those, the chance of each cell being a mine, by enumerating the ways
+  the mines can lie around the numbers, each weighted by the ways the rest can lie
+  in the cells away from them. The least likely cell is the one to guess.
+
+Batch games are split into tasks across worker processes, each playing its games
+on one board, so only a few numbers pass between processes.
+"""
+import argparse
+from math import comb
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+
+from board import Board, LEVELS, adjacent_counts
+
+# Groups of unknown cells bigger than this are estimated rather than enumerated.
+ENUMERATION_LIMIT = 24
+
+# Games each worker plays per task.
+GAMES_PER_TASK = 200
+
+
+def bits_of(bits):
+    # Positions of the set bits of an int, lowest first.
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def popcount(bits):
+    return bin(bits).count('1')
+
+
+def convolve(a, b):
+    # Distribution of the sum of two mine counts, as lists of ways by count.
+    out = [0] * (len(a) + len(b) - 1)
+    for i, x in enumerate(a):
+        if x:
+            for j, y in enumerate(b):
+                out[i + j] += x * y
+    return out
+
+
+def components(constraints):
+    """
+    Split constraints into groups sharing no cells, which can be enumerated separately.
+    :param constraints: list of (bits, mines).
+    :return: list of (bits of all the cells, list of constraints).
+    """
+    groups = []
+    for constraint in constraints:
+        bits, cons = constraint[0], [constraint]
+        rest = []
+        for group in groups:
+            if group[0] & bits:
+                bits |= group[0]
+                cons += group[1]
+            else:
+                rest.append(group)
+        groups = rest + [(bits, cons)]
+    return groups
+
+
+def enumerate_component(bits, constraints, limit):
+    """
+    Count the arrangements of mines over a group of cells which satisfy its numbers.
+
+    Cells are assigned in an order which completes numbers early, and an arrangement
+    is abandoned as soon as any number has too many mines or too few cells left to
+    reach its count.
+    :param limit: most mines the arrangement may use.
+    :return: (ways, cell_ways, cells): ways[k] arrangements use k mines, of which
+        cell_ways[k][i] have a mine on cells[i], the bit positions of the cells.
+    """
+    # Cells in the order the numbers reach them, so each number is settled soon after it starts.
+    cells, seen = [], 0
+    for cons_bits, _ in constraints:
+        for bit in bits_of(cons_bits & ~seen):
+            cells.append(bit)
+        seen |= cons_bits
+    local = {bit: i for i, bit in enumerate(cells)}
+
+    need = [mines for _, mines in constraints]
+    left = [popcount(cons_bits) for cons_bits, _ in constraints]
+    found = [0] * len(constraints)
+    touches = [[] for _ in cells]
+    for c, (cons_bits, _) in enumerate(constraints):
+        for bit in bits_of(cons_bits):
+            touches[local[bit]].append(c)
+
+    ways = [0] * (min(len(cells), limit) + 1)
+    cell_ways = [[0] * len(cells) for _ in ways]
+    assignment = [0] * len(cells)
+
+    def visit(i, total):
+        if i == len(cells):
+            ways[total] += 1
+            counts = cell_ways[total]
+            for j, mine in enumerate(assignment):
+                if mine:
+                    counts[j] += 1
+            return
+
+        for mine in (0, 1):
+            if total + mine > limit:
+                break
+            ok = True
+            for c in touches[i]:
+                found[c] += mine
+                left[c] -= 1
+                if found[c] > need[c] or found[c] + left[c] < need[c]:
+                    ok = False
+            if ok:
+                assignment[i] = mine
+                visit(i + 1, total + mine)
+            for c in touches[i]:
+                found[c] -= mine
+                left[c] += 1
+        assignment[i] = 0
+
+    visit(0, 0)
+    return ways, cell_ways, cells
+
+
+class Solver:
+    '''
+    Works out safe cells, mines and mine chances for a board from its revealed cells.
+    Mines found are kept in known, rather than flagged on the board, so the player's
+    own flags are neither trusted nor disturbed.
+    '''
+
+    def __init__(self, board):
+        self.board = board
+        self.known = np.zeros_like(board.mines)
+
+    def counts(self):
+        """
+        :return: hidden cells not known to be mines, the mines still to find around each
+            revealed number, and the numbers which still have hidden cells around them.
+        """
+        b = self.board
+        hidden = ~b.revealed & ~self.known
+        unknown = adjacent_counts(hidden)
+        need = b.adjacent.astype(np.int16) - adjacent_counts(self.known)
+        active = b.revealed & (unknown > 0)
+        return hidden, unknown, need, active
+
+    def single_cell(self):
+        """
+        Apply the single-cell rules until they find no more mines.
+        :return: (height, width) bool array of the cells found to be safe.
+        """
+        while True:
+            hidden, unknown, need, active = self.counts()
+            mines = hidden & (adjacent_counts(active & (need == unknown)) > 0)
+            if not mines.any():
+                return hidden & (adjacent_counts(active & (need == 0)) > 0)
+            self.known |= mines
+
+    def constraints(self):
+        """
+        The revealed numbers with hidden cells around them, as bitsets over those cells.
+        :return: list of (bits, mines still to find), and the flat indices of the cells by bit.
+        """
+        b = self.board
+        hidden, unknown, need, active = self.counts()
+        cells = np.flatnonzero(hidden & (adjacent_counts(active) > 0))
+        bit = {n: k for k, n in enumerate(cells.tolist())}
+
+        constraints = []
+        ys, xs = np.nonzero(active)
+        for y, x, mines in zip(ys.tolist(), xs.tolist(), need[active].tolist()):
+            bits = 0
+            for xi, yi in b.surrounding(x, y):
+                k = bit.get(yi * b.width + xi)
+                if k is not None:
+                    bits |= 1 << k
+            constraints.append((bits, mines))
+        return constraints, cells
+
+    def subsets(self, constraints):
+        """
+        Apply the subset rule to each pair of numbers sharing a cell.
+        :return: bitsets of the cells found to be safe, and to be mines.
+        """
+        by_bit = {}
+        for i, (bits, _) in enumerate(constraints):
+            for bit in bits_of(bits):
+                by_bit.setdefault(bit, []).append(i)
+
+        safe = mines = 0
+        for i, (a, a_mines) in enumerate(constraints):
+            partners = {j for bit in bits_of(a) for j in by_bit[bit]}
+            for j in partners:
+                b, b_mines = constraints[j]
+                if a & b == a and a != b:
+                    rest, rest_mines = b & ~a, b_mines - a_mines
+                    if rest_mines == 0:
+                        safe |= rest
+                    elif rest_mines == popcount(rest):
+                        mines |= rest
+        return safe, mines
+
+    def probabilities(self, constraints, cells):
+        """
+        The chance of each hidden cell being a mine.
+
+        Each group of cells around the numbers is enumerated on its own, giving the ways
+        it can hold each number of mines. Combined, and weighted by the ways the mines
+        left over can lie in the hidden cells away from the numbers, these give exact
+        chances, unless a group is too big to enumerate and chances are estimated.
+        :return: (height, width) float array, NaN where the cell is not hidden.
+        """
+        b = self.board
+        hidden = ~b.revealed & ~self.known
+        probability = np.full(hidden.shape, np.nan)
+        remaining = b.n_mines - int(np.count_nonzero(self.known))
+        n_hidden = int(np.count_nonzero(hidden))
+        interior = n_hidden - len(cells)
+        groups = components(constraints)
+
+        results = None
+        if all(popcount(bits) <= ENUMERATION_LIMIT for bits, _ in groups):
+            results = [enumerate_component(bits, cons, remaining) for bits, cons in groups]
+
+        def weight(k):
+            # Ways to place the rest of the mines in the cells away from the numbers.
+            return comb(interior, remaining - k) if 0 <= remaining - k <= interior else 0
+
+        total = 0
+        if results is not None:
+            overall = [1]
+            for ways, _, _ in results:
+                overall = convolve(overall, ways)
+            total = sum(n * weight(k) for k, n in enumerate(overall))
+
+        if not total:
+            # Estimate: each number's mines spread evenly over its cells, the rest over the others.
+            flat = probability.ravel()
+            for bits, mines in constraints:
+                chance = mines / popcount(bits)
+                for bit in bits_of(bits):
+                    n = cells[bit]
+                    flat[n] = chance if np.isnan(flat[n]) else max(flat[n], chance)
+            probability[hidden & np.isnan(probability)] = remaining / max(n_hidden, 1)
+            return probability
+
+        flat = probability.ravel()
+        for g, (ways, cell_ways, group_cells) in enumerate(results):
+            others = [1]
+            for h, (other_ways, _, _) in enumerate(results):
+                if h != g:
+                    others = convolve(others, other_ways)
+            mine_ways = [0] * len(group_cells)
+            for k, counts in enumerate(cell_ways):
+                if ways[k]:
+                    factor = sum(n * weight(k + m) for m, n in enumerate(others))
+                    for i, count in enumerate(counts):
+                        mine_ways[i] += count * factor
+            for bit, n in zip(group_cells, mine_ways):
+                flat[cells[bit]] = n / total
+
+        if interior:
+            expected = sum(n * weight(k) * (remaining - k) for k, n in enumerate(overall))
+            probability[hidden & np.isnan(probability)] = expected / total / interior
+        return probability
+
+    def solve(self):
+        """
+        Work out all that can be from the revealed cells.
+        :return: (safe, probability): flat indices of the cells certain to be safe, and if
+            there are none, the chance of each hidden cell being a mine (see probabilities),
+            otherwise None.
+        """
+        safe = self.single_cell()
+        if safe.any():
+            return np.flatnonzero(safe), None
+
+        constraints, cells = self.constraints()
+        safe_bits, mine_bits = self.subsets(constraints)
+        if mine_bits:
+            self.known.ravel()[cells[list(bits_of(mine_bits))]] = True
+        if safe_bits:
+            return cells[list(bits_of(safe_bits))], None
+        if mine_bits:
+            # New mines may settle some numbers.
+            return self.solve()
+
+        return np.empty(0, dtype=np.intp), self.probabilities(constraints, cells)
+
+    def hint(self):
+        """
+        The best cell to reveal next.
+        :return: (x, y, chance of a mine there), or None if there is nothing left to reveal.
+        """
+        safe, probability = self.solve()
+        if len(safe):
+            y, x = divmod(int(safe[0]), self.board.width)
+            return x, y, 0.0
+        if probability is None or np.all(np.isnan(probability)):
+            return None
+        y, x = divmod(int(np.nanargmin(probability)), self.board.width)
+        return x, y, float(probability[y, x])
+
+
+def play(board, n_mines):
+    """
+    Play one game on a board to the end, revealing safe cells while there are any and
+    guessing the least likely cell when there are not.
+    :return: True if the game was won.
+    """
+    board.generate(n_mines)
+    board.reveal_area(*board.start)
+    solver = Solver(board)
+    n_safe = board.width * board.height - n_mines
+
+    while np.count_nonzero(board.revealed) < n_safe:
+        safe, probability = solver.solve()
+        if not len(safe):
+            safe = [np.nanargmin(probability)]
+
+        for n in safe:
+            y, x = divmod(int(n), board.width)
+            if board.mines[y, x]:
+                return False
+            board.reveal_area(x, y)
+
+    return True
+
+
+def play_games(task):
+    """
+    Play a run of games, in a worker process.
+
+    With a seed each game has its own, made from the seed, its level and its number
+    among the games at that level, so a level plays the same games however the run is
+    split into tasks and whichever other levels are played alongside it.
+    :param task: (board size, mines, number of the first game, games, seed or None).
+    :return: (board size, mines, games, games won).
+    """
+    size, n_mines, first, n_games, seed = task
+    board = Board(size)
+    wins = 0
+    for n in range(first, first + n_games):
+        if seed is not None:
+            board = Board(size, seed=(seed, size, n_mines, n))
+        wins += play(board, n_mines)
+    return size, n_mines, n_games, wins
+
+
+def run(levels, n_games, jobs=None, seed=None, report=print):
+    """
+    Play games at each level with a pool of worker processes.
+    :param levels: list of (board size, mines).
+    :param n_games: games to play at each level.
+    :param jobs: number of worker processes, by default one per core.
+    :param seed: seed for the games, the same seed playing the same games, or None.
+    :param report: called with a line of results for each level.
+    :return: dict of (games, wins) by level.
+    """
+    tasks = []
+    for size, n_mines in levels:
+        for start in range(0, n_games, GAMES_PER_TASK):
+            tasks.append((size, n_mines, start, min(GAMES_PER_TASK, n_games - start), seed))
+
+    results = {level: (0, 0) for level in levels}
+    start = time.perf_counter()
+    with multiprocessing.Pool(jobs) as pool:
+        for size, n_mines, games, wins in pool.imap_unordered(play_games, tasks):
+            played, won = results[size, n_mines]
+            results[size, n_mines] = played + games, won + wins
+
+    seconds = time.perf_counter() - start
+    for (size, n_mines), (played, won) in results.items():
+        report("%dx%d, %d mines: won %d of %d (%.1f%%)" % (size, size, n_mines, won, played, 100 * won / played))
+    total = sum(played for played, _ in results.values())
+    report("%d games in %.1f s (%.0f games/s)" % (total, seconds, total / seconds))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play Moonsweeper games with the solver and report win rates.")
+    parser.add_argument('-n', '--games', type=int, default=1000, help="games to play at each level")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument('--seed', type=int, default=None, help="play the same games every run")
+    parser.add_argument('--level', type=int, default=None, help="only this level, by number from 0")
+    args = parser.parse_args(argv)
+
+    levels = LEVELS if args.level is None else [LEVELS[args.level]]
+    run(levels, args.games, args.jobs, args.seed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
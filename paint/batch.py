@@ -0,0 +1,135 @@
+"""
+Run a script of paint operations over many images, in parallel worker processes.
+
+    python batch.py script.json photos/ -o edited/ -j 4
+
+The script is a JSON list of operations, run in order on every image, as described
+in core.run_operations:
+
+    [
+        {"op": "filter", "name": "auto_levels"},
+        {"op": "rect", "rect": [10, 10, 200, 60], "color": "#000000", "fill": "#ffffff"},
+        {"op": "text", "pos": [20, 50], "text": "Piecasso", "color": "#000000", "size": 24},
+        {"op": "stamp", "path": "stamps/pie-apple.png", "pos": [300, 200], "scale": 50}
+    ]
+
+Inputs are image files, or folders of them. Each worker opens, edits and writes one
+image at a time, and only file names pass between the processes, so memory use
+stays at an image or so per worker however many files there are.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+
+# Images each worker process handles before it is replaced, so nothing builds up.
+TASKS_PER_WORKER = 500
+
+# Set up in each worker process by init_worker.
+app = None
+worker_script = None
+
+
+def find_images(paths):
+    """
+    Image files among the paths, looking inside folders, yielded as they are found.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+                if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield entry.path
+        else:
+            yield path
+
+
+def output_path(path, output, extension=None):
+    name = os.path.basename(path)
+    if extension:
+        name = os.path.splitext(name)[0] + '.' + extension.lstrip('.')
+    return os.path.join(output, name)
+
+
+def init_worker(script):
+    # Qt needs a QGuiApplication for fonts, one per process, with no display.
+    global app, worker_script
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PySide2.QtGui import QGuiApplication
+    app = QGuiApplication.instance() or QGuiApplication([])
+    worker_script = script
+
+
+def process(task):
+    """
+    Edit one image, in a worker process.
+    :param task: (input path, output path, folder stamp paths are relative to).
+    :return: (input path, error message or None, seconds taken).
+    """
+    import core
+
+    path, target, directory = task
+    start = time.perf_counter()
+    try:
+        image = core.load_image(path)
+        image = core.run_operations(image, worker_script, directory)
+        core.save_image(image, target)
+    except Exception as e:
+        return path, "%s: %s" % (type(e).__name__, e), time.perf_counter() - start
+    return path, None, time.perf_counter() - start
+
+
+def run(script, paths, output, jobs=None, extension=None, directory='', report=print):
+    """
+    Run a script over images with a pool of worker processes.
+    :param script: list of operations, see core.run_operations.
+    :param paths: image files or folders of them.
+    :param output: folder to write the results to, under the same names.
+    :param jobs: number of worker processes, by default one per core.
+    :param extension: format to write, by extension, rather than that of the input.
+    :param directory: folder stamp paths in the script are relative to.
+    :param report: called with a line of progress for each image.
+    :return: number of images which failed.
+    """
+    os.makedirs(output, exist_ok=True)
+    tasks = ((path, output_path(path, output, extension), directory) for path in find_images(paths))
+
+    # Spawned rather than forked, so workers start with a clean Qt.
+    context = multiprocessing.get_context('spawn')
+    failed = done = 0
+    start = time.perf_counter()
+    with context.Pool(jobs, initializer=init_worker, initargs=(script,), maxtasksperchild=TASKS_PER_WORKER) as pool:
+        for path, error, seconds in pool.imap_unordered(process, tasks):
+            done += 1
+            if error:
+                failed += 1
+                report("%d failed %s: %s" % (done, path, error))
+            else:
+                report("%d done %s (%.0f ms)" % (done, path, seconds * 1000))
+
+    report("%d images in %.1f s, %d failed" % (done, time.perf_counter() - start, failed))
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply a script of paint operations to many images.")
+    parser.add_argument('script', help="JSON file with the list of operations")
+    parser.add_argument('inputs', nargs='+', help="image files, or folders of them")
+    parser.add_argument('-o', '--output', required=True, help="folder to write the edited images to")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument('-f', '--format', default=None, help="write in this format, e.g. png, rather than the input's")
+    args = parser.parse_args(argv)
+
+    with open(args.script) as f:
+        script = json.load(f)
+
+    # Stamps are found next to the script.
+    directory = os.path.dirname(os.path.abspath(args.script))
+    return 1 if run(script, args.inputs, args.output, args.jobs, args.format, directory) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,629 @@
+"""
+Benchmarks for Piecasso's pixel operations.
+
+Run from the paint folder, no display is needed:
+
+    python benchmark.py
+"""
+from functools import partial
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+
+from PySide2.QtCore import QEvent, QEventLoop, QPoint, QPointF, QRect, Qt, QThreadPool, QTimer
+from PySide2.QtGui import QColor, QImage, QMouseEvent, QPainter, QPen, QPixmap
+from PySide2.QtWidgets import QApplication
+
+import filters
+from imaging import (bounds_stages, fill_stages, flood_fill, image_array, paint_mask_stages, paint_points,
+                     pixel_value, replace_color, spray_points)
+from layers import LayerStack
+from paint import Canvas, pen_margin
+from project import Project
+import tiles
+from tiles import TileJob
+from undo import UndoStack
+
+CANVAS_DIMENSIONS = 600, 400
+
+FILL_COLOR = QColor('#f70406')
+WHITE = QColor('#ffffff')
+
+
+def legacy_flood_fill(image, x, y, color):
+    """
+    The original per-pixel fill from Canvas.fill_mousePressEvent, for comparison.
+    """
+    w, h = image.width(), image.height()
+    target_color = image.pixel(x, y)
+
+    have_seen = set()
+    queue = [(x, y)]
+
+    def get_cardinal_points(have_seen, center_pos):
+        points = []
+        cx, cy = center_pos
+        for x, y in [(1, 0), (0, 1), (-1, 0), (0, -1)]:
+            xx, yy = cx + x, cy + y
+            if (xx >= 0 and xx < w and
+                yy >= 0 and yy < h and
+                (xx, yy) not in have_seen):
+
+                points.append((xx, yy))
+                have_seen.add((xx, yy))
+
+        return points
+
+    target = image.copy()
+    p = QPainter(target)
+    p.setPen(QPen(color))
+
+    while queue:
+        x, y = queue.pop()
+        if image.pixel(x, y) == target_color:
+            p.drawPoint(QPoint(x, y))
+            queue.extend(get_cardinal_points(have_seen, (x, y)))
+
+    p.end()
+    return target
+
+
+def empty_canvas(w, h):
+    image = QImage(w, h, QImage.Format_RGB32)
+    image.fill(WHITE)
+    return image
+
+
+def noisy_canvas(w, h, density=0.3, seed=0):
+    """
+    White canvas speckled with black pixels. Below the percolation threshold the
+    white area stays connected, so a fill from the clear patch in the middle
+    still reaches most of the canvas, one tiny span at a time.
+    """
+    rng = random.Random(seed)
+    image = empty_canvas(w, h)
+    black = QColor('#000000').rgb()
+    for _ in range(int(w * h * density)):
+        image.setPixel(rng.randrange(w), rng.randrange(h), black)
+
+    p = QPainter(image)
+    p.fillRect(w // 2 - 2, h // 2 - 2, 5, 5, WHITE)
+    p.end()
+    return image
+
+
+def maze_canvas(w, h, cell=4, seed=0):
+    """
+    White canvas carved into a perfect maze with black walls, the worst case
+    for a span-based fill as every corridor is a separate short span.
+    """
+    rng = random.Random(seed)
+    image = QImage(w, h, QImage.Format_RGB32)
+    image.fill(QColor('#000000'))
+
+    p = QPainter(image)
+    cols, rows = w // (cell * 2), h // (cell * 2)
+    seen = {(0, 0)}
+    stack = [(0, 0)]
+    p.fillRect(cell, cell, cell, cell, WHITE)
+
+    while stack:
+        cx, cy = stack[-1]
+        options = [
+            (cx + dx, cy + dy) for dx, dy in [(1, 0), (0, 1), (-1, 0), (0, -1)]
+            if 0 <= cx + dx < cols and 0 <= cy + dy < rows and (cx + dx, cy + dy) not in seen
+        ]
+        if not options:
+            stack.pop()
+            continue
+
+        nx, ny = rng.choice(options)
+        seen.add((nx, ny))
+        stack.append((nx, ny))
+        # Knock through the wall between the two cells, and open the new cell.
+        x0, y0 = (min(cx, nx) * 2 + 1) * cell, (min(cy, ny) * 2 + 1) * cell
+        p.fillRect(x0, y0, (abs(nx - cx) * 2 + 1) * cell, (abs(ny - cy) * 2 + 1) * cell, WHITE)
+
+    p.end()
+    return image
+
+
+CANVASES = [
+    ('empty', empty_canvas),
+    ('noisy', noisy_canvas),
+    ('maze', maze_canvas),
+]
+
+
+def find_seed(image):
+    """
+    First white pixel scanning outwards from the middle row, to start the fill in open space.
+    """
+    w, h = image.width(), image.height()
+    white = WHITE.rgb()
+    for y in sorted(range(h), key=lambda y: abs(y - h // 2)):
+        for x in range(w // 2, w):
+            if image.pixel(x, y) == white:
+                return x, y
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def benchmark_fill(dimensions=CANVAS_DIMENSIONS, legacy=True):
+    w, h = dimensions
+    print("Flood fill, %dx%d canvas" % (w, h))
+    print("%-8s %12s %12s %9s" % ('canvas', 'legacy (s)', 'scanline (s)', 'speedup'))
+
+    for name, build in CANVASES:
+        source = build(w, h)
+        x, y = find_seed(source)
+
+        image = source.copy()
+        t_new, _ = timed(flood_fill, image, x, y, FILL_COLOR)
+
+        if legacy:
+            t_old, expected = timed(legacy_flood_fill, source, x, y, FILL_COLOR)
+            assert expected == image, "Scanline fill differs from the legacy fill on %s canvas" % name
+            print("%-8s %12.3f %12.4f %8.0fx" % (name, t_old, t_new, t_old / t_new))
+        else:
+            print("%-8s %12s %12.4f %9s" % (name, '-', t_new, '-'))
+
+
+def benchmark_replace(dimensions=(3840, 2160), tolerances=(0, 10, 40)):
+    """
+    Global (replace color) fill over a canvas of random colors, where the
+    tolerance test has to look at every channel of every pixel.
+    """
+    w, h = dimensions
+    print("Global fill, %dx%d canvas" % (w, h))
+    print("%-10s %12s %10s" % ('tolerance', 'time (ms)', 'replaced'))
+
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 1 << 24, size=(h, w), dtype=np.uint32) | 0xff000000
+
+    for tolerance in tolerances:
+        image = QImage(w, h, QImage.Format_RGB32)
+        image_array(image)[:] = noise
+        t, rect = timed(replace_color, image, 0, 0, FILL_COLOR, tolerance)
+        replaced = int((image_array(image) == FILL_COLOR.rgba()).sum())
+        print("%-10d %12.1f %10d" % (tolerance, t * 1000, replaced))
+
+
+def benchmark_undo(dimensions=(3840, 2160), steps=200, seed=0):
+    """
+    Random brush strokes recorded through the undo stack, as the canvas does. Reports
+    the history size against keeping a full snapshot per step, then checks undoing
+    everything restores the original image and redoing everything the final one.
+    """
+    w, h = dimensions
+    print("Undo history, %dx%d canvas, %d strokes" % (w, h, steps))
+
+    rng = random.Random(seed)
+    image = empty_canvas(w, h)
+    original = image.copy()
+    stack = UndoStack(budget=float('inf'))
+
+    t_record = 0
+    for _ in range(steps):
+        x, y = rng.randrange(w), rng.randrange(h)
+        width = rng.randint(1, 40)
+        p = QPainter(image)
+        p.setPen(QPen(QColor(rng.randrange(1 << 24)), width))
+
+        start = time.perf_counter()
+        for _ in range(rng.randint(2, 20)):
+            nx, ny = x + rng.randint(-60, 60), y + rng.randint(-60, 60)
+            margin = width + 2
+            stack.touch(image, QRect(QPoint(x, y), QPoint(nx, ny)).normalized().adjusted(-margin, -margin, margin, margin))
+            p.drawLine(x, y, nx, ny)
+            x, y = nx, ny
+        p.end()
+        stack.commit(image)
+        t_record += time.perf_counter() - start
+
+    final = image.copy()
+    snapshot = image.sizeInBytes()
+    print("%-24s %10.1f KB" % ('history size', stack.memory / 1024))
+    print("%-24s %10.1f KB" % ('per step', stack.memory / 1024 / steps))
+    print("%-24s %10.1f KB" % ('full snapshot per step', snapshot / 1024))
+    print("%-24s %10.2f ms" % ('record per step', t_record * 1000 / steps))
+
+    t_undo, _ = timed(lambda: [stack.undo(image) for _ in range(steps)])
+    assert image == original, "Undoing every step did not restore the original image"
+    t_redo, _ = timed(lambda: [stack.redo(image) for _ in range(steps)])
+    assert image == final, "Redoing every step did not restore the final image"
+    print("%-24s %10.2f ms" % ('undo per step', t_undo * 1000 / steps))
+    print("%-24s %10.2f ms" % ('redo per step', t_redo * 1000 / steps))
+
+
+def legacy_spray(image, x, y, color, size, rng):
+    """
+    The original spray from Canvas.spray_mouseMoveEvent, a gauss pair and a drawPoint per dot.
+    """
+    p = QPainter(image)
+    p.setPen(QPen(color, 1))
+    for n in range(size * 100):
+        xo = rng.gauss(0, size * 5)
+        yo = rng.gauss(0, size * 5)
+        p.drawPoint(x + xo, y + yo)
+    p.end()
+
+
+def benchmark_spray(sizes=(1, 5, 20), events=50, seed=0):
+    """
+    Cost of one spray mouse move event, at the canvas' 100 dots per unit of size spread
+    over 5 pixels per unit. Also checks that a seeded spray is repeatable.
+    """
+    w, h = CANVAS_DIMENSIONS
+    print("Spray, per mouse move event")
+    print("%-6s %8s %12s %12s %9s" % ('size', 'dots', 'legacy (ms)', 'batch (ms)', 'speedup'))
+
+    for size in sizes:
+        image = empty_canvas(w, h)
+        rng = random.Random(seed)
+        t_old, _ = timed(lambda: [legacy_spray(image, w // 2, h // 2, FILL_COLOR, size, rng) for _ in range(events)])
+
+        image = empty_canvas(w, h)
+        generator = np.random.default_rng(seed)
+        t_new, _ = timed(lambda: [
+            paint_points(image, spray_points(generator, w // 2, h // 2, size * 100, size * 5), FILL_COLOR)
+            for _ in range(events)
+        ])
+        print("%-6d %8d %12.3f %12.3f %8.0fx" % (
+            size, size * 100, t_old * 1000 / events, t_new * 1000 / events, t_old / t_new))
+
+    images = []
+    for _ in range(2):
+        image = empty_canvas(w, h)
+        generator = np.random.default_rng(seed)
+        for n in range(events):
+            paint_points(image, spray_points(generator, w // 2 + n, h // 2, 500, 25), FILL_COLOR)
+        images.append(image)
+    assert images[0] == images[1], "Seeded spray is not repeatable"
+
+
+class LegacyCanvas(Canvas):
+    """
+    Canvas with the original pen, which built a new QPen and QPainter and drew a straight
+    segment for every mouse move event.
+    """
+
+    def pen_mousePressEvent(self, e):
+        self.generic_mousePressEvent(e)
+
+    def pen_mouseMoveEvent(self, e):
+        if self.last_pos:
+            rect = QRect(self.last_pos, e.pos())
+            self.touch(rect, pen_margin(self.config['size']))
+
+            p = QPainter(self.image)
+            p.setPen(QPen(self.active_color, self.config['size'], Qt.SolidLine, Qt.SquareCap, Qt.RoundJoin))
+            p.drawLine(self.last_pos, e.pos())
+
+            self.update_rect(rect, pen_margin(self.config['size']))
+            self.last_pos = e.pos()
+
+    def pen_mouseReleaseEvent(self, e):
+        self.generic_mouseReleaseEvent(e)
+
+
+def timed_canvas(cls):
+    """
+    Canvas class which notes when it last finished painting to the screen.
+    """
+    class TimedCanvas(cls):
+        painted = 0
+
+        def paintEvent(self, e):
+            super(TimedCanvas, self).paintEvent(e)
+            self.painted = time.perf_counter()
+
+    return TimedCanvas
+
+
+def stroke_latency(cls, burst, bursts=100, size=4):
+    """
+    Drive a pen stroke with bursts of mouse moves, as arrive from a fast pointer while the
+    app is busy, and time each burst from arriving in the queue to being on screen.
+    :return: list of latencies in seconds.
+    """
+    app = QApplication.instance()
+    w, h = CANVAS_DIMENSIONS
+    canvas = timed_canvas(cls)()
+    canvas.initialize()
+    canvas.set_mode('pen')
+    canvas.set_config('size', size)
+    canvas.resize(w, h)
+    canvas.show()
+    app.processEvents()
+
+    def mouse(kind, n):
+        # Zigzag across the canvas, a few pixels per event.
+        x = 20 + (n * 3) % (w - 40)
+        y = h // 2 + ((n * 7) % 120) - 60
+        return QMouseEvent(kind, QPointF(x, y), Qt.LeftButton, Qt.LeftButton, Qt.NoModifier)
+
+    app.sendEvent(canvas, mouse(QEvent.MouseButtonPress, 0))
+    latencies = []
+    n = 0
+    for _ in range(bursts):
+        start = time.perf_counter()
+        for _ in range(burst):
+            n += 1
+            app.postEvent(canvas, mouse(QEvent.MouseMove, n))
+        while canvas.painted < start:
+            app.processEvents()
+        latencies.append(canvas.painted - start)
+
+    app.sendEvent(canvas, mouse(QEvent.MouseButtonRelease, n))
+    canvas.close()
+    return latencies
+
+
+def benchmark_stroke(bursts=(1, 4, 16, 64)):
+    """
+    Input to pixel latency of a pen stroke, per-event segments against the coalesced stroke.
+    """
+    print("Pen stroke, input to screen latency per burst of mouse moves")
+    print("%-7s %12s %12s %12s %12s" % ('burst', 'legacy (ms)', 'p95 (ms)', 'stroke (ms)', 'p95 (ms)'))
+
+    for burst in bursts:
+        row = []
+        for cls in (LegacyCanvas, Canvas):
+            latencies = sorted(stroke_latency(cls, burst))
+            row += [sum(latencies) / len(latencies) * 1000, latencies[int(len(latencies) * 0.95)] * 1000]
+        print("%-7d %12.2f %12.2f %12.2f %12.2f" % tuple([burst] + row))
+
+
+FILTER_SIZES = [(600, 400), (1920, 1080), (3840, 2160), (7680, 4320)]
+
+FILTERS = [
+    ('invert', [filters.invert]),
+    ('flip h', [filters.flip_horizontal]),
+    ('flip v', [filters.flip_vertical]),
+    ('rotate 90', [filters.rotate_90]),
+    ('rotate 180', [filters.rotate_180]),
+    ('grayscale', [filters.grayscale]),
+    ('levels', [partial(filters.levels, black=20, white=230, gamma=1.2)]),
+    ('auto levels', [filters.auto_levels]),
+    ('posterize', [filters.posterize]),
+    ('blur r2', [filters.blur]),
+    ('blur r8', [partial(filters.blur, radius=8)]),
+    ('sharpen', [filters.sharpen]),
+]
+
+
+def legacy_invert(image):
+    # The original Image menu round trip: pixmap to image, invert, back to pixmap.
+    pixmap = QPixmap.fromImage(image)
+    img = pixmap.toImage()
+    img.invertPixels()
+    return QPixmap.fromImage(img)
+
+
+def legacy_flip(image):
+    pixmap = QPixmap.fromImage(image)
+    return QPixmap.fromImage(pixmap.toImage().mirrored(True, False))
+
+
+def benchmark_filters(sizes=FILTER_SIZES, repeat=3):
+    """
+    Time of each filter on a canvas of random colors, best of a few runs, against the
+    original QPixmap round trips for invert and flip.
+    """
+    print("Image filters, best of %d (ms)" % repeat)
+    print("%-12s" % 'filter' + ''.join("%12s" % ('%dx%d' % size) for size in sizes))
+
+    sources = []
+    rng = np.random.default_rng(0)
+    for w, h in sizes:
+        image = QImage(w, h, QImage.Format_RGB32)
+        image_array(image)[:] = rng.integers(0, 1 << 24, size=(h, w), dtype=np.uint32) | 0xff000000
+        sources.append(image)
+
+    def best(fn, source):
+        times = []
+        for _ in range(repeat):
+            image = source.copy()
+            times.append(timed(fn, image)[0])
+        return min(times) * 1000
+
+    rows = [('legacy inv.', legacy_invert), ('legacy flip', legacy_flip)]
+    rows += [(name, partial(filters.apply, chain=chain)) for name, chain in FILTERS]
+    for name, fn in rows:
+        print("%-12s" % name + ''.join("%12.1f" % best(fn, source) for source in sources))
+
+
+def fill_operation(pixels, x, y, value, tolerance, contiguous):
+    # The fill tool's stages, without the undo history.
+    mask = yield from fill_stages(pixels, x, y, tolerance, contiguous)
+    rect = yield from bounds_stages(mask)
+    yield from paint_mask_stages(pixels, mask, value)
+    return rect
+
+
+def run_job(threadpool, stages, count):
+    """
+    Run stages as a TileJob, timing it and the longest the event loop went without a turn.
+    :return: (seconds, longest stall in seconds)
+    """
+    loop = QEventLoop()
+    ticks = [time.perf_counter()]
+    stall = [0]
+
+    def tick():
+        now = time.perf_counter()
+        stall[0] = max(stall[0], now - ticks[-1])
+        ticks.append(now)
+
+    timer = QTimer()
+    timer.setInterval(1)
+    timer.timeout.connect(tick)
+    job = TileJob(threadpool, stages, count)
+    job.finished.connect(lambda result: loop.quit())
+    job.error.connect(lambda error: loop.quit())
+
+    start = time.perf_counter()
+    timer.start()
+    job.start()
+    loop.exec_()
+    timer.stop()
+    return time.perf_counter() - start, stall[0]
+
+
+def benchmark_tiles(dimensions=(3840, 2160), repeat=3):
+    """
+    Whole-image operations run in one go on the GUI thread, against the same stages run
+    as a TileJob on a QThreadPool. The stall is the longest the event loop was blocked,
+    which is the whole run when it's done in one go.
+    """
+    w, h = dimensions
+    threadpool = QThreadPool()
+    print("Tiled operations, %dx%d canvas, %d threads, best of %d" % (w, h, threadpool.maxThreadCount(), repeat))
+    print("%-12s %12s %12s %12s" % ('operation', 'inline (ms)', 'pool (ms)', 'stall (ms)'))
+
+    rng = np.random.default_rng(0)
+    source = QImage(w, h, QImage.Format_RGB32)
+    image_array(source)[:] = rng.integers(0, 1 << 24, size=(h, w), dtype=np.uint32) | 0xff000000
+    value = pixel_value(source, FILL_COLOR)
+
+    operations = [
+        ('blur r2', lambda p: filters.stages([filters.blur], p), 2),
+        ('fill 50%', lambda p: fill_operation(p, 0, 0, value, 128, True), 4),
+        ('replace 10%', lambda p: fill_operation(p, 0, 0, value, 25, False), 3),
+    ]
+    for name, stages, count in operations:
+        inline, pool, stall = [], [], []
+        for _ in range(repeat):
+            image = source.copy()
+            inline.append(timed(tiles.run, stages(image_array(image)))[0])
+            image = source.copy()
+            t, s = run_job(threadpool, stages(image_array(image)), count)
+            pool.append(t)
+            stall.append(s)
+        print("%-12s %12.1f %12.1f %12.1f" % (name, min(inline) * 1000, min(pool) * 1000, min(stall) * 1000))
+
+
+def benchmark_layers(dimensions=(3840, 2160), counts=(2, 4, 8, 16), dabs=200, seed=0):
+    """
+    Keeping the composite up to date while brush dabs are drawn on the top layer, using
+    the cache of the layers below, against blending every layer over each dab.
+    """
+    w, h = dimensions
+    print("Layer compositing, %dx%d canvas, %d brush dabs on the top layer" % (w, h, dabs))
+    print("%-8s %14s %14s %9s" % ('layers', 'blend all (ms)', 'cached (ms)', 'speedup'))
+
+    rng = random.Random(seed)
+    rects = [QRect(rng.randrange(w - 64), rng.randrange(h - 64), 64, 64) for _ in range(dabs)]
+
+    for count in counts:
+        background = QImage(w, h, QImage.Format_RGB32)
+        background.fill(WHITE)
+        layers = LayerStack(background)
+        for n in range(1, count):
+            layer = layers.add()
+            layer.image.fill(QColor(0, 0, 255, 40))
+            layer.mode = 'Multiply' if n % 2 else 'Normal'
+        layers.invalidate()
+
+        def blend_all():
+            for rect in rects:
+                p = QPainter(layers.composite)
+                p.setCompositionMode(QPainter.CompositionMode_Source)
+                p.fillRect(rect, 0)
+                layers.blend(p, layers.layers, rect)
+                p.end()
+
+        def cached():
+            for rect in rects:
+                layers.compose(rect)
+
+        t_all, _ = timed(blend_all)
+        t_cached, _ = timed(cached)
+        print("%-8d %14.3f %14.3f %8.1fx" % (count, t_all * 1000 / dabs, t_cached * 1000 / dabs, t_all / t_cached))
+
+
+def benchmark_project(dimensions=(3840, 2160), count=4, seed=0):
+    """
+    Saving a project in full, opening it and showing a window's worth, and saving it
+    again after a brush dab, against reading every tile in.
+    """
+    w, h = dimensions
+    print("Project files, %dx%d canvas, %d layers" % (w, h, count))
+
+    rng = np.random.default_rng(seed)
+    background = QImage(w, h, QImage.Format_RGB32)
+    background.fill(WHITE)
+    layers = LayerStack(background)
+    for n in range(1, count):
+        layer = layers.add()
+        pixels = image_array(layer.image)
+        # Scattered blocks, so tiles don't all compress to nothing.
+        for _ in range(200):
+            x, y = rng.integers(0, w - 100), rng.integers(0, h - 100)
+            pixels[y:y + 100, x:x + 100] = rng.integers(0, 1 << 32, dtype=np.uint32) | 0xff000000
+    undo_stack = UndoStack()
+
+    path = os.path.join(tempfile.mkdtemp(), 'benchmark.piecasso')
+    project = Project(path)
+    t_save, _ = timed(lambda: project.save(layers, undo_stack).run())
+    project.save_finished()
+    print("%-28s %9.1f ms  %6.1f MB" % ('full save', t_save * 1000, os.path.getsize(path) / 1e6))
+
+    view = QRect(0, 0, 1280, 720)
+
+    def open_view():
+        _, opened, _, _ = Project.open(path)
+        opened.ensure(view)
+        return opened
+
+    def open_all():
+        _, opened, _, _ = Project.open(path)
+        opened.ensure_all()
+        return opened
+
+    t_view, _ = timed(open_view)
+    t_all, _ = timed(open_all)
+    print("%-28s %9.1f ms" % ('open, 1280x720 in view', t_view * 1000))
+    print("%-28s %9.1f ms" % ('open, every tile', t_all * 1000))
+
+    layer = layers.active_layer
+    undo_stack.touch(layer.image, QRect(100, 100, 64, 64))
+    p = QPainter(layer.image)
+    p.fillRect(100, 100, 64, 64, FILL_COLOR)
+    p.end()
+    undo_stack.commit(layer.image, layer)
+    size = os.path.getsize(path)
+    t_inc, _ = timed(lambda: project.save(layers, undo_stack).run())
+    project.save_finished()
+    print("%-28s %9.1f ms  %6.1f kB added" % ('save after an edit', t_inc * 1000, (os.path.getsize(path) - size) / 1e3))
+
+
+if __name__ == '__main__':
+    app = QApplication([])
+    benchmark_fill()
+    print()
+    benchmark_replace()
+    print()
+    benchmark_undo()
+    print()
+    benchmark_spray()
+    print()
+    benchmark_stroke()
+    print()
+    benchmark_filters()
+    print()
+    benchmark_tiles()
+    print()
+    benchmark_layers()
+    print()
+    benchmark_project()
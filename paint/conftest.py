@@ -0,0 +1,15 @@
+"""
+Shared setup for the tests, run with pytest from the paint folder. No display is needed.
+"""
+import os
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import pytest
+
+from PySide2.QtWidgets import QApplication
+
+
+@pytest.fixture(scope='session')
+def app():
+    return QApplication.instance() or QApplication([])
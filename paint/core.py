@@ -0,0 +1,355 @@
+"""
+Piecasso's drawing operations, without the GUI.
+
+Everything here draws on a QImage, so it works under the offscreen Qt platform
+and in scripts (see batch.py) as well as behind the Canvas tools, which call the
+same functions. Only a QGuiApplication is needed, for fonts:
+
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QGuiApplication([])
+
+    image = core.load_image('photo.jpg')
+    core.shape(image, 'ellipse', QRect(10, 10, 200, 100), '#ff0000', width=3, fill='#ffff00')
+    core.text(image, QPoint(20, 60), "Hello", '#000000', core.font('Times', 24, bold=True))
+    image = core.apply_filters(image, ['auto_levels', 'sharpen'])
+    core.save_image(image, 'photo-edited.png')
+
+Colors can be given as QColor or anything QColor takes (e.g. '#ff0000'), rects as
+QRect or [x, y, width, height] and points as QPoint or [x, y], so operations can
+also be read from JSON, see run_operations.
+"""
+from functools import lru_cache, partial
+import os
+
+import numpy as np
+
+from PySide2.QtCore import QPoint, QPointF, QRect, Qt
+from PySide2.QtGui import QColor, QFont, QFontMetrics, QImage, QPainter, QPainterPath, QPen, QPolygon
+
+import filters
+from imaging import fill_mask, mask_bounds, paint_mask, paint_points, spray_points, working_format
+from stamps import stamp_variant
+
+BRUSH_MULT = 3
+SPRAY_PAINT_MULT = 5
+SPRAY_PAINT_N = 100
+
+# Shapes by tool name: the QPainter method drawing them and its extra arguments.
+SHAPES = {
+    'rect': ('drawRect', ()),
+    'ellipse': ('drawEllipse', ()),
+    'roundrect': ('drawRoundedRect', (25, 25)),
+}
+
+# Filters which can be applied by name.
+FILTERS = {
+    fn.__name__: fn for fn in (
+        filters.invert, filters.grayscale, filters.levels, filters.auto_levels, filters.posterize,
+        filters.blur, filters.sharpen, filters.flip_horizontal, filters.flip_vertical,
+        filters.rotate_90, filters.rotate_180, filters.rotate_270,
+    )
+}
+
+
+def to_color(color):
+    return QColor(color)
+
+
+def to_rect(rect):
+    return rect if isinstance(rect, QRect) else QRect(*rect)
+
+
+def to_point(point):
+    return point if isinstance(point, QPoint) else QPoint(*point)
+
+
+# Images.
+
+def load_image(path):
+    """
+    Read an image, in a format the pixel operations can work on directly (see
+    imaging.working_format).
+    :param path: image file.
+    :return: QImage
+    """
+    image = QImage(path)
+    if image.isNull():
+        raise IOError("Could not read %s" % path)
+    return working_format(image)
+
+
+def save_image(image, path, quality=-1):
+    if not image.save(path, None, quality):
+        raise IOError("Could not write %s" % path)
+
+
+def new_image(width, height, color='#ffffff'):
+    image = QImage(width, height, QImage.Format_RGB32)
+    image.fill(to_color(color))
+    return image
+
+
+# Pens and fonts, built once per set of options.
+
+@lru_cache(maxsize=64)
+def stroke_pen(rgba, width, cap):
+    """
+    Pen for the freehand tools, built once per color, width and cap rather than per mouse event.
+    :param rgba: color as an int, from QColor.rgba().
+    :param width: pen width in pixels.
+    :param cap: Qt.PenCapStyle
+    :return: QPen
+    """
+    return QPen(QColor.fromRgba(rgba), width, Qt.SolidLine, cap, Qt.RoundJoin)
+
+
+@lru_cache(maxsize=32)
+def font(family='Times', size=12, bold=False, italic=False, underline=False):
+    """
+    :return: QFont, which is shared so must not be changed.
+    """
+    f = QFont(family)
+    f.setPointSize(size)
+    f.setBold(bold)
+    f.setItalic(italic)
+    f.setUnderline(underline)
+    return f
+
+
+def pen_margin(width):
+    """
+    How far a line drawn with a pen of the given width can reach beyond its end points,
+    allowing for square caps on diagonals and a pixel of antialiasing.
+    :param width: pen width in pixels.
+    :return: int
+    """
+    return int(width * 0.71) + 2
+
+
+# Drawing. Each operation returns the QRect of the image it may have changed.
+
+def fill(image, x, y, color, tolerance=0, contiguous=True):
+    """
+    Flood fill from (x, y), or replace the color there everywhere.
+    :param tolerance: maximum per-channel difference from the seed color, 0-255.
+    :param contiguous: only the area connected to (x, y), rather than the whole image.
+    """
+    if not image.rect().contains(x, y):
+        return QRect()
+
+    mask = fill_mask(image, x, y, tolerance, contiguous)
+    paint_mask(image, mask, to_color(color))
+    return mask_bounds(mask)
+
+
+def shape(image, kind, rect, color, width=1, fill=None):
+    """
+    :param kind: 'rect', 'ellipse' or 'roundrect'.
+    :param rect: QRect, may be unnormalized.
+    :param fill: color to fill the shape with, or None.
+    """
+    fn, args = SHAPES[kind]
+    rect = to_rect(rect)
+    p = QPainter(image)
+    p.setPen(QPen(to_color(color), width, Qt.SolidLine, Qt.SquareCap, Qt.MiterJoin))
+    if fill is not None:
+        p.setBrush(to_color(fill))
+    getattr(p, fn)(rect, *args)
+    p.end()
+    margin = pen_margin(width)
+    return rect.normalized().adjusted(-margin, -margin, margin, margin)
+
+
+def line(image, start, end, color, width=1):
+    start, end = to_point(start), to_point(end)
+    p = QPainter(image)
+    p.setPen(QPen(to_color(color), width, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+    p.drawLine(start, end)
+    p.end()
+    margin = pen_margin(width)
+    return QRect(start, end).normalized().adjusted(-margin, -margin, margin, margin)
+
+
+def polygon(image, points, color, width=1, fill=None, closed=True):
+    """
+    :param points: list of points.
+    :param fill: color to fill a closed polygon with, or None.
+    :param closed: join the last point back to the first.
+    """
+    poly = QPolygon([to_point(point) for point in points])
+    p = QPainter(image)
+    p.setPen(QPen(to_color(color), width, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+    if closed:
+        if fill is not None:
+            p.setBrush(to_color(fill))
+        p.drawPolygon(poly)
+    else:
+        p.drawPolyline(poly)
+    p.end()
+    margin = pen_margin(width)
+    return poly.boundingRect().adjusted(-margin, -margin, margin, margin)
+
+
+def polyline(image, points, color, width=1):
+    return polygon(image, points, color, width, closed=False)
+
+
+def catmull_rom(p0, p1, p2, p3):
+    """
+    Bezier control points for the Catmull-Rom spline segment from p1 to p2, which passes
+    smoothly through every point of the stroke.
+    :return: the two QPointF control points for QPainterPath.cubicTo.
+    """
+    return p1 + (p2 - p0) / 6, p2 - (p3 - p1) / 6
+
+
+def stroke_path(points, start, end):
+    """
+    Smoothed path through points from index start to end. Each segment is a
+    Catmull-Rom curve, shaped by the points either side of it.
+    :param points: list of QPointF.
+    :return: QPainterPath
+    """
+    path = QPainterPath(points[start])
+    for n in range(start, end):
+        p0, p1, p2, p3 = points[max(n - 1, 0)], points[n], points[n + 1], points[min(n + 2, len(points) - 1)]
+        path.cubicTo(*catmull_rom(p0, p1, p2, p3), p2)
+    return path
+
+
+def stroke(image, points, color, width=1, brush=False):
+    """
+    A freehand stroke through points, as the pen (square ends) or brush (round, wider) draws.
+    """
+    points = [QPointF(to_point(point)) for point in points]
+    if brush:
+        width *= BRUSH_MULT
+    pen = stroke_pen(to_color(color).rgba(), width, Qt.RoundCap if brush else Qt.SquareCap)
+    path = stroke_path(points, 0, len(points) - 1)
+
+    p = QPainter(image)
+    p.setPen(pen)
+    p.drawPath(path)
+    p.end()
+    margin = pen_margin(width)
+    return path.controlPointRect().toAlignedRect().adjusted(-margin, -margin, margin, margin)
+
+
+def spray_dots(rng, x, y, size=1):
+    """
+    One burst of spray around (x, y).
+    :param rng: numpy.random.Generator.
+    :return: (n, 2) int array of points, and the QRect they cover.
+    """
+    points = spray_points(rng, x, y, size * SPRAY_PAINT_N, size * SPRAY_PAINT_MULT)
+    (x0, y0), (x1, y1) = points.min(axis=0), points.max(axis=0)
+    return points, QRect(int(x0), int(y0), int(x1 - x0) + 1, int(y1 - y0) + 1)
+
+
+def spray(image, x, y, color, size=1, seed=None):
+    points, rect = spray_dots(np.random.default_rng(seed), x, y, size)
+    paint_points(image, points, to_color(color))
+    return rect
+
+
+@lru_cache(maxsize=16)
+def load_stamp(path, scale=100, tint=None):
+    """
+    A stamp image read from a file, scaled and tinted, kept for reuse.
+    :param tint: color name to tint with, or None.
+    """
+    return stamp_variant(load_image(path), scale, QColor(tint) if tint else None)
+
+
+def stamp_rect(stamp, pos):
+    return QRect(pos.x() - stamp.width() // 2, pos.y() - stamp.height() // 2, stamp.width(), stamp.height())
+
+
+def stamp(image, stamp, pos):
+    """
+    :param stamp: QImage, or the path of a stamp image.
+    :param pos: centre of the stamp.
+    """
+    if not isinstance(stamp, QImage):
+        stamp = load_stamp(stamp)
+    rect = stamp_rect(stamp, to_point(pos))
+    p = QPainter(image)
+    p.drawImage(rect.topLeft(), stamp)
+    p.end()
+    return rect
+
+
+def text_rect(text, font, pos):
+    """
+    Area covered by text drawn with its baseline starting at pos.
+    """
+    return QFontMetrics(font).boundingRect(text).translated(pos)
+
+
+def text(image, pos, text, color, font):
+    """
+    :param pos: start of the baseline.
+    :param font: QFont, see font().
+    """
+    pos = to_point(pos)
+    p = QPainter(image)
+    p.setRenderHints(QPainter.Antialiasing)
+    p.setFont(font)
+    p.setPen(QPen(to_color(color), 1, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+    p.drawText(pos, text)
+    p.end()
+    return text_rect(text, font, pos).adjusted(-2, -2, 2, 2)
+
+
+def apply_filters(image, chain):
+    """
+    :param chain: list of filter callables or names (see FILTERS).
+    :return: the resulting QImage, the same one unless a filter changed its size.
+    """
+    return filters.apply(image, [FILTERS[fn] if isinstance(fn, str) else fn for fn in chain])
+
+
+# Scripts of operations, e.g. read from JSON.
+
+# Operations taking their arguments as they are, by name. Shapes, text, stamps and
+# filters are handled in run_operations.
+DRAWING = {
+    'fill': fill, 'line': line, 'polygon': polygon, 'polyline': polyline, 'stroke': stroke, 'spray': spray,
+}
+
+
+def run_operations(image, operations, directory=''):
+    """
+    Run a list of operations on an image. Each is a dict with the operation name under
+    'op' and its arguments by name, e.g.
+
+        {"op": "fill", "x": 10, "y": 10, "color": "#ff0000", "tolerance": 20}
+        {"op": "rect", "rect": [10, 10, 100, 50], "color": "#000000", "width": 3}
+        {"op": "text", "pos": [20, 40], "text": "Hi", "color": "#fff", "size": 24, "bold": true}
+        {"op": "stamp", "path": "stamps/pie-apple.png", "pos": [300, 200], "scale": 50}
+        {"op": "filter", "name": "blur", "radius": 4}
+
+    :param directory: folder relative stamp paths are found in.
+    :return: the resulting QImage.
+    """
+    for operation in operations:
+        args = dict(operation)
+        op = args.pop('op')
+
+        if op == 'filter':
+            name = args.pop('name')
+            image = apply_filters(image, [partial(FILTERS[name], **args) if args else FILTERS[name]])
+        elif op in SHAPES:
+            shape(image, op, **args)
+        elif op == 'text':
+            options = {key: args.pop(key) for key in ('family', 'size', 'bold', 'italic', 'underline') if key in args}
+            text(image, args['pos'], args['text'], args['color'], font(**options))
+        elif op == 'stamp':
+            path = os.path.join(directory, args['path'])
+            stamp(image, load_stamp(path, args.get('scale', 100), args.get('tint')), args['pos'])
+        elif op in DRAWING:
+            DRAWING[op](image, **args)
+        else:
+            raise ValueError("Unknown operation %r" % op)
+
+    return image
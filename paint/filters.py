@@ -0,0 +1,337 @@
+"""
+Whole-image filters for the paint canvas.
+
+Filters work on the (height, width) uint32 pixel view from imaging.image_array,
+so they read and write the QImage buffer directly, without copying the canvas.
+Each filter takes the pixel array and returns the result: the same array when it
+worked in place, or a new one when the shape changes (rotations). Parameters are
+given with keywords, so a chain is a list such as
+
+    [invert, partial(blur, radius=4), rotate_90]
+
+and apply() runs one on an image. Large filters work in strips of rows (or columns)
+so the temporary arrays stay small whatever the size of the canvas. stages() splits
+a chain into tasks on those strips instead, to run in parallel (see tiles.py).
+
+Colors are treated as stored. On premultiplied images (those with transparency)
+that is right for the linear filters (blur, sharpen, grayscale), while levels and
+posterize act on the premultiplied values.
+"""
+from functools import partial
+
+import numpy as np
+
+from PySide2.QtGui import QImage
+
+from imaging import image_array, strips
+
+# Channel order of a pixel in memory, the color channels are those other than alpha.
+ALPHA = 3 if np.little_endian else 0
+RGB = slice(0, 3) if np.little_endian else slice(1, 4)
+
+
+def channels(pixels):
+    """
+    View of a pixel array with the four channels of each pixel split out.
+    :param pixels: (height, width) uint32 array.
+    :return: (height, width, 4) uint8 array, sharing memory with pixels.
+    """
+    c = pixels.view(np.uint8)
+    # Setting the shape (rather than reshape) fails instead of quietly copying.
+    c.shape = pixels.shape + (4,)
+    return c
+
+
+def apply(image, chain):
+    """
+    Run a chain of filters on an image.
+    :param image: 32-bit QImage.
+    :param chain: list of filter callables.
+    :return: the same QImage if every filter worked in place, otherwise a new one.
+    """
+    original = image_array(image)
+    pixels = original
+    for fn in chain:
+        pixels = fn(pixels)
+
+    return result_image(image, original, pixels)
+
+
+def result_image(image, original, pixels):
+    """
+    The image holding the result of a chain of filters.
+    :param image: QImage the chain ran on.
+    :param original: its pixel array, which the chain started from.
+    :param pixels: pixel array the chain returned.
+    :return: image itself if the filters worked in place, otherwise a new QImage.
+    """
+    if pixels is original:
+        return image
+
+    result = QImage(pixels.shape[1], pixels.shape[0], image.format())
+    image_array(result)[:] = pixels
+    return result
+
+
+def apply_lut(pixels, lut):
+    """
+    Map the color channels through a lookup table, in place.
+    :param pixels: (height, width) uint32 array.
+    :param lut: 256 entry uint8 array.
+    """
+    for rows in strips(pixels.shape[0]):
+        c = channels(pixels[rows])
+        # Mapping all four bytes through take() and putting alpha back beats indexing
+        # the strided color channels alone.
+        alpha = c[..., ALPHA].copy()
+        np.take(lut, c, out=c)
+        c[..., ALPHA] = alpha
+    return pixels
+
+
+# Geometry.
+
+def flip_horizontal(pixels):
+    pixels[:] = pixels[:, ::-1]
+    return pixels
+
+
+def flip_vertical(pixels):
+    pixels[:] = pixels[::-1]
+    return pixels
+
+
+def rotate_90(pixels):
+    # Clockwise, np.rot90 turns the other way.
+    return np.ascontiguousarray(np.rot90(pixels, -1))
+
+
+def rotate_180(pixels):
+    pixels[:] = pixels[::-1, ::-1]
+    return pixels
+
+
+def rotate_270(pixels):
+    return np.ascontiguousarray(np.rot90(pixels, 1))
+
+
+# Color.
+
+def invert(pixels):
+    """
+    Invert the colors, keeping alpha. For premultiplied pixels the inverse of a channel
+    is alpha minus its value, which for opaque pixels is the usual 255 minus the value.
+    """
+    for rows in strips(pixels.shape[0]):
+        p = pixels[rows]
+        if p.min() >= 0xff000000:
+            # All opaque, as always without an alpha channel: 255 minus a channel is the
+            # channel with its bits flipped, a single pass like QImage.invertPixels.
+            p ^= 0xffffff
+            continue
+        # No channel exceeds alpha, so subtracting the colors from alpha copied into each
+        # of them never borrows across channels, and whole pixels can be done at once.
+        inverse = p >> 24
+        inverse *= 0x010101
+        inverse -= p & 0xffffff
+        p &= 0xff000000
+        p |= inverse
+    return pixels
+
+
+def grayscale(pixels):
+    """
+    Replace the colors with their luma (ITU-R 601 weights, in 8-bit fixed point).
+    """
+    for rows in strips(pixels.shape[0]):
+        p = pixels[rows]
+        # Pixels read as 0xAARRGGBB integers, whatever the byte order.
+        luma = (p >> 16 & 0xff) * 77
+        luma += (p >> 8 & 0xff) * 150
+        luma += (p & 0xff) * 29
+        luma >>= 8
+        luma *= 0x010101
+        p &= 0xff000000
+        p |= luma
+    return pixels
+
+
+def levels(pixels, black=0, white=255, gamma=1.0):
+    """
+    Stretch the range black to white over the full range, with a gamma adjustment.
+    :param black: input value which becomes 0.
+    :param white: input value which becomes 255.
+    :param gamma: greater than 1 brightens the midtones, less than 1 darkens them.
+    """
+    x = np.clip((np.arange(256) - black) / max(white - black, 1), 0, 1)
+    return apply_lut(pixels, np.round(255 * x ** (1 / gamma)).astype(np.uint8))
+
+
+def histogram(pixels):
+    # Counts of the color channel values, for auto_levels.
+    return np.bincount(channels(pixels)[..., RGB].ravel(), minlength=256)
+
+
+def auto_levels(pixels, clip=0.005):
+    """
+    Levels with the black and white points taken from the image itself, ignoring the
+    darkest and lightest fraction clip of the color values.
+    """
+    counts = sum(histogram(pixels[rows]) for rows in strips(pixels.shape[0]))
+    black, white = level_points(counts, clip)
+    return levels(pixels, black, white)
+
+
+def level_points(counts, clip):
+    # Black and white points which clip the given fraction of a histogram at either end.
+    cumulative = np.cumsum(counts) / max(counts.sum(), 1)
+    black = int(np.searchsorted(cumulative, clip))
+    white = int(np.searchsorted(cumulative, 1 - clip))
+    return black, max(white, black + 1)
+
+
+def posterize(pixels, steps=4):
+    """
+    Reduce each color channel to a number of evenly spaced values.
+    :param steps: values per channel, at least 2.
+    """
+    steps = max(steps, 2)
+    x = np.round(np.arange(256) * (steps - 1) / 255)
+    return apply_lut(pixels, np.round(x * 255 / (steps - 1)).astype(np.uint8))
+
+
+# Convolution.
+
+def box_pass(c, radius, axis):
+    """
+    Replace each value with the mean of the 2 * radius + 1 values around it along an axis,
+    in place. Edges are extended with their last value. The mean comes from a running sum,
+    so the cost doesn't depend on the radius.
+    :param c: (height, width, 4) uint8 array, or a strip of one.
+    :param axis: 0 to blur along columns, 1 along rows.
+    """
+    size = 2 * radius + 1
+    pad = [(0, 0)] * c.ndim
+    pad[axis] = (radius + 1, radius)
+    sums = np.cumsum(np.pad(c, pad, mode='edge'), axis=axis, dtype=np.uint32)
+
+    upper, lower = [slice(None)] * c.ndim, [slice(None)] * c.ndim
+    upper[axis], lower[axis] = slice(size, None), slice(None, -size)
+    total = sums[tuple(upper)] - sums[tuple(lower)]
+    total += size // 2
+    total //= size
+    c[:] = total
+
+
+def blur_rows(pixels, radius, passes=3):
+    # Horizontal blur, every row is independent so it is done a strip of rows at a time.
+    for rows in strips(pixels.shape[0]):
+        c = channels(pixels[rows])
+        for _ in range(passes):
+            box_pass(c, radius, axis=1)
+    return pixels
+
+
+def blur_columns(pixels, radius, passes=3):
+    # Vertical blur, a strip of columns at a time.
+    for cols in strips(pixels.shape[1]):
+        c = channels(pixels[:, cols])
+        for _ in range(passes):
+            box_pass(c, radius, axis=0)
+    return pixels
+
+
+def blur(pixels, radius=2, passes=3):
+    """
+    Blur by repeated box filters, which three passes bring close to a Gaussian.
+    :param radius: box radius of each pass, in pixels.
+    :param passes: number of box passes in each direction.
+    """
+    blur_rows(pixels, radius, passes)
+    return blur_columns(pixels, radius, passes)
+
+
+def sharpen(pixels, radius=1, amount=1.0):
+    """
+    Unsharp mask: push each pixel away from a blurred copy of the image.
+    :param radius: blur radius, the size of the detail which is sharpened.
+    :param amount: strength, 1 doubles the difference from the blurred image.
+    """
+    blurred = blur(pixels.copy(), radius)
+    for rows in strips(pixels.shape[0]):
+        c = channels(pixels[rows])[..., RGB]
+        b = channels(blurred[rows])[..., RGB]
+        sharp = c + amount * (c.astype(np.float32) - b)
+        np.clip(sharp, 0, channels(pixels[rows])[..., ALPHA, None], out=sharp)
+        c[:] = np.round(sharp)
+    return pixels
+
+
+# Parallel stages, see tiles.py.
+
+def row_stages(fn, pixels):
+    # Filters which treat every row on its own run on each strip of rows at once.
+    yield [partial(fn, pixels[rows]) for rows in strips(pixels.shape[0])]
+    return pixels
+
+
+def auto_levels_stages(fn, pixels):
+    counts = yield [partial(histogram, pixels[rows]) for rows in strips(pixels.shape[0])]
+    clip = getattr(fn, 'keywords', {}).get('clip', 0.005)
+    black, white = level_points(sum(counts), clip)
+    return (yield from row_stages(partial(levels, black=black, white=white), pixels))
+
+
+def blur_stages(fn, pixels):
+    radius = getattr(fn, 'keywords', {}).get('radius', 2)
+    passes = getattr(fn, 'keywords', {}).get('passes', 3)
+    yield [partial(blur_rows, pixels[rows], radius, passes) for rows in strips(pixels.shape[0])]
+    yield [partial(blur_columns, pixels[:, cols], radius, passes) for cols in strips(pixels.shape[1])]
+    return pixels
+
+
+# Filters which split into strips, with their stage generators and the number of stages.
+PARALLEL = {
+    invert: (row_stages, 1),
+    grayscale: (row_stages, 1),
+    levels: (row_stages, 1),
+    posterize: (row_stages, 1),
+    flip_horizontal: (row_stages, 1),
+    auto_levels: (auto_levels_stages, 2),
+    blur: (blur_stages, 2),
+}
+
+
+def stages(chain, pixels):
+    """
+    Split a chain of filters into stages of independent tasks on strips of the image,
+    for tiles.TileJob. Filters which can't be split run as a single task.
+    :param chain: list of filter callables.
+    :param pixels: (height, width) uint32 array, as from imaging.image_array.
+    :return: generator of stages, which returns the resulting pixel array.
+    """
+    for fn in chain:
+        split, _ = PARALLEL.get(getattr(fn, 'func', fn), (None, 1))
+        if split:
+            pixels = yield from split(fn, pixels)
+        else:
+            pixels, = yield [partial(fn, pixels)]
+    return pixels
+
+
+# Filters which move pixels around rather than change their colors.
+GEOMETRY = {flip_horizontal, flip_vertical, rotate_90, rotate_180, rotate_270}
+
+
+def moves_pixels(chain):
+    """
+    Whether a chain of filters moves pixels around (or changes the size of the image).
+    """
+    return any(getattr(fn, 'func', fn) in GEOMETRY for fn in chain)
+
+
+def stage_count(chain):
+    """
+    Number of stages stages() yields for a chain.
+    """
+    return sum(PARALLEL.get(getattr(fn, 'func', fn), (None, 1))[1] for fn in chain)
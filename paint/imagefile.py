@@ -0,0 +1,151 @@
+"""
+Loading and saving images off the GUI thread.
+
+Decoding or encoding a large image can take seconds, so both run as workers on a
+QThreadPool and report back with signals. The file is read (or written) in chunks
+so there is progress to show. Formats which can decode at a reduced size for less
+than the cost of a full decode (JPEG) first give a quick preview of big images.
+"""
+import os
+import sys
+import traceback
+
+from PySide2.QtCore import QBuffer, QByteArray, QIODevice, QObject, QRunnable, QSize, Qt, Signal, Slot
+from PySide2.QtGui import QImage, QImageReader, QImageWriter
+
+from imaging import working_format
+
+# Bytes read or written between progress updates.
+CHUNK_SIZE = 1024 * 1024
+
+# Images with more pixels than this get a preview while loading, if the format allows.
+PREVIEW_PIXELS = 4000 * 3000
+
+# Longest side of the preview.
+PREVIEW_SIZE = 1024
+
+# Formats whose decoders skip detail when reading at a reduced size. Others scale after a
+# full decode, so a preview would only double the work.
+PREVIEW_FORMATS = [b'jpeg']
+
+
+def remove_partial(path):
+    # Clear away a file left part written by a failed save, if there is one.
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ImageFileSignals(QObject):
+    '''
+    Defines the signals available from a running load or save worker.
+    '''
+    finished = Signal(QImage)
+    preview = Signal(QImage)
+    error = Signal(tuple)
+    progress = Signal(float)
+
+
+class LoadWorker(QRunnable):
+    '''
+    Worker thread for reading and decoding an image file.
+    '''
+
+    def __init__(self, path):
+        super(LoadWorker, self).__init__()
+        self.signals = ImageFileSignals()
+        self.path = path
+
+    def read_bytes(self):
+        # Read the compressed file in chunks, for the first half of the progress.
+        data = QByteArray()
+        total = max(os.path.getsize(self.path), 1)
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                data.append(chunk)
+                self.signals.progress.emit(0.5 * data.size() / total)
+        return data
+
+    def reader(self, data):
+        # The buffer is kept on the worker, it must outlive the reader.
+        self.buffer = QBuffer(data)
+        self.buffer.open(QIODevice.ReadOnly)
+        reader = QImageReader(self.buffer)
+        reader.setAutoTransform(True)
+        return reader
+
+    @Slot()
+    def run(self):
+        try:
+            data = self.read_bytes()
+
+            reader = self.reader(data)
+            size = reader.size()
+            if size.width() * size.height() > PREVIEW_PIXELS and reader.format() in PREVIEW_FORMATS:
+                reader.setScaledSize(size.scaled(QSize(PREVIEW_SIZE, PREVIEW_SIZE), Qt.KeepAspectRatio))
+                preview = reader.read()
+                if not preview.isNull():
+                    self.signals.preview.emit(preview)
+                reader = self.reader(data)
+
+            image = reader.read()
+            if image.isNull():
+                raise IOError("Could not read %s: %s" % (self.path, reader.errorString()))
+            self.signals.progress.emit(0.9)
+
+            # Convert here rather than in the canvas, which would do it on the GUI thread.
+            image = working_format(image)
+            self.signals.progress.emit(1.0)
+
+        except Exception:
+            exctype, value = sys.exc_info()[:2]
+            self.signals.error.emit((exctype, value, traceback.format_exc()))
+            return
+
+        self.signals.finished.emit(image)
+
+
+class SaveWorker(QRunnable):
+    '''
+    Worker thread for encoding and writing an image file.
+
+    The image passed in is a snapshot: QImage is copy-on-write, so the canvas can keep
+    drawing on its own image while this one is saved.
+    '''
+
+    def __init__(self, image, path, format=b'png'):
+        super(SaveWorker, self).__init__()
+        self.signals = ImageFileSignals()
+        self.image = QImage(image)
+        self.path = path
+        self.format = format
+
+    @Slot()
+    def run(self):
+        # Written alongside and then moved over the file, so a failed save leaves the old one intact.
+        temp_path = self.path + '.part'
+        try:
+            data = QByteArray()
+            buffer = QBuffer(data)
+            buffer.open(QIODevice.WriteOnly)
+            writer = QImageWriter(buffer, self.format)
+            if not writer.write(self.image):
+                raise IOError("Could not save %s: %s" % (self.path, writer.errorString()))
+            buffer.close()
+            self.signals.progress.emit(0.5)
+
+            total = max(data.size(), 1)
+            with open(temp_path, 'wb') as f:
+                for offset in range(0, data.size(), CHUNK_SIZE):
+                    f.write(data.mid(offset, CHUNK_SIZE).data())
+                    self.signals.progress.emit(0.5 + 0.5 * min(offset + CHUNK_SIZE, total) / total)
+            os.replace(temp_path, self.path)
+
+        except Exception:
+            exctype, value = sys.exc_info()[:2]
+            remove_partial(temp_path)
+            self.signals.error.emit((exctype, value, traceback.format_exc()))
+            return
+
+        self.signals.finished.emit(self.image)
@@ -0,0 +1,347 @@
+"""
+Pixel-level operations on QImage buffers.
+
+Everything here works on a NumPy view of the image memory, rather than going
+through QImage.pixel and QPainter.drawPoint, so a whole-canvas operation costs
+a handful of array passes instead of a Python loop per pixel.
+"""
+from bisect import bisect_left, bisect_right
+from functools import partial
+
+import numpy as np
+
+from PySide2.QtCore import QRect
+from PySide2.QtGui import QColor, QImage
+
+# Rows (or columns) processed at a time by strip-wise operations.
+STRIP_SIZE = 256
+
+
+def image_array(image):
+    """
+    Return a writable (height, width) uint32 view onto the pixels of a 32-bit image.
+
+    Nothing is copied, so writing to the array changes the image. The image must be
+    kept alive, and not detached, for as long as the array is in use.
+    :param image: QImage in one of the 32-bit formats.
+    :return: numpy.ndarray
+    """
+    if image.depth() != 32:
+        raise ValueError("Expected a 32-bit image, got depth %d" % image.depth())
+
+    stride = image.bytesPerLine() // 4
+    pixels = np.frombuffer(image.bits(), dtype=np.uint32)
+    return pixels.reshape(image.height(), stride)[:, :image.width()]
+
+
+def working_format(image):
+    """
+    The image in one of the two formats the pixel operations work on: premultiplied
+    ARGB if it has an alpha channel, RGB32 otherwise. Other formats, 32-bit ones such
+    as unpremultiplied ARGB included, are converted.
+    :param image: QImage
+    :return: the same QImage if it was already in that format, otherwise a converted copy.
+    """
+    format = QImage.Format_ARGB32_Premultiplied if image.hasAlphaChannel() else QImage.Format_RGB32
+    if image.format() != format:
+        image = image.convertToFormat(format)
+    return image
+
+
+def strips(length, size=STRIP_SIZE):
+    """
+    Slices covering range(length) in steps of size.
+    """
+    return [slice(start, min(start + size, length)) for start in range(0, length, size)]
+
+
+def pixel_value(image, color):
+    """
+    Convert a QColor into the raw pixel value it has in the given image's format.
+
+    Letting Qt do the conversion keeps premultiplied formats exact.
+    :param image: QImage the value is intended for.
+    :param color: QColor
+    :return: int
+    """
+    swatch = QImage(1, 1, image.format())
+    swatch.fill(color)
+    return int(image_array(swatch)[0, 0])
+
+
+def average_color(image, rect):
+    """
+    The average color over an area of an image, read straight from its buffer.
+
+    Colors are averaged premultiplied, so transparent pixels count for nothing.
+    :param image: QImage in one of the 32-bit formats.
+    :param rect: QRect, inside the image.
+    :return: QColor
+    """
+    pixels = image_array(image)[rect.top():rect.bottom() + 1, rect.left():rect.right() + 1]
+    # Channels of each pixel as (blue, green, red, alpha).
+    channels = ((pixels[..., None] >> np.array([0, 8, 16, 24], dtype=np.uint32)) & 0xff).astype(np.float64)
+
+    if image.format() == QImage.Format_RGB32:
+        channels[..., 3] = 255
+    elif image.format() != QImage.Format_ARGB32_Premultiplied:
+        channels[..., :3] *= channels[..., 3:] / 255
+
+    b, g, r, a = channels.reshape(-1, 4).mean(axis=0)
+    scale = 255 / a if a else 0
+    r, g, b = (int(min(round(v * scale), 255)) for v in (r, g, b))
+    return QColor(r, g, b, int(round(a)))
+
+
+def mask_bounds(mask):
+    """
+    Bounding rectangle of the set pixels in a boolean mask.
+    :param mask: (height, width) bool array.
+    :return: QRect, null if the mask is empty.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if not len(rows):
+        return QRect()
+
+    cols = np.flatnonzero(mask[rows[0]:rows[-1] + 1].any(axis=0))
+    return QRect(int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1))
+
+
+def flood_fill_mask(match, x, y):
+    """
+    Scanline flood fill over a boolean match array, starting from (x, y).
+
+    The match array is split into horizontal runs of matching pixels in one
+    vectorized pass. The search then walks from run to overlapping run on the
+    rows above and below, so the Python loop runs once per span rather than
+    once per pixel. The result is rebuilt from the reached runs with a cumulative
+    sum along each row.
+    :param match: (height, width) bool array, True where a pixel may be filled.
+    :param x: seed column.
+    :param y: seed row.
+    :return: (height, width) bool array of pixels 4-connected to the seed.
+    """
+    h, w = match.shape
+    if not match[y, x]:
+        return np.zeros((h, w), dtype=bool)
+
+    # Run edges: +1 where a run starts, -1 one past where it ends.
+    padded = np.zeros((h, w + 2), dtype=np.int8)
+    padded[:, 1:-1] = match
+    edges = np.diff(padded, axis=1)
+    run_y, run_start = np.nonzero(edges == 1)
+    run_end = np.nonzero(edges == -1)[1]
+    del padded, edges
+
+    # Runs come out in row-major order, so each row owns a contiguous slice.
+    first = np.searchsorted(run_y, np.arange(h + 1)).tolist()
+    ys, starts, ends = run_y.tolist(), run_start.tolist(), run_end.tolist()
+
+    seed = bisect_right(starts, x, first[y], first[y + 1]) - 1
+    reached = bytearray(len(starts))
+    reached[seed] = 1
+    stack = [seed]
+
+    while stack:
+        n = stack.pop()
+        s, e = starts[n], ends[n]
+        for ny in (ys[n] - 1, ys[n] + 1):
+            if 0 <= ny < h:
+                # Runs on the neighbouring row which share at least one column.
+                lo = bisect_right(ends, s, first[ny], first[ny + 1])
+                hi = bisect_left(starts, e, first[ny], first[ny + 1])
+                for k in range(lo, hi):
+                    if not reached[k]:
+                        reached[k] = 1
+                        stack.append(k)
+
+    selected = np.flatnonzero(np.frombuffer(reached, dtype=np.uint8))
+    steps = np.zeros((h, w + 1), dtype=np.int8)
+    steps[run_y[selected], run_start[selected]] = 1
+    steps[run_y[selected], run_end[selected]] = -1
+    return np.cumsum(steps, axis=1, dtype=np.int8)[:, :w].view(bool)
+
+
+def color_match(pixels, value, tolerance=0, alpha=True, out=None):
+    """
+    Boolean mask of the pixels within tolerance of a raw pixel value.
+
+    The distance is the largest difference over the channels, so a tolerance of 0
+    is an exact match. Each channel is tested with one wrapping uint8 subtraction,
+    since c lies in [lo, hi] exactly when (c - lo) mod 256 <= hi - lo.
+    :param pixels: (height, width) uint32 array, as from image_array.
+    :param value: raw pixel value to match against.
+    :param tolerance: maximum per-channel difference, 0-255.
+    :param alpha: whether to compare the alpha channel, which is constant in opaque formats.
+    :param out: (height, width) bool array to write the result to, or None for a new one.
+    :return: (height, width) bool array.
+    """
+    if not tolerance:
+        return np.equal(pixels, value, out=out)
+
+    channels = pixels.view(np.uint8).reshape(pixels.shape + (4,))
+    target = np.array([value], dtype=np.uint32).view(np.uint8)
+    alpha_channel = 3 if np.little_endian else 0
+
+    match = np.ones(pixels.shape, dtype=bool) if out is None else out
+    match[:] = True
+    offset = np.empty(pixels.shape, dtype=np.uint8)
+    within = np.empty(pixels.shape, dtype=bool)
+    for n in range(4):
+        lo = max(int(target[n]) - tolerance, 0)
+        hi = min(int(target[n]) + tolerance, 255)
+        if (n == alpha_channel and not alpha) or (lo == 0 and hi == 255):
+            continue
+
+        np.subtract(channels[..., n], np.uint8(lo), out=offset)
+        np.less_equal(offset, np.uint8(hi - lo), out=within)
+        match &= within
+
+    return match
+
+
+def fill_mask(image, x, y, tolerance=0, contiguous=True):
+    """
+    The pixels a fill starting from (x, y) would change.
+    :param image: 32-bit QImage.
+    :param x: seed column.
+    :param y: seed row.
+    :param tolerance: maximum per-channel difference from the seed color, 0-255.
+    :param contiguous: only the area connected to the seed, rather than the whole image.
+    :return: (height, width) bool array.
+    """
+    pixels = image_array(image)
+    match = color_match(pixels, pixels[y, x], tolerance, image.hasAlphaChannel())
+    return flood_fill_mask(match, x, y) if contiguous else match
+
+
+def fill_stages(pixels, x, y, tolerance=0, contiguous=True, alpha=True):
+    """
+    fill_mask split into stages for tiles.TileJob. The color test runs on strips of
+    rows in parallel, writing into one mask, and the flood fill then runs as one task.
+    :param pixels: (height, width) uint32 array, as from image_array.
+    :param alpha: whether to compare the alpha channel, see color_match.
+    :return: generator of stages, which returns the (height, width) bool mask.
+    """
+    value = pixels[y, x]
+    match = np.empty(pixels.shape, dtype=bool)
+    yield [partial(color_match, pixels[rows], value, tolerance, alpha, out=match[rows])
+           for rows in strips(pixels.shape[0])]
+    if contiguous:
+        match, = yield [partial(flood_fill_mask, match, x, y)]
+    return match
+
+
+def bounds_stages(mask):
+    """
+    mask_bounds split into stages for tiles.TileJob, a task per strip of rows.
+    :return: generator of stages, which returns the QRect.
+    """
+    rows = strips(mask.shape[0])
+    rects = yield [partial(mask_bounds, mask[r]) for r in rows]
+    bounds = QRect()
+    for r, rect in zip(rows, rects):
+        if not rect.isNull():
+            bounds |= rect.translated(0, r.start)
+    return bounds
+
+
+def paint_mask_stages(pixels, mask, value):
+    """
+    paint_mask split into stages for tiles.TileJob, a task per strip of rows.
+    :param value: raw pixel value to paint, see pixel_value.
+    :return: generator of stages.
+    """
+    value = np.uint32(value)
+    yield [partial(np.copyto, pixels[r], value, where=mask[r]) for r in strips(pixels.shape[0])]
+
+
+def paint_mask(image, mask, color):
+    """
+    Set every pixel under a mask to a color, in place.
+    :param image: 32-bit QImage.
+    :param mask: (height, width) bool array.
+    :param color: QColor
+    """
+    np.copyto(image_array(image), np.uint32(pixel_value(image, color)), where=mask)
+
+
+def flood_fill(image, x, y, color, tolerance=0):
+    """
+    Fill the region of pixels matching the color at (x, y), in place.
+    :param image: 32-bit QImage to fill.
+    :param x: seed column.
+    :param y: seed row.
+    :param color: QColor to fill with.
+    :param tolerance: maximum per-channel difference from the seed color, 0-255.
+    :return: QRect bounding the pixels which were changed.
+    """
+    if image_array(image)[y, x] == pixel_value(image, color) and not tolerance:
+        return QRect()
+
+    mask = fill_mask(image, x, y, tolerance)
+    paint_mask(image, mask, color)
+    return mask_bounds(mask)
+
+
+def replace_color(image, x, y, color, tolerance=0):
+    """
+    Replace the color at (x, y) everywhere on the image, in place.
+    :param image: 32-bit QImage to fill.
+    :param x: column of the pixel to take the color from.
+    :param y: row of the pixel to take the color from.
+    :param color: QColor to replace it with.
+    :param tolerance: maximum per-channel difference from the picked color, 0-255.
+    :return: QRect bounding the pixels which were changed.
+    """
+    if image_array(image)[y, x] == pixel_value(image, color) and not tolerance:
+        return QRect()
+
+    mask = fill_mask(image, x, y, tolerance, contiguous=False)
+    paint_mask(image, mask, color)
+    return mask_bounds(mask)
+
+
+def spray_points(rng, x, y, count, sigma):
+    """
+    Scatter points around (x, y) with a normal distribution, for the spray tool.
+    :param rng: numpy.random.Generator, seed it for a repeatable spray.
+    :param x: centre column.
+    :param y: centre row.
+    :param count: number of points.
+    :param sigma: standard deviation of the scatter, in pixels.
+    :return: (count, 2) int array of (x, y) pixel positions.
+    """
+    offsets = rng.normal(0, sigma, size=(count, 2))
+    return np.floor(offsets + (x + 0.5, y + 0.5)).astype(np.intp)
+
+
+def paint_points(image, points, color):
+    """
+    Set the pixels at a batch of positions to a color, in place. Positions outside the
+    image are skipped.
+    :param image: 32-bit QImage.
+    :param points: (n, 2) int array of (x, y) positions.
+    :param color: QColor
+    """
+    xs, ys = points[:, 0], points[:, 1]
+    inside = (xs >= 0) & (xs < image.width()) & (ys >= 0) & (ys < image.height())
+    image_array(image)[ys[inside], xs[inside]] = pixel_value(image, color)
+
+
+def tint(image, color):
+    """
+    Multiply the colors of an image by a color, keeping its shading and transparency.
+    :param image: QImage
+    :param color: QColor to tint with.
+    :return: new QImage, in premultiplied ARGB.
+    """
+    image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+    pixels = image_array(image)
+    channels = pixels.view(np.uint8).reshape(pixels.shape + (4,))
+
+    # Premultiplied channels stay valid when scaled down, alpha is left alone.
+    factors = [color.blue(), color.green(), color.red()] if np.little_endian else [color.red(), color.green(), color.blue()]
+    rgb = slice(0, 3) if np.little_endian else slice(1, 4)
+    channels[..., rgb] = (channels[..., rgb] * np.array(factors, dtype=np.uint16) + 127) // 255
+    return image
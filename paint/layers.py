@@ -0,0 +1,329 @@
+"""
+Layers for the paint canvas.
+
+The layers are blended into one image for the screen (and for saving) by
+QPainter composition modes. Rather than blend every layer for every change, the
+blend of the visible layers below the active one is cached. Tools only ever draw
+on the active layer, so bringing the composite up to date after a change is a
+copy from that cache plus a blend of each layer from the active one up, over the
+changed area only. With the top layer active that is a single blend.
+
+Hidden layers don't take part in the composite, so their pixels are kept
+zlib-compressed until they are shown again. Layers opened from a project file
+(see project.py) read their tiles only as they are needed, see ensure().
+"""
+import zlib
+
+import numpy as np
+
+from PySide2.QtCore import QRect
+from PySide2.QtGui import QImage, QPainter, QRegion
+
+from imaging import image_array
+
+# Blend modes on offer, by name, in menu order.
+BLEND_MODES = [
+    ('Normal', QPainter.CompositionMode_SourceOver),
+    ('Multiply', QPainter.CompositionMode_Multiply),
+    ('Screen', QPainter.CompositionMode_Screen),
+    ('Overlay', QPainter.CompositionMode_Overlay),
+    ('Darken', QPainter.CompositionMode_Darken),
+    ('Lighten', QPainter.CompositionMode_Lighten),
+    ('Color dodge', QPainter.CompositionMode_ColorDodge),
+    ('Color burn', QPainter.CompositionMode_ColorBurn),
+    ('Difference', QPainter.CompositionMode_Difference),
+    ('Add', QPainter.CompositionMode_Plus),
+]
+COMPOSITION_MODES = dict(BLEND_MODES)
+
+# zlib level for hidden layers, fast since layers are hidden and shown interactively.
+COMPRESSION_LEVEL = 1
+
+
+class Layer:
+    """
+    One layer: an image, with how it blends onto the layers below.
+    """
+
+    def __init__(self, image, name, opacity=1.0, mode='Normal', visible=True, tiles=None):
+        """
+        :param image: QImage, or None for a layer whose pixels all come from tiles.
+        :param tiles: project.TileSource the tiles not read in yet come from, or None.
+        """
+        self._image = image
+        self.packed = None
+        self.tiles = tiles
+        self.name = name
+        self.opacity = opacity
+        self.mode = mode
+        self.visible = visible
+
+    @property
+    def image(self):
+        if self._image is None:
+            if self.packed is not None:
+                self.unpack()
+            else:
+                self._image = self.tiles.blank()
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self.packed = None
+
+    @property
+    def size(self):
+        if self._image is not None:
+            return self._image.size()
+        return self.packed[0] if self.packed is not None else self.tiles.size
+
+    @property
+    def nbytes(self):
+        # Memory held for the pixels, packed or not.
+        if self._image is not None:
+            return self._image.sizeInBytes()
+        return len(self.packed[2]) if self.packed is not None else 0
+
+    def ensure(self, rect=None):
+        """
+        Read in the tiles under rect (or all of them) of a layer opened from a project,
+        if they haven't been already.
+        :return: QRect bounding the area read, null if nothing was.
+        """
+        if self.tiles is None:
+            return QRect()
+
+        loaded = self.tiles.load(self.image, rect)
+        if not self.tiles.missing:
+            self.tiles = None
+        return loaded
+
+    def pack(self):
+        """
+        Compress the pixels, freeing the image until it is next used.
+        """
+        if self._image is not None:
+            self.ensure()
+            image = self._image
+            data = zlib.compress(np.ascontiguousarray(image_array(image)).tobytes(), COMPRESSION_LEVEL)
+            self.packed = (image.size(), image.format(), data)
+            self._image = None
+
+    def unpack(self):
+        size, format, data = self.packed
+        image = QImage(size, format)
+        image_array(image)[:] = np.frombuffer(zlib.decompress(data), dtype=np.uint32).reshape(
+            size.height(), size.width())
+        self._image = image
+        self.packed = None
+
+
+class LayerStack:
+    """
+    The layers of a drawing, bottom first, with a cache of their blend.
+
+    Whenever pixels change call compose() with the area, and call invalidate() when
+    anything else changes which affects the blend below the active layer.
+    """
+
+    def __init__(self, image):
+        self.layers = [Layer(image, "Background")]
+        self.active = 0
+        self.reset_cache()
+
+    @classmethod
+    def from_layers(cls, layers, active=0):
+        stack = cls.__new__(cls)
+        stack.layers = layers
+        stack.active = active
+        stack.pack_hidden()
+        stack.reset_cache()
+        return stack
+
+    @property
+    def active_layer(self):
+        return self.layers[self.active]
+
+    def size(self):
+        return self.layers[0].size
+
+    def rect(self):
+        return QRect(0, 0, self.size().width(), self.size().height())
+
+    def new_image(self):
+        image = QImage(self.size(), QImage.Format_ARGB32_Premultiplied)
+        image.fill(0)
+        return image
+
+    # Changing the stack.
+
+    def add(self, image=None, name=None):
+        """
+        Add a layer above the active one, which becomes active.
+        :param image: QImage for the layer, or None for a transparent one.
+        :return: the new Layer.
+        """
+        layer = Layer(image if image is not None else self.new_image(), name or "Layer %d" % (len(self.layers) + 1))
+        self.layers.insert(self.active + 1, layer)
+        self.select(self.active + 1)
+        return layer
+
+    def remove(self, index):
+        # The last layer can't go.
+        if len(self.layers) > 1:
+            del self.layers[index]
+            self.select(min(self.active, len(self.layers) - 1))
+
+    def move(self, index, to):
+        to = max(0, min(to, len(self.layers) - 1))
+        active = self.active_layer
+        self.layers.insert(to, self.layers.pop(index))
+        self.select(self.layers.index(active))
+
+    def select(self, index):
+        self.active = index
+        self.pack_hidden()
+        self.invalidate()
+
+    def set_visible(self, index, visible):
+        self.layers[index].visible = visible
+        self.pack_hidden()
+        self.invalidate()
+
+    def pack_hidden(self):
+        # The active layer stays unpacked even when hidden, as the tools draw on it.
+        for n, layer in enumerate(self.layers):
+            if not layer.visible and n != self.active:
+                layer.pack()
+
+    def set_opacity(self, index, opacity):
+        self.layers[index].opacity = opacity
+        self.invalidate()
+
+    def set_mode(self, index, mode):
+        self.layers[index].mode = mode
+        self.invalidate()
+
+    def set_images(self, images):
+        """
+        Replace the image of every layer, e.g. after a rotation changed their size.
+        :param images: list of QImage, one per layer, bottom first.
+        """
+        for layer, image in zip(self.layers, images):
+            layer.image = image
+        self.pack_hidden()
+        self.reset_cache()
+
+    def ensure(self, rect):
+        """
+        Read in the tiles under rect of the layers which show there (see Layer.ensure),
+        updating the composite over what was read.
+        :return: QRect bounding the area read, null if nothing was.
+        """
+        loaded = QRect()
+        for n, layer in enumerate(self.layers):
+            if layer.tiles is not None and (layer.visible or n == self.active):
+                loaded |= layer.ensure(rect)
+
+        if not loaded.isNull():
+            self.invalidate(loaded)
+        return loaded
+
+    def ensure_all(self):
+        # Read in every tile of every layer, before an operation which works on all of them.
+        loaded = QRect()
+        for layer in self.layers:
+            if layer.tiles is not None:
+                loaded |= layer.ensure()
+
+        if not loaded.isNull():
+            self.invalidate(loaded)
+        return loaded
+
+    # Compositing.
+
+    def passthrough(self):
+        # With a single plain layer showing, the blend is that layer's image as it is.
+        visible = [layer for layer in self.layers if layer.visible]
+        return len(visible) == 1 and visible[0].mode == 'Normal' and visible[0].opacity >= 1
+
+    def reset_cache(self):
+        self.below = None
+        self.below_stale = QRegion()
+        self.composite = None
+        self.invalidate()
+
+    def invalidate(self, rect=None):
+        """
+        Mark the blend of the layers below the active one as out of date, over rect or all
+        of it, and rebuild the composite.
+        """
+        rect = self.rect() if rect is None else rect & self.rect()
+        self.below_stale += QRegion(rect)
+        self.compose(rect)
+
+    def blend(self, p, layers, rect):
+        # Draw layers onto a painter in their blend modes, over one area.
+        for layer in layers:
+            if layer.visible and layer.opacity > 0:
+                p.setCompositionMode(COMPOSITION_MODES[layer.mode])
+                p.setOpacity(layer.opacity)
+                p.drawImage(rect.topLeft(), layer.image, rect)
+
+    def update_below(self):
+        below = [layer for layer in self.layers[:self.active] if layer.visible]
+        if not below:
+            self.below = None
+            return
+
+        if self.below is None:
+            self.below = self.new_image()
+            self.below_stale = QRegion(self.rect())
+        self.below_stale &= QRegion(self.rect())
+
+        if not self.below_stale.isEmpty():
+            p = QPainter(self.below)
+            for rect in self.below_stale.rects():
+                p.setCompositionMode(QPainter.CompositionMode_Source)
+                p.setOpacity(1)
+                p.fillRect(rect, 0)
+                self.blend(p, below, rect)
+            p.end()
+            self.below_stale = QRegion()
+
+    def compose(self, rect):
+        """
+        Bring the composite up to date over an area, after its pixels changed.
+        :param rect: QRect in image coordinates.
+        """
+        if self.passthrough():
+            self.composite = None
+            self.below = None
+            return
+
+        rect = rect & self.rect()
+        if self.composite is None:
+            self.composite = self.new_image()
+            rect = self.rect()
+        if rect.isEmpty():
+            return
+
+        self.update_below()
+        p = QPainter(self.composite)
+        p.setCompositionMode(QPainter.CompositionMode_Source)
+        if self.below is None:
+            p.fillRect(rect, 0)
+        else:
+            p.drawImage(rect.topLeft(), self.below, rect)
+        self.blend(p, self.layers[self.active:], rect)
+        p.end()
+
+    def flattened(self):
+        """
+        The blend of all of the visible layers, as shown on the screen.
+        :return: QImage, which changes as the layers are drawn on (copy it to keep it).
+        """
+        if self.composite is None:
+            return [layer for layer in self.layers if layer.visible][0].image
+        return self.composite
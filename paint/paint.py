@@ -1,16 +1,29 @@
 
+from functools import lru_cache, partial
+import math
 import os
-import random
 import types
 
-from PySide2.QtCore import (QCoreApplication, QMetaObject, QObject, QRect, QRunnable, QSize,  Qt, QThreadPool, QTimer, Signal, Slot)
-from PySide2.QtGui import (QBrush, QColor, QFont, QIcon, QImage, QPainter, QPalette, QPen, QPixmap)
-from PySide2.QtWidgets import (QAction, QApplication, QButtonGroup, QComboBox, QFontComboBox, QFormLayout, QGridLayout, QHBoxLayout, QLabel, QLayout, QLineEdit, QMainWindow, QMenu, QMenuBar, QMessageBox, QPushButton, QSizePolicy, QSlider, QSpacerItem, QStatusBar, QToolBar, QVBoxLayout, QWidget)
+import numpy as np
 
+from PySide2.QtCore import (QCoreApplication, QMetaObject, QObject, QPoint, QPointF, QRect, QRectF, QRunnable, QSize,  Qt, QThreadPool, QTimer, Signal, Slot)
+from PySide2.QtGui import (QColor, QFont, QFontMetrics, QIcon, QImage, QMouseEvent, QPainter, QPalette, QPen, QPixmap, QPolygon, QRegion, QStaticText, QTransform)
+from PySide2.QtWidgets import (QAction, QApplication, QButtonGroup, QColorDialog, QComboBox, QDockWidget, QFileDialog, QFontComboBox, QFormLayout, QGridLayout, QHBoxLayout, QLabel, QLayout, QLineEdit, QListWidget, QListWidgetItem, QMainWindow, QMenu, QMenuBar, QMessageBox, QProgressBar, QPushButton, QSizePolicy, QSlider, QSpacerItem, QStatusBar, QToolBar, QVBoxLayout, QWidget)
+
+import core
+from core import BRUSH_MULT, pen_margin, stroke_path, stroke_pen
+import filters
+from imagefile import LoadWorker, SaveWorker
+from layers import BLEND_MODES, LayerStack
+from project import PROJECT_EXTENSION, Project
+from selection import Selection
+from imaging import (average_color, bounds_stages, fill_stages, image_array, paint_mask_stages, paint_points,
+                     pixel_value, working_format)
+from stamps import STAMP_SCALES, StampLibrary
+import tiles
+from tiles import TileJob
+from undo import Group, Restack, Swap, UndoStack
 
-BRUSH_MULT = 3
-SPRAY_PAINT_MULT = 5
-SPRAY_PAINT_N = 100
 
 COLORS = [
     '#000000', '#82817f', '#820300', '#868417', '#007e03', '#037e7b', '#040079',
@@ -22,6 +35,12 @@ COLORS = [
 
 FONT_SIZES = [7, 8, 9, 10, 11, 12, 13, 14, 18, 24, 36, 48, 64, 72, 96, 144, 288]
 
+# Dropper sample sizes, in pixels across.
+DROPPER_SIZES = [1, 3, 5]
+
+# Colors kept in the recent colors toolbar, newest first.
+RECENT_COLORS = 10
+
 MODES = [
     'selectpoly', 'selectrect',
     'eraser', 'fill',
@@ -35,29 +54,53 @@ MODES = [
 
 CANVAS_DIMENSIONS = 600, 400
 
+# Zoom limits, and the step for each wheel notch or zoom in/out.
+ZOOM_MIN = 1 / 64
+ZOOM_MAX = 32
+ZOOM_STEP = 1.25
+
 STAMP_DIR = './stamps'
-STAMPS = [os.path.join(STAMP_DIR, f) for f in os.listdir(STAMP_DIR)]
+
+# Whole-image operations run on the thread pool for images with more pixels than this,
+# smaller ones are done sooner than a progress bar could be shown.
+BACKGROUND_PIXELS = 1024 * 1024
 
 SELECTION_PEN = QPen(QColor(0xff, 0xff, 0xff), 1, Qt.DashLine)
 PREVIEW_PEN = QPen(QColor(0xff, 0xff, 0xff), 1, Qt.SolidLine)
 
 
+def font_key(config):
+    # The font options of the configuration, as a hashable key.
+    return config['font'].family(), config['fontsize'], config['bold'], config['italic'], config['underline']
+
+
 def build_font(config):
     """
-    Construct a complete font from the configuration options
-    :param self:
+    Construct a complete font from the configuration options, once per combination of them.
     :param config:
-    :return: QFont
+    :return: QFont, which is shared so must not be changed.
     """
-    font = config['font']
-    font.setPointSize(config['fontsize'])
-    font.setBold(config['bold'])
-    font.setItalic(config['italic'])
-    font.setUnderline(config['underline'])
-    return font
+    return core.font(*font_key(config))
 
 
-class Canvas(QLabel):
+@lru_cache(maxsize=8)
+def text_layout(text, key, scale):
+    """
+    Text laid out for the preview, only again once the text, font or zoom change.
+    :param text: str
+    :param key: font options, from font_key.
+    :param scale: zoom the preview is shown at, glyphs are placed for it.
+    :return: QStaticText, the QRect it covers relative to the baseline, and the ascent.
+    """
+    font = core.font(*key)
+    static = QStaticText(text)
+    static.setTextFormat(Qt.PlainText)
+    static.prepare(QTransform.fromScale(scale, scale), font)
+    metrics = QFontMetrics(font)
+    return static, metrics.boundingRect(text), metrics.ascent()
+
+
+class Canvas(QWidget):
 
     mode = 'rectangle'
 
@@ -66,12 +109,24 @@ class Canvas(QLabel):
 
     primary_color_updated = Signal(str)
     secondary_color_updated = Signal(str)
+    job_started = Signal(object, str)
+    layers_changed = Signal()
 
     # Store configuration settings, including pen width, fonts etc.
     config = {
         # Drawing options.
         'size': 1,
         'fill': True,
+        # Fill tool options, tolerance is a percentage.
+        'tolerance': 0,
+        'fill_global': False,
+        # Dropper samples the average over a square of this many pixels across.
+        'dropper_size': 1,
+        # Seed for the spray scatter, restarted for each stroke. None for a random spray.
+        'spray_seed': None,
+        # Stamp options, size is a percentage of the original.
+        'stamp_scale': 100,
+        'stamp_tint': False,
         # Font options.
         'font': QFont('Times'),
         'fontsize': 12,
@@ -83,9 +138,46 @@ class Canvas(QLabel):
     active_color = None
     preview_pen = None
 
-    timer_event = None
+    # Preview drawn over the image by paintEvent: (QPainter method, args, pen, font, invert),
+    # and the image area it covers.
+    overlay = None
+    overlay_rect = None
+
+    # Freehand stroke in progress: the painter held open on the image, and its points.
+    stroke_painter = None
+    stroke_points = None
+
+    # Locked selection of the select tools, and its pixels while they are being dragged.
+    selection = None
+    floating = None
 
+    # Stamp image, None while it is loading. Clicks made meanwhile are stamped once it arrives.
     current_stamp = None
+    pending_stamps = []
+
+    # Whole-image operation running on the thread pool (see tiles.py), and the pool. The
+    # tools take no input while one runs, but the view can still be moved around.
+    job = None
+    threadpool = None
+
+    # Viewport: image pixels are shown at zoom scale, shifted by offset (in widget pixels).
+    zoom = 1.0
+    pan_pos = None
+
+    def __init__(self, *args, **kwargs):
+        super(Canvas, self).__init__(*args, **kwargs)
+        self.undo_stack = UndoStack()
+
+        # Marching ants for selections, only running while a selection is shown.
+        self.ants_timer = QTimer(self)
+        self.ants_timer.setInterval(100)
+        self.ants_timer.timeout.connect(self.march_ants)
+
+        # Stroke points are drawn once the queued mouse moves have all been handled.
+        self.stroke_timer = QTimer(self)
+        self.stroke_timer.setSingleShot(True)
+        self.stroke_timer.setInterval(0)
+        self.stroke_timer.timeout.connect(self.flush_stroke)
 
     def initialize(self):
         self.background_color = QColor(self.secondary_color) if self.secondary_color else QColor(Qt.white)
@@ -94,11 +186,506 @@ class Canvas(QLabel):
         self.reset()
 
     def reset(self):
-        # Create the pixmap for display.
-        self.setPixmap(QPixmap(*CANVAS_DIMENSIONS))
+        # Create the image which holds the drawing.
+        image = QImage(*CANVAS_DIMENSIONS, QImage.Format_RGB32)
 
         # Clear the canvas.
-        self.pixmap().fill(self.background_color)
+        image.fill(self.background_color)
+        self.set_image(image)
+
+    def clear_image(self):
+        """
+        Clear the active layer to the background, or to transparent on layers which have
+        it, as an undo step. The other layers and the history are left alone.
+        """
+        if self.job:
+            return
+        self.reset_mode()
+        self.commit()
+        self.touch(self.image.rect())
+        image_array(self.image)[:] = self.background_value()
+        self.commit()
+        self.update_rect(self.image.rect())
+
+    def set_image(self, image):
+        """
+        Replace the drawing with a new image, converting it to a format the tools can
+        work on the pixel buffer of (see imaging.working_format). The image is kept at
+        full resolution, only the visible part of it is ever drawn to the screen.
+        :param image: QImage
+        """
+        self.set_layers(LayerStack(working_format(image)))
+
+    def set_layers(self, layers):
+        """
+        Replace the drawing with a stack of layers, clearing the undo history.
+        :param layers: LayerStack
+        """
+        if self.job:
+            # Anything still running works on the old layers, which it keeps hold of.
+            self.job.cancel()
+            self.job = None
+        self.end_stroke()
+        if self.selection is not None:
+            # Any selection was of the old drawing.
+            self.floating = None
+            self.reset_mode()
+
+        self.layers = layers
+        self.undo_stack.clear()
+        self.zoom = 1.0
+        self.offset = QPointF()
+        self.image_changed()
+
+    @property
+    def image(self):
+        # The active layer's image, which the tools draw on.
+        return self.layers.active_layer.image
+
+    def image_changed(self):
+        """
+        Redraw everything after the layers changed size, or were replaced.
+        """
+        # Downscaled copies of the image for zoomed out views, by level (1/2**level), built on demand.
+        self.mips = {}
+        self.mip_stale = {}
+        self.shown_size = self.layers.size()
+
+        self.clamp_offset()
+        self.updateGeometry()
+        self.update()
+        self.layers_changed.emit()
+
+    def update_rect(self, rect, margin=0):
+        """
+        Mark a region of the active layer as changed, scheduling a repaint of just that part
+        of the view rather than all of it.
+        :param rect: QRect in image coordinates, may be unnormalized (e.g. from two line end points).
+        :param margin: extra pixels to include on every side, to cover the pen width.
+        """
+        rect = rect.normalized().adjusted(-margin, -margin, margin, margin) & self.image.rect()
+        self.layers.compose(rect)
+        self.update_view(rect)
+
+    def update_view(self, rect):
+        # Repaint part of the view, from the composite which is already up to date.
+        for level in self.mips:
+            self.mip_stale[level] += QRegion(rect)
+
+        self.update(self.map_from_image(rect).toAlignedRect().adjusted(-1, -1, 1, 1))
+
+    # Undo history.
+
+    def touch(self, rect, margin=0):
+        """
+        Record the pixels in a region before drawing over them, so the change can be undone.
+        :param rect: QRect in image coordinates, may be unnormalized.
+        :param margin: extra pixels to include on every side, to cover the pen width.
+        """
+        rect = rect.normalized().adjusted(-margin, -margin, margin, margin)
+        self.layers.ensure(rect)
+        self.undo_stack.touch(self.image, rect)
+
+    def commit(self):
+        """
+        Close the current operation as a single undo step, on the active layer.
+        """
+        self.undo_stack.commit(self.image, self.layers.active_layer)
+
+    def undo(self):
+        if self.job:
+            return
+        self.reset_mode()
+        self.commit()
+        # The step may be on any layer, anywhere.
+        self.layers.ensure_all()
+        self.show_step(self.undo_stack.undo)
+
+    def redo(self):
+        if self.job:
+            return
+        self.reset_mode()
+        self.commit()
+        # The step may be on any layer, anywhere.
+        self.layers.ensure_all()
+        self.show_step(self.undo_stack.redo)
+
+    def show_step(self, step):
+        # Undo or redo, and show the result, which may have been on any layer, may have
+        # swapped in images of a different size, or changed the layers themselves.
+        layers = list(self.layers.layers)
+        image, rect = step(self.image)
+        if self.layers.layers != layers:
+            self.layers_changed.emit()
+        if self.layers.size() != self.shown_size:
+            self.layers.reset_cache()
+            self.image_changed()
+        else:
+            self.layers.invalidate(rect)
+            self.update_view(rect)
+
+    def apply_filters(self, chain):
+        """
+        Run a chain of filters (see filters.py) over the whole image, as one undo step.
+        Filters which move pixels around apply to every layer so they stay lined up, the
+        rest to the active layer.
+        :param chain: list of filter callables.
+        """
+        if self.job:
+            return
+        self.reset_mode()
+        self.commit()
+        self.layers.ensure_all()
+
+        if filters.moves_pixels(chain):
+            # The undo step keeps every layer whole, they may change size.
+            layers = self.layers.layers
+            step = Group([Swap(layer.image, layer) for layer in layers])
+            self.start_job(
+                self.layer_stages(chain, layers), filters.stage_count(chain) * len(layers),
+                partial(self.layer_filters_finished, step), "Applying filters...",
+                rollback=partial(self.layer_filters_stopped, step)
+            )
+        else:
+            self.touch(self.image.rect())
+            self.start_job(
+                filters.stages(chain, image_array(self.image)), filters.stage_count(chain),
+                self.filters_finished, "Applying filters..."
+            )
+
+    def filters_finished(self, pixels):
+        self.commit()
+        self.update_rect(self.image.rect())
+
+    def layer_stages(self, chain, layers):
+        # Run the filters over each layer in turn, giving the resulting images.
+        images = []
+        for layer in layers:
+            original = image_array(layer.image)
+            pixels = yield from filters.stages(chain, original)
+            images.append(filters.result_image(layer.image, original, pixels))
+        return images
+
+    def layer_filters_finished(self, step, images):
+        self.undo_stack.push(step)
+        self.layers.set_images(images)
+        if self.layers.size() != self.shown_size:
+            self.image_changed()
+        else:
+            self.update_view(self.image.rect())
+
+    def layer_filters_stopped(self, step):
+        # Put every layer back from the undo step, which was never pushed.
+        step.apply(None)
+        self.layers.reset_cache()
+
+    # Background operations.
+
+    def start_job(self, stages, count, finished, message, rollback=None):
+        """
+        Run an operation split into stages of tasks (see tiles.py) on the thread pool,
+        or straight away if the image is small.
+        :param stages: generator of stages.
+        :param count: number of stages it yields, for the progress.
+        :param finished: called with the result of the operation, if it completes.
+        :param message: status to show while it runs.
+        :param rollback: called to undo the changes if the operation is cancelled or fails,
+            by default putting back what was touched on the active layer.
+        """
+        if self.threadpool is None or self.image.width() * self.image.height() <= BACKGROUND_PIXELS:
+            finished(tiles.run(stages))
+            return
+
+        job = TileJob(self.threadpool, stages, count)
+        # The tasks write to the layer images' buffers, so they must outlive them.
+        job.layers = self.layers
+        job.rollback = rollback or partial(self.undo_stack.rollback, self.image)
+        job.finished.connect(partial(self.job_finished, job, finished))
+        job.cancelled.connect(partial(self.job_stopped, job))
+        job.error.connect(partial(self.job_stopped, job))
+        self.job = job
+        self.job_started.emit(job, message)
+        job.start()
+
+    def cancel_job(self):
+        if self.job:
+            self.job.cancel()
+
+    def job_finished(self, job, finished, result):
+        if job is self.job:
+            self.job = None
+            finished(result)
+
+    def job_stopped(self, job, error=None):
+        # Cancelled or failed part way through, put back whatever had been changed.
+        if job is self.job:
+            self.job = None
+            job.rollback()
+            self.layers.invalidate()
+            self.update_view(self.image.rect())
+
+    # Layers.
+
+    def change_layers(self, method, *args):
+        """
+        Change the layer stack, e.g. change_layers('set_opacity', 1, 0.5). See LayerStack
+        for the methods. Adding, removing and reordering layers are undo steps, the other
+        changes aren't.
+        :param method: name of the LayerStack method.
+        """
+        if self.job:
+            return
+        self.reset_mode()
+        self.commit()
+        layers, active = list(self.layers.layers), self.layers.active
+        getattr(self.layers, method)(*args)
+        if self.layers.layers != layers:
+            self.undo_stack.push(Restack(self.layers, layers, active))
+        self.update_view(self.image.rect())
+        self.layers_changed.emit()
+
+    # Viewport.
+
+    def sizeHint(self):
+        # Show the whole canvas where that is reasonable, large images start zoomed to fit.
+        return self.image.size().boundedTo(QSize(1200, 800))
+
+    def minimumSizeHint(self):
+        return QSize(100, 100)
+
+    def map_to_image(self, pos):
+        """
+        Map a point in the widget to the image pixel under it.
+        :param pos: QPoint or QPointF in widget coordinates.
+        :return: QPoint in image coordinates, may lie outside the image.
+        """
+        return QPoint(
+            math.floor((pos.x() - self.offset.x()) / self.zoom),
+            math.floor((pos.y() - self.offset.y()) / self.zoom),
+        )
+
+    def map_from_image(self, rect):
+        """
+        Map a rectangle of image pixels to the area it covers in the widget.
+        :param rect: QRect in image coordinates.
+        :return: QRectF in widget coordinates.
+        """
+        return QRectF(
+            rect.x() * self.zoom + self.offset.x(), rect.y() * self.zoom + self.offset.y(),
+            rect.width() * self.zoom, rect.height() * self.zoom
+        )
+
+    def visible_rect(self, rect):
+        """
+        The image pixels touched by a rectangle of the widget.
+        :param rect: QRect in widget coordinates.
+        :return: QRect in image coordinates, clipped to the image.
+        """
+        top_left = self.map_to_image(rect.topLeft())
+        bottom_right = self.map_to_image(rect.bottomRight())
+        return QRect(top_left, bottom_right) & self.image.rect()
+
+    def clamp_offset(self):
+        # Center the image when it is smaller than the view, otherwise don't let it scroll away.
+        def clamp(offset, view, size):
+            size *= self.zoom
+            if size <= view:
+                return (view - size) / 2
+            return min(0, max(view - size, offset))
+
+        self.offset = QPointF(
+            clamp(self.offset.x(), self.width(), self.image.width()),
+            clamp(self.offset.y(), self.height(), self.image.height()),
+        )
+
+    def set_zoom(self, zoom, anchor=None):
+        """
+        Zoom the view, keeping the image pixel under anchor in place.
+        :param zoom: new scale, limited to ZOOM_MIN-ZOOM_MAX.
+        :param anchor: QPoint in widget coordinates, defaults to the center of the view.
+        """
+        zoom = min(ZOOM_MAX, max(ZOOM_MIN, zoom))
+        if anchor is None:
+            anchor = self.rect().center()
+
+        # Image point (in fractional pixels) under the anchor stays put.
+        x = (anchor.x() - self.offset.x()) / self.zoom
+        y = (anchor.y() - self.offset.y()) / self.zoom
+        self.zoom = zoom
+        self.offset = QPointF(anchor.x() - x * zoom, anchor.y() - y * zoom)
+        self.clamp_offset()
+        self.update()
+
+    def zoom_in(self):
+        self.set_zoom(self.zoom * ZOOM_STEP)
+
+    def zoom_out(self):
+        self.set_zoom(self.zoom / ZOOM_STEP)
+
+    def zoom_actual(self):
+        self.set_zoom(1.0)
+
+    def zoom_to_fit(self):
+        self.set_zoom(min(1.0, self.width() / self.image.width(), self.height() / self.image.height()))
+
+    def pan(self, dx, dy):
+        self.offset += QPointF(dx, dy)
+        self.clamp_offset()
+        self.update()
+
+    def resizeEvent(self, e):
+        self.clamp_offset()
+
+    def wheelEvent(self, e):
+        delta = e.angleDelta()
+        if e.modifiers() & Qt.ControlModifier:
+            self.set_zoom(self.zoom * ZOOM_STEP ** (delta.y() / 120), e.pos())
+        elif e.modifiers() & Qt.ShiftModifier:
+            self.pan(delta.y(), 0)
+        else:
+            self.pan(delta.x(), delta.y())
+
+    def mip(self, level, rect):
+        """
+        Return the image downscaled by 2**level, making sure it is up to date over rect.
+
+        Each level is built from the one above it, and after that only the parts which
+        have been drawn on since are rebuilt, so zoomed out views of big images stay cheap.
+        :param level: 0 for the blend of the layers itself, 1 for half size, etc.
+        :param rect: QRect in image coordinates which is about to be drawn.
+        :return: QImage
+        """
+        if level == 0:
+            # Layers opened from a project read their tiles as they come into view.
+            loaded = self.layers.ensure(rect)
+            if not loaded.isNull():
+                for level in self.mips:
+                    self.mip_stale[level] += QRegion(loaded)
+            return self.layers.flattened()
+
+        scale = 1 << level
+        w, h = self.image.width(), self.image.height()
+
+        if level not in self.mips:
+            source = self.mip(level - 1, self.image.rect())
+            size = QSize(max(1, -(-w // scale)), max(1, -(-h // scale)))
+            self.mips[level] = source.scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            self.mip_stale[level] = QRegion()
+            return self.mips[level]
+
+        stale = self.mip_stale[level] & QRegion(rect)
+        if not stale.isEmpty():
+            # Rebuild whole blocks of image pixels, so each output pixel sees all of its inputs.
+            r = stale.boundingRect()
+            x0, y0 = r.left() // scale * scale, r.top() // scale * scale
+            x1, y1 = min(w, -(-(r.right() + 1) // scale) * scale), min(h, -(-(r.bottom() + 1) // scale) * scale)
+            block = QRect(x0, y0, x1 - x0, y1 - y0)
+
+            half = scale // 2
+            source = self.mip(level - 1, block)
+            source_rect = QRect(x0 // half, y0 // half, -(-(x1 - x0) // half), -(-(y1 - y0) // half))
+            target_rect = QRect(x0 // scale, y0 // scale, -(-(x1 - x0) // scale), -(-(y1 - y0) // scale))
+
+            p = QPainter(self.mips[level])
+            p.setCompositionMode(QPainter.CompositionMode_Source)
+            p.drawImage(target_rect.topLeft(), source.copy(source_rect).scaled(
+                target_rect.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation))
+            p.end()
+
+            self.mip_stale[level] -= QRegion(block)
+
+        return self.mips[level]
+
+    def paintEvent(self, e):
+        # Only the damaged part of the view is redrawn, from the smallest copy of the
+        # image which still has enough detail for the current zoom.
+        p = QPainter(self)
+        source = self.visible_rect(e.rect())
+        target = self.map_from_image(source)
+        if source.isEmpty() or not target.contains(QRectF(e.rect())):
+            p.fillRect(e.rect(), self.palette().color(QPalette.Dark))
+
+        if not source.isEmpty():
+            level = max(0, int(math.floor(math.log2(1 / self.zoom)))) if self.zoom < 1 else 0
+            scale = 1 << level
+            image = self.mip(level, source)
+
+            if self.zoom * scale != 1:
+                # Zoomed in shows crisp pixels, zoomed out between mip levels is smoothed.
+                p.setRenderHint(QPainter.SmoothPixmapTransform, self.zoom < 1)
+
+            p.drawImage(target, image, QRectF(
+                source.x() / scale, source.y() / scale, source.width() / scale, source.height() / scale
+            ))
+
+        if self.overlay:
+            self.draw_overlay(p)
+
+    # Overlay, for tool previews and selections.
+
+    def draw_overlay(self, p):
+        """
+        Draw the current preview over the view, in image coordinates.
+
+        Inverting previews flip what is under them so they stay visible on any color, and use
+        a cosmetic pen so the outline is a single screen pixel at any zoom. Others are drawn
+        just as they will be on the image.
+        """
+        fn, args, pen, font, invert = self.overlay
+        p.translate(self.offset)
+        p.scale(self.zoom, self.zoom)
+        # Through the centre of the image pixels, where the final shape will be drawn.
+        p.translate(0.5, 0.5)
+
+        if invert:
+            p.setCompositionMode(QPainter.CompositionMode_Difference)
+            pen = QPen(pen)
+            pen.setCosmetic(True)
+            pen.setDashOffset(self.dash_offset)
+        p.setPen(pen)
+        if font:
+            p.setFont(font)
+        if callable(fn):
+            fn(p, *args)
+        else:
+            getattr(p, fn)(*args)
+
+    def overlay_update(self):
+        # Repaint the part of the view under the overlay.
+        if self.overlay_rect is not None:
+            self.update(self.map_from_image(self.overlay_rect).toAlignedRect().adjusted(-2, -2, 2, 2))
+
+    def set_overlay(self, fn, args, rect, pen=PREVIEW_PEN, font=None, invert=True):
+        """
+        Show a preview over the image, without drawing on the image itself. Only the parts
+        of the view under the old and new preview are repainted.
+        :param fn: name of the QPainter method which draws the preview, or a function
+            drawing it, called with the painter and args.
+        :param args: arguments for fn, in image coordinates.
+        :param rect: QRect in image coordinates covered by the preview, may be unnormalized.
+        :param pen: QPen to draw with, dashed pens get marching ants.
+        :param font: QFont for text previews.
+        :param invert: draw inverted with a one pixel outline, rather than with the pen as is.
+        """
+        self.overlay_update()
+        self.overlay = fn, args, pen, font, invert
+        self.overlay_rect = rect.normalized()
+        self.overlay_update()
+
+        if pen.style() == Qt.SolidLine:
+            self.ants_timer.stop()
+        elif not self.ants_timer.isActive():
+            self.ants_timer.start()
+
+    def clear_overlay(self):
+        self.ants_timer.stop()
+        self.overlay_update()
+        self.overlay = None
+        self.overlay_rect = None
+
+    def march_ants(self):
+        self.dash_offset -= 1
+        self.overlay_update()
 
     def set_primary_color(self, hex):
         self.primary_color = QColor(hex)
@@ -108,10 +695,15 @@ class Canvas(QLabel):
 
     def set_config(self, key, value):
         self.config[key] = value
+        if self.mode == 'text' and self.current_pos:
+            self.text_preview()
 
     def set_mode(self, mode):
-        # Clean up active timer animations.
-        self.timer_cleanup()
+        # Finish any stroke, and clear any preview or selection.
+        self.end_stroke()
+        self.drop_selection()
+        self.selection = None
+        self.clear_overlay()
         # Reset mode-specific vars (all)
         self.active_shape_fn = None
         self.active_shape_args = ()
@@ -122,12 +714,9 @@ class Canvas(QLabel):
         self.last_pos = None
 
         self.history_pos = None
-        self.last_history = []
-
-        self.current_text = ""
-        self.last_text = ""
 
-        self.last_config = {}
+        # Characters typed, joined only when the text is laid out.
+        self.current_text = []
 
         self.dash_offset = 0
         self.locked = False
@@ -137,38 +726,60 @@ class Canvas(QLabel):
     def reset_mode(self):
         self.set_mode(self.mode)
 
-    def on_timer(self):
-        if self.timer_event:
-            self.timer_event()
-
-    def timer_cleanup(self):
-        if self.timer_event:
-            # Stop the timer, then trigger cleanup.
-            timer_event = self.timer_event
-            self.timer_event = None
-            timer_event(final=True)
-
     # Mouse events.
 
+    def image_event(self, e):
+        """
+        Copy of a mouse event with its position mapped into image coordinates, which is
+        what all of the tool handlers work in.
+        """
+        return QMouseEvent(e.type(), QPointF(self.map_to_image(e.localPos())), e.button(), e.buttons(), e.modifiers())
+
     def mousePressEvent(self, e):
+        if e.button() == Qt.MiddleButton:
+            # Middle button drags the view around, for all tools.
+            self.pan_pos = e.pos()
+            return
+
+        if self.job:
+            return
+
         fn = getattr(self, "%s_mousePressEvent" % self.mode, None)
         if fn:
-            return fn(e)
+            return fn(self.image_event(e))
 
     def mouseMoveEvent(self, e):
+        if self.pan_pos is not None:
+            delta = e.pos() - self.pan_pos
+            self.pan_pos = e.pos()
+            return self.pan(delta.x(), delta.y())
+
+        if self.job:
+            return
+
         fn = getattr(self, "%s_mouseMoveEvent" % self.mode, None)
         if fn:
-            return fn(e)
+            return fn(self.image_event(e))
 
     def mouseReleaseEvent(self, e):
+        if e.button() == Qt.MiddleButton:
+            self.pan_pos = None
+            return
+
+        if self.job:
+            return
+
         fn = getattr(self, "%s_mouseReleaseEvent" % self.mode, None)
         if fn:
-            return fn(e)
+            return fn(self.image_event(e))
 
     def mouseDoubleClickEvent(self, e):
+        if self.job:
+            return
+
         fn = getattr(self, "%s_mouseDoubleClickEvent" % self.mode, None)
         if fn:
-            return fn(e)
+            return fn(self.image_event(e))
 
     # Generic events (shared by brush-like tools)
 
@@ -182,75 +793,139 @@ class Canvas(QLabel):
 
     def generic_mouseReleaseEvent(self, e):
         self.last_pos = None
+        self.commit()
+
+    # Freehand strokes (shared by pen, brush and eraser).
+
+    def begin_stroke(self, e, pen):
+        """
+        Start a freehand stroke, keeping one painter open on the image until it ends.
+        :param e: mouse press event.
+        :param pen: QPen to draw with, from stroke_pen.
+        """
+        self.end_stroke()
+        self.stroke_points = [QPointF(e.pos())]
+        # Number of segments (point to next point) already drawn.
+        self.stroke_drawn = 0
+        self.stroke_margin = pen_margin(pen.width())
+
+        self.stroke_painter = QPainter(self.image)
+        self.stroke_painter.setPen(pen)
+
+    def extend_stroke(self, e):
+        """
+        Queue a point onto the stroke. Points are drawn in one go, after every mouse move
+        waiting in the event queue has been added, so a burst of events costs one draw.
+        """
+        if self.stroke_painter:
+            self.stroke_points.append(QPointF(e.pos()))
+            if not self.stroke_timer.isActive():
+                self.stroke_timer.start()
+
+    def flush_stroke(self, final=False):
+        """
+        Draw the queued part of the stroke onto the image as a single path.
+
+        The newest segment can still change shape when the next point arrives, so until the
+        stroke ends it is only shown in the overlay, and drawn for real on the next flush.
+        :param final: draw up to the last point.
+        """
+        if not self.stroke_painter:
+            return
+
+        last = len(self.stroke_points) - 1
+        end = last if final else last - 1
+        if end > self.stroke_drawn:
+            path = stroke_path(self.stroke_points, self.stroke_drawn, end)
+            self.stroke_drawn = end
+
+            # The curve always lies within its control points.
+            rect = path.controlPointRect().toAlignedRect()
+            self.touch(rect, self.stroke_margin)
+            self.stroke_painter.drawPath(path)
+            self.update_rect(rect, self.stroke_margin)
+
+        if end < last:
+            tail = stroke_path(self.stroke_points, end, last)
+            rect = tail.controlPointRect().toAlignedRect()
+            margin = self.stroke_margin
+            self.set_overlay(
+                'drawPath', (tail,), rect.adjusted(-margin, -margin, margin, margin),
+                self.stroke_painter.pen(), invert=False
+            )
+
+    def end_stroke(self):
+        if self.stroke_painter:
+            self.stroke_timer.stop()
+            self.flush_stroke(final=True)
+            self.clear_overlay()
+            self.stroke_painter.end()
+            self.stroke_painter = None
+            self.stroke_points = None
+            self.commit()
 
     # Mode-specific events.
 
     # Select polygon events
 
     def selectpoly_mousePressEvent(self, e):
-        if not self.locked or e.button == Qt.RightButton:
+        if self.locked and e.button() == Qt.LeftButton and self.selection and self.selection.contains(e.pos()):
+            self.begin_move(e)
+        elif not self.locked or e.button() == Qt.RightButton:
             self.active_shape_fn = 'drawPolygon'
             self.preview_pen = SELECTION_PEN
             self.generic_poly_mousePressEvent(e)
 
-    def selectpoly_timerEvent(self, final=False):
-        self.generic_poly_timerEvent(final)
-
     def selectpoly_mouseMoveEvent(self, e):
-        if not self.locked:
+        if self.floating is not None:
+            self.move_selection(e)
+        elif not self.locked:
             self.generic_poly_mouseMoveEvent(e)
 
+    def selectpoly_mouseReleaseEvent(self, e):
+        if self.floating is not None:
+            self.set_selection(self.drop_selection())
+
     def selectpoly_mouseDoubleClickEvent(self, e):
+        if self.locked or not self.history_pos:
+            return
         self.current_pos = e.pos()
-        self.locked = True
+        self.set_selection(Selection.from_polygon(QPolygon(self.history_pos + [self.current_pos]), self.image.rect()))
 
     def selectpoly_copy(self):
         """
-        Copy a polygon region from the current image, returning it.
-
-        Create a mask for the selected area, and use it to blank
-        out non-selected regions. Then get the bounding rect of the
-        selection and crop to produce the smallest possible image.
+        Copy the selected polygon from the current image, returning it cropped to the
+        polygon's bounds, transparent outside it.
 
         :return: QPixmap of the copied region.
         """
-        self.timer_cleanup()
-
-        pixmap = self.pixmap().copy()
-        bitmap = QBitmap(*CANVAS_DIMENSIONS)
-        bitmap.clear()  # Starts with random data visible.
-
-        p = QPainter(bitmap)
-        # Construct a mask where the user selected area will be kept, the rest removed from the image is transparent.
-        userpoly = QPolygon(self.history_pos + [self.current_pos])
-        p.setPen(QPen(Qt.color1))
-        p.setBrush(QBrush(Qt.color1))  # Solid color, Qt.color1 == bit on.
-        p.drawPolygon(userpoly)
-        p.end()
-
-        # Set our created mask on the image.
-        pixmap.setMask(bitmap)
-
-        # Calculate the bounding rect and return a copy of that region.
-        return pixmap.copy(userpoly.boundingRect())
+        return QPixmap.fromImage(self.selection.copy(self.image))
 
     # Select rectangle events
 
     def selectrect_mousePressEvent(self, e):
+        if self.locked and e.button() == Qt.LeftButton and self.selection and self.selection.contains(e.pos()):
+            self.begin_move(e)
+            return
+
+        self.selection = None
+        self.locked = False
         self.active_shape_fn = 'drawRect'
         self.preview_pen = SELECTION_PEN
         self.generic_shape_mousePressEvent(e)
 
-    def selectrect_timerEvent(self, final=False):
-        self.generic_shape_timerEvent(final)
-
     def selectrect_mouseMoveEvent(self, e):
-        if not self.locked:
-            self.current_pos = e.pos()
+        if self.floating is not None:
+            self.move_selection(e)
+        elif not self.locked:
+            self.generic_shape_mouseMoveEvent(e)
 
     def selectrect_mouseReleaseEvent(self, e):
-        self.current_pos = e.pos()
-        self.locked = True
+        if self.floating is not None:
+            self.set_selection(self.drop_selection())
+        elif not self.locked and self.origin_pos:
+            self.current_pos = e.pos()
+            self.set_selection(Selection.from_rect(QRect(self.origin_pos, self.current_pos), self.image.rect()))
 
     def selectrect_copy(self):
         """
@@ -258,84 +933,186 @@ class Canvas(QLabel):
 
         :return: QPixmap of the copied region.
         """
-        self.timer_cleanup()
-        return self.pixmap().copy(QRect(self.origin_pos, self.current_pos))
+        return QPixmap.fromImage(self.selection.copy(self.image))
+
+    # Selections (shared by the select tools). The selected pixels can be dragged to move
+    # them, flipped, rotated or deleted, only the selection's bounding rect is touched.
+
+    def set_selection(self, selection):
+        """
+        Lock in a selection, showing its outline until the mode changes.
+        :param selection: Selection, or None if nothing ended up selected.
+        """
+        self.selection = selection
+        self.locked = selection is not None
+        if selection is None:
+            self.clear_overlay()
+        else:
+            self.set_overlay('drawPolygon', (selection.outline,), selection.rect, SELECTION_PEN)
+
+    def background_value(self):
+        # What moved or deleted pixels leave behind: transparency on layers which have it.
+        if self.image.hasAlphaChannel():
+            return 0
+        return pixel_value(self.image, self.background_color)
+
+    def begin_move(self, e):
+        # Lift the selected pixels off the image, to follow the mouse until released.
+        rect = self.selection.rect
+        self.touch(rect)
+        self.floating = self.selection.lift(self.image)
+        self.floating_image = self.selection.copy(self.image)
+        self.selection.clear(self.image, self.background_value())
+        self.update_rect(rect)
+
+        self.origin_pos = e.pos()
+        self.move_selection(e)
+
+    def move_selection(self, e):
+        self.current_pos = e.pos()
+        d = self.current_pos - self.origin_pos
+        moved = self.selection.translated(d.x(), d.y())
+        self.set_overlay(self.draw_floating, (self.floating_image, moved), moved.rect, SELECTION_PEN)
+
+    def draw_floating(self, p, image, selection):
+        # Overlay for a selection being moved, its pixels under its outline.
+        p.save()
+        p.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        p.drawImage(QPointF(selection.rect.topLeft()) - QPointF(0.5, 0.5), image)
+        p.restore()
+        p.drawPolygon(selection.outline)
+
+    def drop_selection(self):
+        """
+        Put down pixels lifted by begin_move where they were dragged to, as one undo step.
+        :return: the moved Selection, or None if nothing was lifted.
+        """
+        if self.floating is None:
+            return None
+
+        d = self.current_pos - self.origin_pos
+        selection = self.selection.translated(d.x(), d.y())
+        self.touch(selection.rect)
+        selection.paste(self.image, self.floating)
+        self.floating = self.floating_image = None
+
+        self.commit()
+        self.update_rect(selection.rect)
+        return selection
+
+    def transform_selection(self, fn):
+        """
+        Flip or rotate the selected pixels about the selection's centre, as one undo step.
+        :param fn: one of the geometry filters (see filters.py).
+        """
+        if self.job or self.selection is None:
+            return
+        selection = self.drop_selection() or self.selection
+
+        transformed, transform = selection.transformed(fn)
+        pixels = transform(selection.lift(self.image))
+        self.touch(selection.rect)
+        self.touch(transformed.rect)
+        selection.clear(self.image, self.background_value())
+        transformed.paste(self.image, pixels)
+        self.commit()
+
+        self.update_rect(selection.rect | transformed.rect)
+        self.set_selection(transformed)
+
+    def delete_selection(self):
+        if self.job or self.selection is None:
+            return
+        selection = self.drop_selection() or self.selection
+
+        self.touch(selection.rect)
+        selection.clear(self.image, self.background_value())
+        self.commit()
+        self.update_rect(selection.rect)
+        self.set_selection(selection)
 
     # Eraser events
 
     def eraser_mousePressEvent(self, e):
-        self.generic_mousePressEvent(e)
+        self.begin_stroke(e, stroke_pen(self.eraser_color.rgba(), 30, Qt.RoundCap))
+        if self.image.hasAlphaChannel():
+            # On a layer with transparency, erase to transparent rather than paint over.
+            self.stroke_painter.setCompositionMode(QPainter.CompositionMode_DestinationOut)
 
     def eraser_mouseMoveEvent(self, e):
-        if self.last_pos:
-            p = QPainter(self.pixmap())
-            p.setPen(QPen(self.eraser_color, 30, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-            p.drawLine(self.last_pos, e.pos())
-
-            self.last_pos = e.pos()
-            self.update()
+        self.extend_stroke(e)
 
     def eraser_mouseReleaseEvent(self, e):
-        self.generic_mouseReleaseEvent(e)
+        self.end_stroke()
 
     # Stamp (pie) events
 
+    def set_stamp(self, image):
+        """
+        Set the image for the stamp tool, stamping any clicks made while it was loading.
+        :param image: QImage, or None if it is not ready yet.
+        """
+        self.current_stamp = image
+        if image is not None:
+            pending, self.pending_stamps = self.pending_stamps, []
+            for pos in pending:
+                self.draw_stamp(pos)
+
+    def draw_stamp(self, pos):
+        self.touch(core.stamp_rect(self.current_stamp, pos))
+        rect = core.stamp(self.image, self.current_stamp, pos)
+        self.commit()
+        self.update_rect(rect)
+
+    def drop_pending_stamps(self):
+        # The stamp they were waiting for isn't coming.
+        self.pending_stamps = []
+
     def stamp_mousePressEvent(self, e):
-        p = QPainter(self.pixmap())
-        stamp = self.current_stamp
-        p.drawPixmap(e.x() - stamp.width() // 2, e.y() - stamp.height() // 2, stamp)
-        self.update()
+        if self.current_stamp is None:
+            self.pending_stamps = self.pending_stamps + [e.pos()]
+        else:
+            self.draw_stamp(e.pos())
 
     # Pen events
 
     def pen_mousePressEvent(self, e):
         self.generic_mousePressEvent(e)
+        self.begin_stroke(e, stroke_pen(self.active_color.rgba(), self.config['size'], Qt.SquareCap))
 
     def pen_mouseMoveEvent(self, e):
-        if self.last_pos:
-            p = QPainter(self.pixmap())
-            p.setPen(QPen(self.active_color, self.config['size'], Qt.SolidLine, Qt.SquareCap, Qt.RoundJoin))
-            p.drawLine(self.last_pos, e.pos())
-
-            self.last_pos = e.pos()
-            self.update()
+        self.extend_stroke(e)
 
     def pen_mouseReleaseEvent(self, e):
-        self.generic_mouseReleaseEvent(e)
+        self.end_stroke()
 
     # Brush events
 
     def brush_mousePressEvent(self, e):
         self.generic_mousePressEvent(e)
+        self.begin_stroke(e, stroke_pen(self.active_color.rgba(), self.config['size'] * BRUSH_MULT, Qt.RoundCap))
 
     def brush_mouseMoveEvent(self, e):
-        if self.last_pos:
-            p = QPainter(self.pixmap())
-            p.setPen(QPen(self.active_color, self.config['size'] * BRUSH_MULT, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-            p.drawLine(self.last_pos, e.pos())
-
-            self.last_pos = e.pos()
-            self.update()
+        self.extend_stroke(e)
 
     def brush_mouseReleaseEvent(self, e):
-        self.generic_mouseReleaseEvent(e)
+        self.end_stroke()
 
     # Spray events
 
     def spray_mousePressEvent(self, e):
+        self.spray_rng = np.random.default_rng(self.config['spray_seed'])
         self.generic_mousePressEvent(e)
 
     def spray_mouseMoveEvent(self, e):
         if self.last_pos:
-            p = QPainter(self.pixmap())
-            p.setPen(QPen(self.active_color, 1))
+            # The whole spray is generated and written to the image buffer in one batch.
+            points, rect = core.spray_dots(self.spray_rng, e.x(), e.y(), self.config['size'])
 
-            for n in range(self.config['size'] * SPRAY_PAINT_N):
-                xo = random.gauss(0, self.config['size'] * SPRAY_PAINT_MULT)
-                yo = random.gauss(0, self.config['size'] * SPRAY_PAINT_MULT)
-                p.drawPoint(e.x() + xo, e.y() + yo)
-
-        self.update()
+            # Only the area the spray reached is saved and repainted.
+            self.touch(rect)
+            paint_points(self.image, points, self.active_color)
+            self.update_rect(rect)
 
     def spray_mouseReleaseEvent(self, e):
         self.generic_mouseReleaseEvent(e)
@@ -343,54 +1120,50 @@ class Canvas(QLabel):
     # Text events
 
     def keyPressEvent(self, e):
+        if self.job:
+            if e.key() == Qt.Key_Escape:
+                self.cancel_job()
+            return
+
         if self.mode == 'text':
             if e.key() == Qt.Key_Backspace:
-                self.current_text = self.current_text[:-1]
-            else:
-                self.current_text = self.current_text + e.text()
+                if self.current_text:
+                    self.current_text.pop()
+            elif e.text():
+                self.current_text.append(e.text())
+
+            if self.current_pos:
+                self.text_preview()
 
     def text_mousePressEvent(self, e):
         if e.button() == Qt.LeftButton and self.current_pos is None:
             self.current_pos = e.pos()
-            self.current_text = ""
-            self.timer_event = self.text_timerEvent
+            self.current_text = []
+            self.text_preview()
 
         elif e.button() == Qt.LeftButton:
 
-            self.timer_cleanup()
+            self.clear_overlay()
             # Draw the text to the image
-            p = QPainter(self.pixmap())
-            p.setRenderHints(QPainter.Antialiasing)
             font = build_font(self.config)
-            p.setFont(font)
-            pen = QPen(self.primary_color, 1, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-            p.setPen(pen)
-            p.drawText(self.current_pos, self.current_text)
-            self.update()
+            text = ''.join(self.current_text)
+            rect = text_layout(text, font_key(self.config), self.zoom)[1].translated(self.current_pos)
+            self.touch(rect, 2)
+            rect = core.text(self.image, self.current_pos, text, self.primary_color, font)
+            self.commit()
+            self.update_rect(rect)
 
             self.reset_mode()
 
         elif e.button() == Qt.RightButton and self.current_pos:
             self.reset_mode()
 
-    def text_timerEvent(self, final=False):
-        p = QPainter(self.pixmap())
-        p.setCompositionMode(QPainter.RasterOp_SourceXorDestination)
-        pen = PREVIEW_PEN
-        p.setPen(pen)
-        if self.last_text:
-            font = build_font(self.last_config)
-            p.setFont(font)
-            p.drawText(self.current_pos, self.last_text)
-
-        if not final:
-            font = build_font(self.config)
-            p.setFont(font)
-            p.drawText(self.current_pos, self.current_text)
-
-        self.last_text = self.current_text
-        self.last_config = self.config.copy()
-        self.update()
+    def text_preview(self):
+        # The layout is cached, so repainting the preview doesn't lay the text out again.
+        static, rect, ascent = text_layout(''.join(self.current_text), font_key(self.config), self.zoom)
+        rect = rect.translated(self.current_pos).adjusted(-2, -2, 2, 2)
+        pos = QPointF(self.current_pos.x(), self.current_pos.y() - ascent)
+        self.set_overlay('drawStaticText', (pos, static), rect)
 
     # Fill events
 
@@ -401,47 +1174,45 @@ class Canvas(QLabel):
         else:
             self.active_color = self.secondary_color
 
-        image = self.pixmap().toImage()
-        w, h = image.width(), image.height()
-        x, y = e.x(), e.y()
-
-        # Get our target color from origin.
-        target_color = image.pixel(x,y)
-
-        have_seen = set()
-        queue = [(x, y)]
-
-        def get_cardinal_points(have_seen, center_pos):
-            points = []
-            cx, cy = center_pos
-            for x, y in [(1, 0), (0, 1), (-1, 0), (0, -1)]:
-                xx, yy = cx + x, cy + y
-                if (xx >= 0 and xx < w and
-                    yy >= 0 and yy < h and
-                    (xx, yy) not in have_seen):
-
-                    points.append((xx, yy))
-                    have_seen.add((xx, yy))
-
-            return points
-
-        # Now perform the search and fill.
-        p = QPainter(self.pixmap())
-        p.setPen(QPen(self.active_color))
-
-        while queue:
-            x, y = queue.pop()
-            if image.pixel(x, y) == target_color:
-                p.drawPoint(QPoint(x, y))
-                queue.extend(get_cardinal_points(have_seen, (x, y)))
-
-        self.update()
+        if not self.image.rect().contains(e.pos()):
+            return
+
+        # Fill directly on the image buffer, then repaint just the changed region.
+        self.layers.ensure_all()
+        contiguous = not self.config['fill_global']
+        self.start_job(
+            self.fill_stages(e.x(), e.y(), contiguous), 3 + contiguous, self.fill_finished,
+            "Filling..." if contiguous else "Replacing color..."
+        )
+
+    def fill_stages(self, x, y, contiguous):
+        # Find the pixels to fill, then save them for undo before painting over them.
+        pixels = image_array(self.image)
+        tolerance = self.config['tolerance'] * 255 // 100
+        mask = yield from fill_stages(pixels, x, y, tolerance, contiguous, self.image.hasAlphaChannel())
+        rect = yield from bounds_stages(mask)
+        if not rect.isNull():
+            self.touch(rect)
+            yield from paint_mask_stages(pixels, mask, pixel_value(self.image, self.active_color))
+        return rect
+
+    def fill_finished(self, rect):
+        if not rect.isNull():
+            self.commit()
+            self.update_rect(rect)
 
     # Dropper events
 
     def dropper_mousePressEvent(self, e):
-        c = self.pixmap().toImage().pixel(e.pos())
-        hex = QColor(c).name()
+        if not self.image.rect().contains(e.pos()):
+            return
+
+        # Read straight from the composite the canvas shows, averaging over a small
+        # square if asked, clipped to the image at its edges.
+        size = self.config['dropper_size']
+        rect = QRect(e.x() - size // 2, e.y() - size // 2, size, size) & self.image.rect()
+        self.layers.ensure(rect)
+        hex = average_color(self.layers.flattened(), rect).name()
 
         if e.button() == Qt.LeftButton:
             self.set_primary_color(hex)
@@ -456,41 +1227,30 @@ class Canvas(QLabel):
     def generic_shape_mousePressEvent(self, e):
         self.origin_pos = e.pos()
         self.current_pos = e.pos()
-        self.timer_event = self.generic_shape_timerEvent
+        self.generic_shape_preview()
 
-    def generic_shape_timerEvent(self, final=False):
-        p = QPainter(self.pixmap())
-        p.setCompositionMode(QPainter.RasterOp_SourceXorDestination)
-        pen = self.preview_pen
-        pen.setDashOffset(self.dash_offset)
-        p.setPen(pen)
-        if self.last_pos:
-            getattr(p, self.active_shape_fn)(QRect(self.origin_pos, self.last_pos), *self.active_shape_args)
-
-        if not final:
-            self.dash_offset -= 1
-            pen.setDashOffset(self.dash_offset)
-            p.setPen(pen)
-            getattr(p, self.active_shape_fn)(QRect(self.origin_pos, self.current_pos), *self.active_shape_args)
-
-        self.update()
-        self.last_pos = self.current_pos
+    def generic_shape_preview(self):
+        rect = QRect(self.origin_pos, self.current_pos)
+        self.set_overlay(self.active_shape_fn, (rect,) + tuple(self.active_shape_args), rect, self.preview_pen)
 
     def generic_shape_mouseMoveEvent(self, e):
-        self.current_pos = e.pos()
+        if self.origin_pos:
+            self.current_pos = e.pos()
+            self.generic_shape_preview()
 
     def generic_shape_mouseReleaseEvent(self, e):
-        if self.last_pos:
+        if self.origin_pos:
             # Clear up indicator.
-            self.timer_cleanup()
+            self.clear_overlay()
 
-            p = QPainter(self.pixmap())
-            p.setPen(QPen(self.primary_color, self.config['size'], Qt.SolidLine, Qt.SquareCap, Qt.MiterJoin))
-
-            if self.config['fill']:
-                p.setBrush(QBrush(self.secondary_color))
-            getattr(p, self.active_shape_fn)(QRect(self.origin_pos, e.pos()), *self.active_shape_args)
-            self.update()
+            rect = QRect(self.origin_pos, e.pos())
+            self.touch(rect, pen_margin(self.config['size']))
+            rect = core.shape(
+                self.image, self.mode, rect, self.primary_color, self.config['size'],
+                self.secondary_color if self.config['fill'] else None
+            )
+            self.commit()
+            self.update_rect(rect)
 
         self.reset_mode()
 
@@ -500,35 +1260,26 @@ class Canvas(QLabel):
         self.origin_pos = e.pos()
         self.current_pos = e.pos()
         self.preview_pen = PREVIEW_PEN
-        self.timer_event = self.line_timerEvent
+        self.line_preview()
 
-    def line_timerEvent(self, final=False):
-        p = QPainter(self.pixmap())
-        p.setCompositionMode(QPainter.RasterOp_SourceXorDestination)
-        pen = self.preview_pen
-        p.setPen(pen)
-        if self.last_pos:
-            p.drawLine(self.origin_pos, self.last_pos)
-
-        if not final:
-            p.drawLine(self.origin_pos, self.current_pos)
-
-        self.update()
-        self.last_pos = self.current_pos
+    def line_preview(self):
+        rect = QRect(self.origin_pos, self.current_pos)
+        self.set_overlay('drawLine', (self.origin_pos, self.current_pos), rect, self.preview_pen)
 
     def line_mouseMoveEvent(self, e):
-        self.current_pos = e.pos()
+        if self.origin_pos:
+            self.current_pos = e.pos()
+            self.line_preview()
 
     def line_mouseReleaseEvent(self, e):
-        if self.last_pos:
+        if self.origin_pos:
             # Clear up indicator.
-            self.timer_cleanup()
-
-            p = QPainter(self.pixmap())
-            p.setPen(QPen(self.primary_color, self.config['size'], Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+            self.clear_overlay()
 
-            p.drawLine(self.origin_pos, e.pos())
-            self.update()
+            self.touch(QRect(self.origin_pos, e.pos()), pen_margin(self.config['size']))
+            rect = core.line(self.image, self.origin_pos, e.pos(), self.primary_color, self.config['size'])
+            self.commit()
+            self.update_rect(rect)
 
         self.reset_mode()
 
@@ -540,46 +1291,33 @@ class Canvas(QLabel):
             else:
                 self.history_pos = [e.pos()]
                 self.current_pos = e.pos()
-                self.timer_event = self.generic_poly_timerEvent
+            self.generic_poly_preview()
 
         elif e.button() == Qt.RightButton and self.history_pos:
             # Clean up, we're not drawing
-            self.timer_cleanup()
             self.reset_mode()
 
-    def generic_poly_timerEvent(self, final=False):
-        p = QPainter(self.pixmap())
-        p.setCompositionMode(QPainter.RasterOp_SourceXorDestination)
-        pen = self.preview_pen
-        pen.setDashOffset(self.dash_offset)
-        p.setPen(pen)
-        if self.last_history:
-            getattr(p, self.active_shape_fn)(*self.last_history)
-
-        if not final:
-            self.dash_offset -= 1
-            pen.setDashOffset(self.dash_offset)
-            p.setPen(pen)
-            getattr(p, self.active_shape_fn)(*self.history_pos + [self.current_pos])
-
-        self.update()
-        self.last_pos = self.current_pos
-        self.last_history = self.history_pos + [self.current_pos]
+    def generic_poly_preview(self):
+        poly = QPolygon(self.history_pos + [self.current_pos])
+        self.set_overlay(self.active_shape_fn, (poly,), poly.boundingRect(), self.preview_pen)
 
     def generic_poly_mouseMoveEvent(self, e):
-        self.current_pos = e.pos()
+        if self.history_pos:
+            self.current_pos = e.pos()
+            self.generic_poly_preview()
 
     def generic_poly_mouseDoubleClickEvent(self, e):
-        self.timer_cleanup()
-        p = QPainter(self.pixmap())
-        p.setPen(QPen(self.primary_color, self.config['size'], Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-
-        # Note the brush is ignored for polylines.
-        if self.secondary_color:
-            p.setBrush(QBrush(self.secondary_color))
-
-        getattr(p, self.active_shape_fn)(*self.history_pos + [e.pos()])
-        self.update()
+        self.clear_overlay()
+        poly = QPolygon(self.history_pos + [e.pos()])
+        self.touch(poly.boundingRect(), pen_margin(self.config['size']))
+
+        # Note the fill is ignored for polylines.
+        rect = core.polygon(
+            self.image, list(poly), self.primary_color, self.config['size'],
+            self.secondary_color or None, closed=self.active_shape_fn == 'drawPolygon'
+        )
+        self.commit()
+        self.update_rect(rect)
         self.reset_mode()
 
     # Polyline events
@@ -589,9 +1327,6 @@ class Canvas(QLabel):
         self.preview_pen = PREVIEW_PEN
         self.generic_poly_mousePressEvent(e)
 
-    def polyline_timerEvent(self, final=False):
-        self.generic_poly_timerEvent(final)
-
     def polyline_mouseMoveEvent(self, e):
         self.generic_poly_mouseMoveEvent(e)
 
@@ -606,9 +1341,6 @@ class Canvas(QLabel):
         self.preview_pen = PREVIEW_PEN
         self.generic_shape_mousePressEvent(e)
 
-    def rect_timerEvent(self, final=False):
-        self.generic_shape_timerEvent(final)
-
     def rect_mouseMoveEvent(self, e):
         self.generic_shape_mouseMoveEvent(e)
 
@@ -622,9 +1354,6 @@ class Canvas(QLabel):
         self.preview_pen = PREVIEW_PEN
         self.generic_poly_mousePressEvent(e)
 
-    def polygon_timerEvent(self, final=False):
-        self.generic_poly_timerEvent(final)
-
     def polygon_mouseMoveEvent(self, e):
         self.generic_poly_mouseMoveEvent(e)
 
@@ -639,9 +1368,6 @@ class Canvas(QLabel):
         self.preview_pen = PREVIEW_PEN
         self.generic_shape_mousePressEvent(e)
 
-    def ellipse_timerEvent(self, final=False):
-        self.generic_shape_timerEvent(final)
-
     def ellipse_mouseMoveEvent(self, e):
         self.generic_shape_mouseMoveEvent(e)
 
@@ -656,9 +1382,6 @@ class Canvas(QLabel):
         self.preview_pen = PREVIEW_PEN
         self.generic_shape_mousePressEvent(e)
 
-    def roundrect_timerEvent(self, final=False):
-        self.generic_shape_timerEvent(final)
-
     def roundrect_mouseMoveEvent(self, e):
         self.generic_shape_mouseMoveEvent(e)
 
@@ -696,28 +1419,69 @@ class MainWindow(QMainWindow):
         self.secondaryButton.pressed.connect(lambda: self.choose_color(self.set_secondary_color))
 
         # Initialize button colours.
+        def patch_mousePressEvent(self_, e):
+            if not self_.hex:
+                return
+
+            if e.button() == Qt.LeftButton:
+                self.set_primary_color(self_.hex)
+
+            elif e.button() == Qt.RightButton:
+                self.set_secondary_color(self_.hex)
+
         for n, hex in enumerate(COLORS, 1):
             btn = getattr(self, 'colorButton_%d' % n)
             btn.setStyleSheet('QPushButton { background-color: %s; }' % hex)
-            btn.hex = hex  # For use in the event below
-
-            def patch_mousePressEvent(self_, e):
-                if e.button() == Qt.LeftButton:
-                    self.set_primary_color(self_.hex)
-
-                elif e.button() == Qt.RightButton:
-                    self.set_secondary_color(self_.hex)
+            btn.hex = hex  # For use in the event above
+            btn.mousePressEvent = types.MethodType(patch_mousePressEvent, btn)
 
+        # Recently picked colors, filled in as the dropper and color dialog are used.
+        self.recent_colors = []
+        self.recentToolbar = QToolBar("Recent colors", self)
+        self.recentToolbar.setObjectName("recentToolbar")
+        self.addToolBar(Qt.TopToolBarArea, self.recentToolbar)
+        self.recentButtons = []
+        for n in range(RECENT_COLORS):
+            btn = QPushButton()
+            btn.setFixedSize(QSize(20, 20))
+            btn.hex = None
             btn.mousePressEvent = types.MethodType(patch_mousePressEvent, btn)
+            self.recentToolbar.addWidget(btn)
+            self.recentButtons.append(btn)
 
         # Setup up action signals
         self.actionCopy.triggered.connect(self.copy_to_clipboard)
-
-        # Initialize animation timer.
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.canvas.on_timer)
-        self.timer.setInterval(100)
-        self.timer.start()
+        self.actionDeleteSelection.triggered.connect(self.canvas.delete_selection)
+        self.actionUndo.triggered.connect(self.canvas.undo)
+        self.actionRedo.triggered.connect(self.canvas.redo)
+
+        # Layers panel. The list shows the top layer first, selecting an item makes it the
+        # active layer and its check box shows and hides it.
+        self.layerList = QListWidget()
+        self.layerList.currentRowChanged.connect(self.select_layer)
+        self.layerList.itemChanged.connect(self.layer_item_changed)
+        self.layerMode = QComboBox()
+        self.layerMode.addItems([name for name, mode in BLEND_MODES])
+        self.layerMode.currentTextChanged.connect(
+            lambda mode: self.canvas.change_layers('set_mode', self.canvas.layers.active, mode))
+        self.layerOpacity = QSlider(Qt.Horizontal)
+        self.layerOpacity.setRange(0, 100)
+        # Only on release, each change blends the whole image again.
+        self.layerOpacity.setTracking(False)
+        self.layerOpacity.valueChanged.connect(
+            lambda v: self.canvas.change_layers('set_opacity', self.canvas.layers.active, v / 100))
+
+        layersPanel = QWidget()
+        layersLayout = QFormLayout(layersPanel)
+        layersLayout.addRow(self.layerList)
+        layersLayout.addRow("Blend", self.layerMode)
+        layersLayout.addRow("Opacity", self.layerOpacity)
+        self.layersDock = QDockWidget("Layers", self)
+        self.layersDock.setObjectName("layersDock")
+        self.layersDock.setWidget(layersPanel)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.layersDock)
+        self.canvas.layers_changed.connect(self.update_layers)
+        self.update_layers()
 
         # Setup to agree with Canvas.
         self.set_primary_color('#000000')
@@ -726,20 +1490,43 @@ class MainWindow(QMainWindow):
         # Signals for canvas-initiated color changes (dropper).
         self.canvas.primary_color_updated.connect(self.set_primary_color)
         self.canvas.secondary_color_updated.connect(self.set_secondary_color)
+        self.canvas.primary_color_updated.connect(self.add_recent_color)
+        self.canvas.secondary_color_updated.connect(self.add_recent_color)
 
-        # Setup the stamp state.
+        # Setup the stamp state, stamps are loaded in the background as they are needed.
+        self.stamps = StampLibrary(STAMP_DIR)
+        self.stamps.ready.connect(self.stamp_ready)
+        self.stamps.failed.connect(self.stamp_failed)
         self.current_stamp_n = -1
         self.next_stamp()
         self.stampnextButton.pressed.connect(self.next_stamp)
 
         # Menu options
-        self.actionNewImage.triggered.connect(self.canvas.initialize)
+        self.actionNewImage.triggered.connect(self.new_image)
         self.actionOpenImage.triggered.connect(self.open_file)
+        self.actionSaveProject.triggered.connect(self.save_project)
         self.actionSaveImage.triggered.connect(self.save_file)
-        self.actionClearImage.triggered.connect(self.canvas.reset)
+        self.actionClearImage.triggered.connect(self.canvas.clear_image)
         self.actionInvertColors.triggered.connect(self.invert)
         self.actionFlipHorizontal.triggered.connect(self.flip_horizontal)
         self.actionFlipVertical.triggered.connect(self.flip_vertical)
+        self.actionRotateRight.triggered.connect(lambda: self.transform(filters.rotate_90))
+        self.actionRotateLeft.triggered.connect(lambda: self.transform(filters.rotate_270))
+        self.actionRotate180.triggered.connect(lambda: self.transform(filters.rotate_180))
+        self.actionGrayscale.triggered.connect(lambda: self.canvas.apply_filters([filters.grayscale]))
+        self.actionAutoLevels.triggered.connect(lambda: self.canvas.apply_filters([filters.auto_levels]))
+        self.actionPosterize.triggered.connect(lambda: self.canvas.apply_filters([filters.posterize]))
+        self.actionBlur.triggered.connect(lambda: self.canvas.apply_filters([filters.blur]))
+        self.actionSharpen.triggered.connect(lambda: self.canvas.apply_filters([filters.sharpen]))
+        self.actionNewLayer.triggered.connect(lambda: self.canvas.change_layers('add'))
+        self.actionDuplicateLayer.triggered.connect(self.duplicate_layer)
+        self.actionDeleteLayer.triggered.connect(lambda: self.canvas.change_layers('remove', self.canvas.layers.active))
+        self.actionLayerUp.triggered.connect(lambda: self.move_layer(1))
+        self.actionLayerDown.triggered.connect(lambda: self.move_layer(-1))
+        self.actionZoomIn.triggered.connect(self.canvas.zoom_in)
+        self.actionZoomOut.triggered.connect(self.canvas.zoom_out)
+        self.actionActualSize.triggered.connect(self.canvas.zoom_actual)
+        self.actionFitToWindow.triggered.connect(self.canvas.zoom_to_fit)
 
         # Setup the drawing toolbar.
         self.fontselect = QFontComboBox()
@@ -775,6 +1562,60 @@ class MainWindow(QMainWindow):
         self.drawingToolbar.addAction(self.actionFillShapes)
         self.actionFillShapes.setChecked(True)
 
+        toleranceicon = QLabel()
+        toleranceicon.setPixmap(QPixmap(os.path.join('images', 'paint-can.png')))
+        self.drawingToolbar.addWidget(toleranceicon)
+        self.toleranceselect = QSlider()
+        self.toleranceselect.setRange(0, 100)
+        self.toleranceselect.setOrientation(Qt.Horizontal)
+        self.toleranceselect.valueChanged.connect(lambda s: self.canvas.set_config('tolerance', s))
+        self.drawingToolbar.addWidget(self.toleranceselect)
+
+        self.actionFillGlobal.triggered.connect(lambda s: self.canvas.set_config('fill_global', s))
+        self.drawingToolbar.addAction(self.actionFillGlobal)
+
+        stampicon = QLabel()
+        stampicon.setPixmap(QPixmap(os.path.join('images', 'cake.png')))
+        self.drawingToolbar.addWidget(stampicon)
+        self.stampscale = QComboBox()
+        self.stampscale.addItems(['%d%%' % s for s in STAMP_SCALES])
+        self.stampscale.setCurrentIndex(STAMP_SCALES.index(100))
+        self.stampscale.currentIndexChanged.connect(lambda n: self.set_stamp_config('stamp_scale', STAMP_SCALES[n]))
+        self.drawingToolbar.addWidget(self.stampscale)
+
+        self.actionStampTint.triggered.connect(lambda s: self.set_stamp_config('stamp_tint', s))
+        self.drawingToolbar.addAction(self.actionStampTint)
+
+        droppericon = QLabel()
+        droppericon.setPixmap(QPixmap(os.path.join('images', 'pipette.png')))
+        self.drawingToolbar.addWidget(droppericon)
+        self.droppersize = QComboBox()
+        self.droppersize.addItems(['Point' if s == 1 else '%d x %d' % (s, s) for s in DROPPER_SIZES])
+        self.droppersize.currentIndexChanged.connect(lambda n: self.canvas.set_config('dropper_size', DROPPER_SIZES[n]))
+        self.drawingToolbar.addWidget(self.droppersize)
+
+        # Files are loaded and saved in the background, with progress shown in the status bar.
+        self.threadpool = QThreadPool()
+        self.load_worker = None
+        self.workers = set()
+        # The project file the drawing was opened from or last saved to, if any.
+        self.project = None
+        self.progress = QProgressBar()
+        self.progress.setRange(0, 100)
+        self.progress.setMaximumWidth(150)
+        self.progress.hide()
+        self.statusBar.addPermanentWidget(self.progress)
+
+        # Slow filters and fills run on the same pool, and can be cancelled.
+        self.canvas.threadpool = self.threadpool
+        self.canvas.job_started.connect(self.job_started)
+        self.cancelButton = QPushButton("Cancel")
+        self.cancelButton.clicked.connect(self.canvas.cancel_job)
+        self.cancelButton.hide()
+        self.statusBar.addPermanentWidget(self.cancelButton)
+
+        # Size the window to show the whole (new) canvas.
+        self.adjustSize()
         self.show()
         
     def setupUi(self, MainWindow):
@@ -1390,6 +2231,10 @@ class MainWindow(QMainWindow):
         self.menuEdit.setObjectName("menuEdit")
         self.menuImage = QMenu(self.menuBar)
         self.menuImage.setObjectName("menuImage")
+        self.menuLayer = QMenu(self.menuBar)
+        self.menuLayer.setObjectName("menuLayer")
+        self.menuView = QMenu(self.menuBar)
+        self.menuView.setObjectName("menuView")
         self.menuHelp = QMenu(self.menuBar)
         self.menuHelp.setObjectName("menuHelp")
         MainWindow.setMenuBar(self.menuBar)
@@ -1408,8 +2253,14 @@ class MainWindow(QMainWindow):
         self.fontToolbar.setIconSize(QSize(16, 16))
         self.fontToolbar.setObjectName("fontToolbar")
         MainWindow.addToolBar(Qt.TopToolBarArea, self.fontToolbar)
+        self.actionUndo = QAction(MainWindow)
+        self.actionUndo.setObjectName("actionUndo")
+        self.actionRedo = QAction(MainWindow)
+        self.actionRedo.setObjectName("actionRedo")
         self.actionCopy = QAction(MainWindow)
         self.actionCopy.setObjectName("actionCopy")
+        self.actionDeleteSelection = QAction(MainWindow)
+        self.actionDeleteSelection.setObjectName("actionDeleteSelection")
         self.actionClearImage = QAction(MainWindow)
         self.actionClearImage.setObjectName("actionClearImage")
         self.actionOpenImage = QAction(MainWindow)
@@ -1417,6 +2268,8 @@ class MainWindow(QMainWindow):
         icon16.addPixmap(QPixmap("images/blue-folder-open-image.png"), QIcon.Normal, QIcon.Off)
         self.actionOpenImage.setIcon(icon16)
         self.actionOpenImage.setObjectName("actionOpenImage")
+        self.actionSaveProject = QAction(MainWindow)
+        self.actionSaveProject.setObjectName("actionSaveProject")
         self.actionSaveImage = QAction(MainWindow)
         icon17 = QIcon()
         icon17.addPixmap(QPixmap("images/disk.png"), QIcon.Normal, QIcon.Off)
@@ -1428,6 +2281,32 @@ class MainWindow(QMainWindow):
         self.actionFlipHorizontal.setObjectName("actionFlipHorizontal")
         self.actionFlipVertical = QAction(MainWindow)
         self.actionFlipVertical.setObjectName("actionFlipVertical")
+        self.actionRotateRight = QAction(MainWindow)
+        self.actionRotateRight.setObjectName("actionRotateRight")
+        self.actionRotateLeft = QAction(MainWindow)
+        self.actionRotateLeft.setObjectName("actionRotateLeft")
+        self.actionRotate180 = QAction(MainWindow)
+        self.actionRotate180.setObjectName("actionRotate180")
+        self.actionGrayscale = QAction(MainWindow)
+        self.actionGrayscale.setObjectName("actionGrayscale")
+        self.actionAutoLevels = QAction(MainWindow)
+        self.actionAutoLevels.setObjectName("actionAutoLevels")
+        self.actionPosterize = QAction(MainWindow)
+        self.actionPosterize.setObjectName("actionPosterize")
+        self.actionBlur = QAction(MainWindow)
+        self.actionBlur.setObjectName("actionBlur")
+        self.actionSharpen = QAction(MainWindow)
+        self.actionSharpen.setObjectName("actionSharpen")
+        self.actionNewLayer = QAction(MainWindow)
+        self.actionNewLayer.setObjectName("actionNewLayer")
+        self.actionDuplicateLayer = QAction(MainWindow)
+        self.actionDuplicateLayer.setObjectName("actionDuplicateLayer")
+        self.actionDeleteLayer = QAction(MainWindow)
+        self.actionDeleteLayer.setObjectName("actionDeleteLayer")
+        self.actionLayerUp = QAction(MainWindow)
+        self.actionLayerUp.setObjectName("actionLayerUp")
+        self.actionLayerDown = QAction(MainWindow)
+        self.actionLayerDown.setObjectName("actionLayerDown")
         self.actionNewImage = QAction(MainWindow)
         icon18 = QIcon()
         icon18.addPixmap(QPixmap("images/document-image.png"), QIcon.Normal, QIcon.Off)
@@ -1457,19 +2336,66 @@ class MainWindow(QMainWindow):
         icon22.addPixmap(QPixmap("images/paint-can-color.png"), QIcon.Normal, QIcon.Off)
         self.actionFillShapes.setIcon(icon22)
         self.actionFillShapes.setObjectName("actionFillShapes")
+        self.actionFillGlobal = QAction(MainWindow)
+        self.actionFillGlobal.setCheckable(True)
+        icon23 = QIcon()
+        icon23.addPixmap(QPixmap("images/magnifier-zoom.png"), QIcon.Normal, QIcon.Off)
+        self.actionFillGlobal.setIcon(icon23)
+        self.actionFillGlobal.setObjectName("actionFillGlobal")
+        self.actionStampTint = QAction(MainWindow)
+        self.actionStampTint.setCheckable(True)
+        icon24 = QIcon()
+        icon24.addPixmap(QPixmap("images/stamp.png"), QIcon.Normal, QIcon.Off)
+        self.actionStampTint.setIcon(icon24)
+        self.actionStampTint.setObjectName("actionStampTint")
+        self.actionZoomIn = QAction(MainWindow)
+        self.actionZoomIn.setObjectName("actionZoomIn")
+        self.actionZoomOut = QAction(MainWindow)
+        self.actionZoomOut.setObjectName("actionZoomOut")
+        self.actionActualSize = QAction(MainWindow)
+        self.actionActualSize.setObjectName("actionActualSize")
+        self.actionFitToWindow = QAction(MainWindow)
+        self.actionFitToWindow.setObjectName("actionFitToWindow")
         self.menuFIle.addAction(self.actionNewImage)
         self.menuFIle.addAction(self.actionOpenImage)
+        self.menuFIle.addAction(self.actionSaveProject)
         self.menuFIle.addAction(self.actionSaveImage)
+        self.menuEdit.addAction(self.actionUndo)
+        self.menuEdit.addAction(self.actionRedo)
+        self.menuEdit.addSeparator()
         self.menuEdit.addAction(self.actionCopy)
+        self.menuEdit.addAction(self.actionDeleteSelection)
         self.menuEdit.addSeparator()
         self.menuEdit.addAction(self.actionClearImage)
         self.menuImage.addAction(self.actionInvertColors)
+        self.menuImage.addAction(self.actionGrayscale)
+        self.menuImage.addAction(self.actionAutoLevels)
+        self.menuImage.addAction(self.actionPosterize)
+        self.menuImage.addSeparator()
+        self.menuImage.addAction(self.actionBlur)
+        self.menuImage.addAction(self.actionSharpen)
         self.menuImage.addSeparator()
         self.menuImage.addAction(self.actionFlipHorizontal)
         self.menuImage.addAction(self.actionFlipVertical)
+        self.menuImage.addAction(self.actionRotateRight)
+        self.menuImage.addAction(self.actionRotateLeft)
+        self.menuImage.addAction(self.actionRotate180)
+        self.menuLayer.addAction(self.actionNewLayer)
+        self.menuLayer.addAction(self.actionDuplicateLayer)
+        self.menuLayer.addAction(self.actionDeleteLayer)
+        self.menuLayer.addSeparator()
+        self.menuLayer.addAction(self.actionLayerUp)
+        self.menuLayer.addAction(self.actionLayerDown)
+        self.menuView.addAction(self.actionZoomIn)
+        self.menuView.addAction(self.actionZoomOut)
+        self.menuView.addSeparator()
+        self.menuView.addAction(self.actionActualSize)
+        self.menuView.addAction(self.actionFitToWindow)
         self.menuBar.addAction(self.menuFIle.menuAction())
         self.menuBar.addAction(self.menuEdit.menuAction())
         self.menuBar.addAction(self.menuImage.menuAction())
+        self.menuBar.addAction(self.menuLayer.menuAction())
+        self.menuBar.addAction(self.menuView.menuAction())
         self.menuBar.addAction(self.menuHelp.menuAction())
         self.fileToolbar.addAction(self.actionNewImage)
         self.fileToolbar.addAction(self.actionOpenImage)
@@ -1484,18 +2410,42 @@ class MainWindow(QMainWindow):
         self.menuFIle.setTitle(_translate("MainWindow", "FIle"))
         self.menuEdit.setTitle(_translate("MainWindow", "Edit"))
         self.menuImage.setTitle(_translate("MainWindow", "Image"))
+        self.menuLayer.setTitle(_translate("MainWindow", "Layer"))
+        self.menuView.setTitle(_translate("MainWindow", "View"))
         self.menuHelp.setTitle(_translate("MainWindow", "Help"))
         self.fileToolbar.setWindowTitle(_translate("MainWindow", "toolBar"))
         self.drawingToolbar.setWindowTitle(_translate("MainWindow", "toolBar"))
         self.fontToolbar.setWindowTitle(_translate("MainWindow", "toolBar"))
+        self.actionUndo.setText(_translate("MainWindow", "Undo"))
+        self.actionUndo.setShortcut(_translate("MainWindow", "Ctrl+Z"))
+        self.actionRedo.setText(_translate("MainWindow", "Redo"))
+        self.actionRedo.setShortcut(_translate("MainWindow", "Ctrl+Shift+Z"))
         self.actionCopy.setText(_translate("MainWindow", "Copy"))
         self.actionCopy.setShortcut(_translate("MainWindow", "Ctrl+C"))
+        self.actionDeleteSelection.setText(_translate("MainWindow", "Delete Selection"))
+        self.actionDeleteSelection.setShortcut(_translate("MainWindow", "Del"))
         self.actionClearImage.setText(_translate("MainWindow", "Clear Image"))
         self.actionOpenImage.setText(_translate("MainWindow", "Open Image..."))
+        self.actionSaveProject.setText(_translate("MainWindow", "Save Project"))
+        self.actionSaveProject.setShortcut(_translate("MainWindow", "Ctrl+S"))
         self.actionSaveImage.setText(_translate("MainWindow", "Save Image As..."))
         self.actionInvertColors.setText(_translate("MainWindow", "Invert Colors"))
         self.actionFlipHorizontal.setText(_translate("MainWindow", "Flip Horizontal"))
         self.actionFlipVertical.setText(_translate("MainWindow", "Flip Vertical"))
+        self.actionRotateRight.setText(_translate("MainWindow", "Rotate Right"))
+        self.actionRotateLeft.setText(_translate("MainWindow", "Rotate Left"))
+        self.actionRotate180.setText(_translate("MainWindow", "Rotate 180\u00b0"))
+        self.actionGrayscale.setText(_translate("MainWindow", "Grayscale"))
+        self.actionNewLayer.setText(_translate("MainWindow", "New Layer"))
+        self.actionNewLayer.setShortcut(_translate("MainWindow", "Ctrl+Shift+N"))
+        self.actionDuplicateLayer.setText(_translate("MainWindow", "Duplicate Layer"))
+        self.actionDeleteLayer.setText(_translate("MainWindow", "Delete Layer"))
+        self.actionLayerUp.setText(_translate("MainWindow", "Move Layer Up"))
+        self.actionLayerDown.setText(_translate("MainWindow", "Move Layer Down"))
+        self.actionAutoLevels.setText(_translate("MainWindow", "Auto Levels"))
+        self.actionPosterize.setText(_translate("MainWindow", "Posterize"))
+        self.actionBlur.setText(_translate("MainWindow", "Blur"))
+        self.actionSharpen.setText(_translate("MainWindow", "Sharpen"))
         self.actionNewImage.setText(_translate("MainWindow", "New Image"))
         self.actionBold.setText(_translate("MainWindow", "Bold"))
         self.actionBold.setShortcut(_translate("MainWindow", "Ctrl+B"))
@@ -1503,32 +2453,119 @@ class MainWindow(QMainWindow):
         self.actionItalic.setShortcut(_translate("MainWindow", "Ctrl+I"))
         self.actionUnderline.setText(_translate("MainWindow", "Underline"))
         self.actionFillShapes.setText(_translate("MainWindow", "Fill Shapes?"))
+        self.actionFillGlobal.setText(_translate("MainWindow", "Fill All Matching Colors?"))
+        self.actionFillGlobal.setToolTip(_translate("MainWindow", "Replace the clicked color everywhere, not just the connected area"))
+        self.actionStampTint.setText(_translate("MainWindow", "Tint Stamps?"))
+        self.actionStampTint.setToolTip(_translate("MainWindow", "Tint stamps with the primary color"))
+        self.actionZoomIn.setText(_translate("MainWindow", "Zoom In"))
+        self.actionZoomIn.setShortcut(_translate("MainWindow", "Ctrl++"))
+        self.actionZoomOut.setText(_translate("MainWindow", "Zoom Out"))
+        self.actionZoomOut.setShortcut(_translate("MainWindow", "Ctrl+-"))
+        self.actionActualSize.setText(_translate("MainWindow", "Actual Size"))
+        self.actionActualSize.setShortcut(_translate("MainWindow", "Ctrl+0"))
+        self.actionFitToWindow.setText(_translate("MainWindow", "Fit to Window"))
 
     def choose_color(self, callback):
         dlg = QColorDialog()
         if dlg.exec():
             callback( dlg.selectedColor().name() )
+            self.add_recent_color(dlg.selectedColor().name())
+
+    def add_recent_color(self, hex):
+        # Newest first, each color once.
+        if hex in self.recent_colors:
+            self.recent_colors.remove(hex)
+        self.recent_colors = [hex] + self.recent_colors[:RECENT_COLORS - 1]
+        for btn, hex in zip(self.recentButtons, self.recent_colors):
+            btn.hex = hex
+            btn.setStyleSheet('QPushButton { background-color: %s; }' % hex)
+            btn.setToolTip(hex)
 
     def set_primary_color(self, hex):
         self.canvas.set_primary_color(hex)
         self.primaryButton.setStyleSheet('QPushButton { background-color: %s; }' % hex)
+        if self.canvas.config['stamp_tint']:
+            self.update_stamp()
 
     def set_secondary_color(self, hex):
         self.canvas.set_secondary_color(hex)
         self.secondaryButton.setStyleSheet('QPushButton { background-color: %s; }' % hex)
 
     def next_stamp(self):
-        self.current_stamp_n += 1
-        if self.current_stamp_n >= len(STAMPS):
-            self.current_stamp_n = 0
+        self.current_stamp_n = (self.current_stamp_n + 1) % len(self.stamps)
+        self.update_stamp()
 
-        pixmap = QPixmap(STAMPS[self.current_stamp_n])
-        self.stampnextButton.setIcon(QIcon(pixmap))
+        # Have the next one ready for the next press.
+        self.stamps.load(self.stamps.key((self.current_stamp_n + 1) % len(self.stamps)))
 
-        self.canvas.current_stamp = pixmap
+    def set_stamp_config(self, key, value):
+        self.canvas.set_config(key, value)
+        self.update_stamp()
+
+    def update_stamp(self):
+        """
+        Pass the current stamp, at the chosen size and tint, to the canvas. If it isn't
+        cached it is loaded in the background, and handed over by stamp_ready.
+        """
+        config = self.canvas.config
+        color = self.canvas.primary_color if config['stamp_tint'] else None
+        self.stamp_key = self.stamps.key(self.current_stamp_n, config['stamp_scale'], color)
+        self.stamp_ready(self.stamp_key)
+
+    def stamp_ready(self, key):
+        if key == self.stamp_key:
+            image = self.stamps.get(key)
+            self.canvas.set_stamp(image)
+            if image is not None:
+                self.stampnextButton.setIcon(QIcon(QPixmap.fromImage(image)))
+
+    def stamp_failed(self, key, message):
+        self.statusBar.showMessage(message, 5000)
+        if key == self.stamp_key:
+            self.canvas.drop_pending_stamps()
+
+    def update_layers(self):
+        # Rebuild the layers panel from the canvas, without feeding the changes back.
+        layers = self.canvas.layers
+        for widget in (self.layerList, self.layerMode, self.layerOpacity):
+            widget.blockSignals(True)
+
+        self.layerList.clear()
+        for layer in reversed(layers.layers):
+            item = QListWidgetItem(layer.name)
+            item.setCheckState(Qt.Checked if layer.visible else Qt.Unchecked)
+            self.layerList.addItem(item)
+        self.layerList.setCurrentRow(len(layers.layers) - 1 - layers.active)
+        self.layerMode.setCurrentText(layers.active_layer.mode)
+        self.layerOpacity.setValue(int(round(layers.active_layer.opacity * 100)))
+
+        for widget in (self.layerList, self.layerMode, self.layerOpacity):
+            widget.blockSignals(False)
+
+    def layer_index(self, row):
+        # The list is top layer first.
+        return len(self.canvas.layers.layers) - 1 - row
+
+    def select_layer(self, row):
+        if row >= 0:
+            self.canvas.change_layers('select', self.layer_index(row))
+
+    def layer_item_changed(self, item):
+        index = self.layer_index(self.layerList.row(item))
+        self.canvas.change_layers('set_visible', index, item.checkState() == Qt.Checked)
+
+    def duplicate_layer(self):
+        self.canvas.layers.ensure_all()
+        layer = self.canvas.layers.active_layer
+        self.canvas.change_layers('add', layer.image.copy(), "%s copy" % layer.name)
+
+    def move_layer(self, step):
+        active = self.canvas.layers.active
+        self.canvas.change_layers('move', active, active + step)
 
     def copy_to_clipboard(self):
         clipboard = QApplication.clipboard()
+        self.canvas.layers.ensure_all()
 
         if self.canvas.mode == 'selectrect' and self.canvas.locked:
             clipboard.setPixmap(self.canvas.selectrect_copy())
@@ -1537,68 +2574,222 @@ class MainWindow(QMainWindow):
             clipboard.setPixmap(self.canvas.selectpoly_copy())
 
         else:
-            clipboard.setPixmap(self.canvas.pixmap())
+            clipboard.setImage(self.canvas.layers.flattened())
+
+    def new_image(self):
+        self.canvas.reset()
+        self.set_project(None)
+
+    def set_project(self, project):
+        """
+        Change the project the drawing belongs to, after the drawing has been replaced.
+        The old project's file is closed, as its layers are gone.
+        :param project: Project, or None for a drawing not saved as one.
+        """
+        if self.project is not None and self.project is not project:
+            self.project.close()
+        self.project = project
 
     def open_file(self):
         """
-        Open image file for editing, scaling the smaller dimension and cropping the remainder.
+        Open image file for editing, at its full size, and zoom the view to fit it.
+        Projects open with all of their layers and undo history.
         :return:
         """
-        path, _ = QFileDialog.getOpenFileName(self, "Open file", "", "PNG image files (*.png); JPEG image files (*jpg); All files (*.*)")
-
-        if path:
-            pixmap = QPixmap()
-            pixmap.load(path)
+        path, _ = QFileDialog.getOpenFileName(self, "Open file", "", "Piecasso projects (*%s);;PNG image files (*.png);;JPEG image files (*jpg);;All files (*.*)" % PROJECT_EXTENSION)
 
-            # We need to crop down to the size of our canvas. Get the size of the loaded image.
-            iw = pixmap.width()
-            ih = pixmap.height()
-
-            # Get the size of the space we're filling.
-            cw, ch = CANVAS_DIMENSIONS
-
-            if iw/cw < ih/ch:  # The height is relatively bigger than the width.
-                pixmap = pixmap.scaledToWidth(cw)
-                hoff = (pixmap.height() - ch) // 2
-                pixmap = pixmap.copy(
-                    QRect(QPoint(0, hoff), QPoint(cw, pixmap.height()-hoff))
-                )
-
-            elif iw/cw > ih/ch:  # The height is relatively bigger than the width.
-                pixmap = pixmap.scaledToHeight(ch)
-                woff = (pixmap.width() - cw) // 2
-                pixmap = pixmap.copy(
-                    QRect(QPoint(woff, 0), QPoint(pixmap.width()-woff, ch))
-                )
-
-            self.canvas.setPixmap(pixmap)
+        if path.endswith(PROJECT_EXTENSION):
+            self.open_project(path)
+        elif path:
+            self.load_file(path)
 
+    def open_project(self, path):
+        """
+        Open a project file. Only its index is read here, the view is left at actual size
+        so just the tiles in sight are read in to start with.
+        :param path: project file to open.
+        """
+        try:
+            project, layers, undo, redo = Project.open(path)
+        except Exception as e:
+            self.statusBar.showMessage("Could not open %s: %s" % (os.path.basename(path), e), 5000)
+            return
+
+        self.load_worker = None
+        self.canvas.set_layers(layers)
+        self.set_project(project)
+        self.canvas.undo_stack.restore(undo, redo)
+        self.canvas.setEnabled(True)
+        self.statusBar.showMessage("Opened %s" % os.path.basename(path), 5000)
+
+    def load_file(self, path):
+        """
+        Load an image in the background, the canvas is disabled until it arrives.
+        :param path: image file to open.
+        """
+        worker = LoadWorker(path)
+        worker.signals.preview.connect(partial(self.load_preview, worker))
+        worker.signals.finished.connect(partial(self.load_finished, worker, path))
+        worker.signals.error.connect(partial(self.load_error, worker, path))
+        worker.signals.progress.connect(self.show_progress)
+
+        # Only the most recently opened file is shown, anything still loading is ignored.
+        # The drawing and its history are kept, to put back if the file can't be read.
+        self.load_worker = worker
+        self.load_previous = self.canvas.layers, self.canvas.undo_stack
+        self.start_worker(worker, "Opening %s..." % os.path.basename(path))
+        self.canvas.setEnabled(False)
+
+    def load_preview(self, worker, image):
+        # A reduced size version of a big image, shown while the rest decodes.
+        if worker is self.load_worker:
+            # Shown with a history of its own, so the drawing's isn't cleared until the image is in.
+            self.canvas.undo_stack = UndoStack(self.load_previous[1].budget)
+            self.canvas.set_image(image)
+            self.canvas.zoom_to_fit()
+
+    def load_finished(self, worker, path, image):
+        self.finish_worker(worker, "Opened %s" % os.path.basename(path))
+        if worker is self.load_worker:
+            self.load_worker = None
+            self.canvas.set_image(image)
+            self.set_project(None)
+            self.canvas.zoom_to_fit()
+            self.canvas.setEnabled(True)
+
+    def load_error(self, worker, path, error):
+        self.finish_worker(worker, "Could not open %s" % os.path.basename(path))
+        if worker is self.load_worker:
+            self.load_worker = None
+            layers, undo_stack = self.load_previous
+            if self.canvas.layers is not layers:
+                # A preview had replaced the drawing, put it back along with its history.
+                self.canvas.set_layers(layers)
+                self.canvas.undo_stack = undo_stack
+                self.canvas.zoom_to_fit()
+            self.canvas.setEnabled(True)
+
+    def start_worker(self, worker, message):
+        self.track_worker(worker, message)
+        self.threadpool.start(worker)
+
+    def track_worker(self, worker, message):
+        # Hold on to the worker until it's done, so its signals stay connected.
+        self.workers.add(worker)
+        self.statusBar.showMessage(message)
+        self.progress.setValue(0)
+        self.progress.show()
+
+    def finish_worker(self, worker, message):
+        self.workers.discard(worker)
+        self.statusBar.showMessage(message, 5000)
+        if not self.workers:
+            self.progress.hide()
+
+    def job_started(self, job, message):
+        self.track_worker(job, message)
+        self.cancelButton.show()
+        job.progress.connect(self.show_progress)
+        job.finished.connect(lambda result: self.job_done(job, ""))
+        job.cancelled.connect(lambda: self.job_done(job, "Cancelled"))
+        job.error.connect(lambda error: self.job_done(job, "Failed: %s" % error[1]))
+
+    def job_done(self, job, message):
+        self.cancelButton.hide()
+        self.finish_worker(job, message)
+
+    def show_progress(self, fraction):
+        self.progress.setValue(int(fraction * 100))
 
     def save_file(self):
         """
         Save active canvas to image file.
         :return:
         """
-        path, _ = QFileDialog.getSaveFileName(self, "Save file", "", "PNG Image file (*.png)")
+        path, _ = QFileDialog.getSaveFileName(self, "Save file", "", "PNG Image file (*.png);;Piecasso project (*%s)" % PROJECT_EXTENSION)
 
-        if path:
-            pixmap = self.canvas.pixmap()
-            pixmap.save(path, "PNG" )
+        if path.endswith(PROJECT_EXTENSION):
+            self.save_project(path)
+        elif path:
+            self.save_to(path)
+
+    def save_to(self, path):
+        """
+        Save the canvas, with the layers flattened, in the background. The worker gets a
+        copy-on-write snapshot of the blended image, so drawing can carry on while it is written.
+        :param path: image file to write.
+        """
+        if self.canvas.job:
+            # The snapshot would share the buffer the job is still writing to.
+            self.statusBar.showMessage("Wait for the current operation to finish before saving", 5000)
+            return
+
+        self.canvas.layers.ensure_all()
+        worker = SaveWorker(self.canvas.layers.flattened(), path)
+        worker.signals.finished.connect(lambda image: self.finish_worker(worker, "Saved %s" % os.path.basename(path)))
+        worker.signals.error.connect(lambda error: self.finish_worker(worker, "Could not save %s" % os.path.basename(path)))
+        worker.signals.progress.connect(self.show_progress)
+        self.start_worker(worker, "Saving %s..." % os.path.basename(path))
+
+    def save_project(self, path=None):
+        """
+        Save the layers and undo history as a project, in the background. Saving again to
+        the same file only adds what changed since the last save.
+        :param path: project file to write, by default the one last opened or saved.
+        """
+        if not path:
+            if self.project is None:
+                path, _ = QFileDialog.getSaveFileName(self, "Save project", "", "Piecasso project (*%s)" % PROJECT_EXTENSION)
+                if not path:
+                    return
+                if not path.endswith(PROJECT_EXTENSION):
+                    path += PROJECT_EXTENSION
+            else:
+                path = self.project.path
+
+        if self.canvas.job or (self.project is not None and self.project.pending is not None):
+            self.statusBar.showMessage("Wait for the current operation to finish before saving", 5000)
+            return
+
+        if self.project is None or os.path.abspath(self.project.path) != os.path.abspath(path):
+            self.project = Project(path)
+        project = self.project
+
+        # Finish any operation in progress, so it is part of the history.
+        self.canvas.commit()
+        worker = project.save(self.canvas.layers, self.canvas.undo_stack)
+        worker.signals.finished.connect(partial(self.project_saved, worker, project))
+        worker.signals.error.connect(partial(self.project_save_error, worker, project))
+        worker.signals.progress.connect(self.show_progress)
+        self.start_worker(worker, "Saving %s..." % os.path.basename(path))
+
+    def project_saved(self, worker, project):
+        project.save_finished()
+        if project is not self.project:
+            # Replaced while it was saving.
+            project.close()
+        self.finish_worker(worker, "Saved %s" % os.path.basename(project.path))
+
+    def project_save_error(self, worker, project, error):
+        project.save_failed()
+        self.finish_worker(worker, "Could not save %s: %s" % (os.path.basename(project.path), error[1]))
 
     def invert(self):
-        img = QImage(self.canvas.pixmap())
-        img.invertPixels()
-        pixmap = QPixmap()
-        pixmap.convertFromImage(img)
-        self.canvas.setPixmap(pixmap)
+        # Works in place on the canvas image, no conversions needed.
+        self.canvas.apply_filters([filters.invert])
+
+    def transform(self, fn):
+        # Flips and rotations apply to the selection if there is one, else to the drawing.
+        if self.canvas.selection is not None:
+            self.canvas.transform_selection(fn)
+        else:
+            self.canvas.apply_filters([fn])
 
     def flip_horizontal(self):
-        pixmap = self.canvas.pixmap()
-        self.canvas.setPixmap(pixmap.transformed(QTransform().scale(-1, 1)))
+        self.transform(filters.flip_horizontal)
 
     def flip_vertical(self):
-        pixmap = self.canvas.pixmap()
-        self.canvas.setPixmap(pixmap.transformed(QTransform().scale(1, -1)))
+        self.transform(filters.flip_vertical)
 
 
 
@@ -0,0 +1,470 @@
+"""
+Piecasso project files: every layer, the undo history and some metadata.
+
+A project is a zip archive. Each layer is cut into tiles of TILE_SIZE pixels,
+stored as separate entries, and an index (JSON) lists the layers, their tiles and
+the undo steps, with any layers which only the undo history still holds (removed
+from the drawing by a step which can be undone). Entry names carry the number of the save which wrote them, so
+saving again only appends the tiles which changed since (found by their CRC) and
+a new index, leaving everything else where it is. Once more than half of the file
+is left over from earlier saves, it is written out afresh.
+
+Opening reads just the index. Tiles are read as they are first shown or drawn on
+(see layers.Layer.ensure), so the visible part of a big project shows right away.
+"""
+from functools import partial
+import json
+import os
+import sys
+import time
+import traceback
+import weakref
+import zipfile
+import zlib
+
+import numpy as np
+
+from PySide2.QtCore import QObject, QRect, QRunnable, QSize, Signal, Slot
+from PySide2.QtGui import QImage
+
+from imaging import image_array
+from layers import Layer, LayerStack
+from undo import Delta, Group, Restack, Swap
+
+PROJECT_EXTENSION = '.piecasso'
+PROJECT_FORMAT = 'piecasso-project'
+PROJECT_VERSION = 2
+
+# Width and height of the tiles layers are stored in.
+TILE_SIZE = 256
+
+# zlib level for tiles, they are saved often so speed matters more than size.
+COMPRESSION_LEVEL = 1
+
+# Indexes are named index-<save number>.json, the highest numbered is the current one.
+INDEX_PREFIX = 'index-'
+
+
+def tile_keys(size, rect=None):
+    """
+    The tiles of an image of the given size under rect.
+    :param size: QSize of the image.
+    :param rect: QRect in image coordinates, or None for the whole image.
+    :return: list of (column, row).
+    """
+    rect = QRect(0, 0, size.width(), size.height()) & (rect if rect is not None else QRect(0, 0, size.width(), size.height()))
+    if rect.isEmpty():
+        return []
+    return [
+        (col, row)
+        for row in range(rect.top() // TILE_SIZE, rect.bottom() // TILE_SIZE + 1)
+        for col in range(rect.left() // TILE_SIZE, rect.right() // TILE_SIZE + 1)
+    ]
+
+
+def tile_rect(key, size):
+    col, row = key
+    return QRect(col * TILE_SIZE, row * TILE_SIZE, TILE_SIZE, TILE_SIZE) & QRect(0, 0, size.width(), size.height())
+
+
+def layer_format(layer):
+    # Pixel format of a layer, without unpacking or reading it in.
+    if layer._image is not None:
+        return layer._image.format()
+    return layer.packed[1] if layer.packed is not None else layer.tiles.format
+
+
+def history_layers(undo_stack, layers):
+    # Layers not in the drawing which steps of the history hold on to, to be put back on undo.
+    held = []
+    for step in list(undo_stack.undo_deltas) + undo_stack.redo_deltas:
+        if isinstance(step, Restack):
+            held += [layer for layer in step.layers if layer not in layers and layer not in held]
+    return held
+
+
+def tile_pixels(pixels, key):
+    col, row = key
+    return pixels[row * TILE_SIZE:(row + 1) * TILE_SIZE, col * TILE_SIZE:(col + 1) * TILE_SIZE]
+
+
+class TileSource:
+    """
+    Where the tiles of a layer opened from a project, which haven't been read in yet,
+    are to be found.
+    """
+
+    def __init__(self, archive, size, format, entries):
+        """
+        :param archive: zipfile.ZipFile open for reading.
+        :param size: QSize of the layer.
+        :param format: QImage.Format of the layer.
+        :param entries: entry name of each tile by (column, row), None for an empty tile.
+        """
+        self.archive = archive
+        self.size = size
+        self.format = format
+        self.entries = entries
+        self.missing = set(entries)
+        # (entry name, CRC) of each tile as saved, by (column, row).
+        self.saved = {}
+
+    def blank(self):
+        # The layer image, before any tiles are read into it.
+        image = QImage(self.size, self.format)
+        image.fill(0)
+        return image
+
+    def load(self, image, rect=None):
+        """
+        Read the missing tiles under rect into the layer image.
+        :param rect: QRect in image coordinates, or None for all of them.
+        :return: QRect bounding the tiles read, null if there were none.
+        """
+        keys = self.missing if rect is None else self.missing.intersection(tile_keys(self.size, rect))
+        loaded = QRect()
+        pixels = image_array(image)
+        for key in list(keys):
+            name = self.entries[key]
+            if name is not None:
+                tile = tile_pixels(pixels, key)
+                tile[:] = np.frombuffer(self.archive.read(name), dtype=np.uint32).reshape(tile.shape)
+            self.missing.discard(key)
+            loaded |= tile_rect(key, self.size)
+        return loaded
+
+
+class Project:
+    """
+    A project file being worked on: what is already saved in it, so the next save can
+    leave that alone.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Open for reading tiles and undo steps, None until the file exists.
+        self.archive = None
+        self.saves = 0
+        self.metadata = {
+            'application': 'Piecasso',
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+
+        # Each layer's tiles as last saved here, (entry name, CRC) by (column, row).
+        self.saved = weakref.WeakKeyDictionary()
+        # Undo data saved here: entry name by id, along with the data to keep the id in use.
+        self.blobs = {}
+
+        # Plan of the save in progress, applied once it's written.
+        self.pending = None
+
+    # Opening.
+
+    @classmethod
+    def open(cls, path):
+        """
+        Read a project's index. Tiles are left to be read as they are needed.
+        :param path: project file.
+        :return: the Project, its LayerStack, and its undo and redo steps.
+        """
+        project = cls(path)
+        project.archive = zipfile.ZipFile(path)
+        try:
+            index = json.loads(project.archive.read(project.index_name()).decode('utf-8'))
+            if index.get('format') != PROJECT_FORMAT or index.get('version', 0) > PROJECT_VERSION:
+                raise IOError("%s is not a project this version of Piecasso can open" % path)
+        except Exception:
+            project.close()
+            raise
+
+        project.saves = index['saves']
+        project.metadata.update(index.get('metadata', {}))
+        size = QSize(index['width'], index['height'])
+
+        layers = []
+        for info in index['layers'] + index.get('removed', []):
+            saved = {tuple(map(int, key.split(','))): tuple(value) for key, value in info['tiles'].items()}
+            source = TileSource(project.archive, size, QImage.Format(info['format']), {
+                key: name for key, (name, crc) in saved.items()
+            })
+            source.saved = saved
+            layer = Layer(None, info['name'], info['opacity'], info['mode'], info['visible'], tiles=source)
+            project.saved[layer] = saved
+            layers.append(layer)
+
+        stack = LayerStack.from_layers(layers[:len(index['layers'])], index['active'])
+        undo = [project.read_step(step, layers, stack) for step in index['undo']]
+        redo = [project.read_step(step, layers, stack) for step in index['redo']]
+        return project, stack, undo, redo
+
+    def index_name(self):
+        names = [name for name in self.archive.namelist() if name.startswith(INDEX_PREFIX)]
+        if not names:
+            raise IOError("%s has no project index" % self.path)
+        return max(names, key=lambda name: int(name[len(INDEX_PREFIX):].split('.')[0]))
+
+    def read_step(self, step, layers, stack):
+        """
+        :param layers: every layer of the index, those removed from the stack last.
+        :param stack: LayerStack of the drawing.
+        """
+        if step['type'] == 'group':
+            return Group([self.read_step(s, layers, stack) for s in step['steps']])
+        if step['type'] == 'layers':
+            return Restack.from_data(stack, [layers[n] for n in step['layers']], step['active'])
+
+        data = self.archive.read(step['data'])
+        self.blobs[id(data)] = (data, step['data'])
+        layer = layers[step['layer']]
+        if step['type'] == 'delta':
+            return Delta.from_data(QRect(*step['rect']), data, layer)
+        return Swap.from_data(QSize(*step['size']), QImage.Format(step['format']), data, layer)
+
+    # Saving.
+
+    def save(self, layers, undo_stack):
+        """
+        Work out what needs writing to bring the file up to date, on the GUI thread as it
+        reads the layers, and return a worker to write it.
+        :param layers: LayerStack to save.
+        :param undo_stack: UndoStack of the drawing.
+        :return: ProjectSaveWorker, call save_finished or save_failed once it is done.
+        """
+        full = self.archive is None or os.path.abspath(self.archive.filename) != os.path.abspath(self.path)
+        plan = self.plan(layers, undo_stack, full)
+        if not full and plan['garbage'] > plan['live']:
+            # Mostly old versions of tiles, start the file afresh.
+            plan = self.plan(layers, undo_stack, True)
+
+        self.pending = plan
+        return ProjectSaveWorker(self.path, plan['writes'], plan['index'], plan['full'])
+
+    def plan(self, layers, undo_stack, full):
+        saves = self.saves + 1
+        writes = []
+        live = set()
+
+        index = {
+            'format': PROJECT_FORMAT,
+            'version': PROJECT_VERSION,
+            'saves': saves,
+            'width': layers.size().width(),
+            'height': layers.size().height(),
+            'active': layers.active,
+            'metadata': dict(self.metadata, modified=time.strftime('%Y-%m-%dT%H:%M:%S')),
+            'layers': [],
+            'removed': [],
+        }
+
+        # Layers removed from the drawing by steps which can still be undone come last.
+        kept = layers.layers + history_layers(undo_stack, layers.layers)
+        saved = {}
+        for n, layer in enumerate(kept):
+            tiles, layer_saved = self.plan_layer(layer, n, saves, full, writes)
+            saved[layer] = layer_saved
+            live.update(name for name, crc in layer_saved.values() if name)
+            index['layers' if n < len(layers.layers) else 'removed'].append({
+                'name': layer.name,
+                'opacity': layer.opacity,
+                'mode': layer.mode,
+                'visible': layer.visible,
+                'format': int(layer_format(layer)),
+                'tiles': tiles,
+            })
+
+        blobs = {}
+        steps = {}
+        for key, stack in (('undo', undo_stack.undo_deltas), ('redo', undo_stack.redo_deltas)):
+            steps[key] = [
+                step for step in (self.plan_step(entry, kept, saves, full, writes, blobs) for entry in stack)
+                if step is not None
+            ]
+        index.update(steps)
+        live.update(name for data, name in blobs.values())
+
+        # Bytes of the file still in use, and left over from earlier saves.
+        live_bytes = garbage = 0
+        if not full:
+            infos = self.archive.infolist()
+            live_bytes = sum(info.compress_size for info in infos if info.filename in live)
+            garbage = sum(info.compress_size for info in infos) - live_bytes
+
+        return {
+            'full': full, 'saves': saves, 'writes': writes, 'index': index,
+            'saved': saved, 'blobs': blobs, 'garbage': garbage, 'live': live_bytes,
+        }
+
+    def plan_layer(self, layer, n, saves, full, writes):
+        """
+        Decide which tiles of a layer to write.
+        :return: the tiles for the index, and their names and CRCs as saved, by (column, row).
+        """
+        previous = {} if full else self.saved.get(layer, {})
+        size = layer.size
+        alpha = QImage(1, 1, layer_format(layer)).hasAlphaChannel()
+        tiles = {}
+        layer_saved = {}
+
+        # Hidden layers are unpacked just while their tiles are read.
+        packed = layer.packed is not None
+        pixels = image_array(layer.image) if layer.tiles is None or layer._image is not None else None
+        for key in tile_keys(size):
+            name = 'tiles/%d/%d/%d,%d' % (saves, n, key[0], key[1])
+            if layer.tiles is not None and key in layer.tiles.missing:
+                # Never read in, so unchanged since it was saved.
+                old = layer.tiles.entries[key]
+                crc = self.saved_crc(layer, key)
+                if key in previous or old is None:
+                    layer_saved[key] = previous.get(key, (old, crc))
+                else:
+                    writes.append((name, partial(layer.tiles.archive.read, old), zipfile.ZIP_DEFLATED))
+                    layer_saved[key] = (name, crc)
+            else:
+                data = np.ascontiguousarray(tile_pixels(pixels, key)).tobytes()
+                crc = zlib.crc32(data)
+                if key in previous and previous[key][1] == crc:
+                    layer_saved[key] = previous[key]
+                elif alpha and not data.strip(b'\0'):
+                    # Fully transparent, no need to store it.
+                    layer_saved[key] = (None, crc)
+                else:
+                    writes.append((name, data, zipfile.ZIP_DEFLATED))
+                    layer_saved[key] = (name, crc)
+
+            tiles['%d,%d' % key] = list(layer_saved[key])
+
+        if packed:
+            layer.pack()
+        return tiles, layer_saved
+
+    def saved_crc(self, layer, key):
+        # CRC of a tile as it was read from (or saved to) some project, which may not be this one.
+        for saved in (self.saved.get(layer), layer.tiles.saved):
+            if saved and key in saved:
+                return saved[key][1]
+        return 0
+
+    def plan_step(self, step, layers, saves, full, writes, blobs):
+        # Undo step for the index, writing its data unless it is already saved.
+        if isinstance(step, Group):
+            steps = [self.plan_step(s, layers, saves, full, writes, blobs) for s in step.entries]
+            return {'type': 'group', 'steps': steps} if None not in steps else None
+        if isinstance(step, Restack):
+            return {'type': 'layers', 'layers': [layers.index(layer) for layer in step.layers], 'active': step.active}
+
+        n = next((n for n, layer in enumerate(layers) if layer is step.target), None)
+        if n is None:
+            # The layer it was on has been deleted.
+            return None
+
+        previous = self.blobs.get(id(step.data))
+        if not full and previous is not None and previous[0] is step.data:
+            name = previous[1]
+        else:
+            name = 'undo/%d/%d' % (saves, len(blobs))
+            # Already zlib-compressed.
+            writes.append((name, step.data, zipfile.ZIP_STORED))
+        blobs[id(step.data)] = (step.data, name)
+
+        if isinstance(step, Delta):
+            r = step.rect
+            return {'type': 'delta', 'layer': n, 'rect': [r.x(), r.y(), r.width(), r.height()], 'data': name}
+        return {
+            'type': 'swap', 'layer': n, 'size': [step.size.width(), step.size.height()],
+            'format': int(step.format), 'data': name,
+        }
+
+    def save_finished(self):
+        """
+        The save in progress was written, so it is now what the file holds.
+        """
+        plan, self.pending = self.pending, None
+        self.saves = plan['saves']
+        self.metadata = plan['index']['metadata']
+        self.blobs = plan['blobs']
+
+        archive = zipfile.ZipFile(self.path)
+        # The files tiles were read from until now, this one's before the save and, after
+        # saving as, the one the drawing was opened from. Nothing reads them any more.
+        previous = {self.archive} - {None}
+        for layer, saved in plan['saved'].items():
+            self.saved[layer] = saved
+            if layer.tiles is not None:
+                # Tiles still to be read come from this file from now on.
+                previous.add(layer.tiles.archive)
+                layer.tiles.saved = saved
+                layer.tiles.entries = {key: saved[key][0] for key in layer.tiles.entries}
+                layer.tiles.archive = archive
+        self.archive = archive
+        for old in previous:
+            old.close()
+
+    def save_failed(self):
+        self.pending = None
+
+    def close(self):
+        """
+        Done with the project, once its layers are no longer being drawn on.
+        """
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+
+class ProjectSignals(QObject):
+    '''
+    Defines the signals available from a running project save worker.
+    '''
+    finished = Signal()
+    error = Signal(tuple)
+    progress = Signal(float)
+
+
+class ProjectSaveWorker(QRunnable):
+    '''
+    Worker thread for writing a project file. An incremental save appends to the file,
+    a full one writes alongside and then replaces it.
+    '''
+
+    def __init__(self, path, writes, index, full):
+        """
+        :param writes: list of (entry name, bytes or a callable giving them, zip compression).
+        :param index: project index, as a dict.
+        :param full: write the whole file, rather than appending to it.
+        """
+        super(ProjectSaveWorker, self).__init__()
+        self.signals = ProjectSignals()
+        self.path = path
+        self.writes = writes
+        self.index = index
+        self.full = full
+
+    @Slot()
+    def run(self):
+        target = self.path + '.part' if self.full else self.path
+        try:
+            with zipfile.ZipFile(target, 'w' if self.full else 'a', zipfile.ZIP_DEFLATED) as archive:
+                for n, (name, data, compression) in enumerate(self.writes):
+                    if callable(data):
+                        data = data()
+                    archive.writestr(name, data, compress_type=compression, compresslevel=COMPRESSION_LEVEL)
+                    self.signals.progress.emit((n + 1) / (len(self.writes) + 1))
+
+                archive.writestr('%s%d.json' % (INDEX_PREFIX, self.index['saves']), json.dumps(self.index))
+
+            if self.full:
+                os.replace(target, self.path)
+
+        except Exception:
+            if self.full:
+                # Leave no half written file beside the project.
+                try:
+                    os.remove(target)
+                except OSError:
+                    pass
+            exctype, value = sys.exc_info()[:2]
+            self.signals.error.emit((exctype, value, traceback.format_exc()))
+            return
+
+        self.signals.progress.emit(1.0)
+        self.signals.finished.emit()
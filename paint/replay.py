@@ -0,0 +1,318 @@
+"""
+Record mouse and keyboard input to the paint canvas, and replay it headless to time
+the tools.
+
+    python replay.py record session.json     # draw, then close the window
+    python replay.py play session.json       # replay it, and report timings
+    python replay.py                         # replay the built-in session of each tool
+
+A recording holds the canvas size, view, mode, colors and settings at the start,
+every input event in widget coordinates, and any change of mode, colors or
+settings along the way, so a replay drives the Canvas exactly as the user did.
+
+Each event is posted to the canvas and timed until it has been handled and the
+damage repainted (latency), with the paint itself timed separately (frame time).
+Peak memory is the most Python memory in use during the replay, from tracemalloc,
+which includes the numpy arrays the tools work on but not Qt's own image buffers.
+
+The built-in sessions also check the tools still draw: each must change the
+image, and identically on a second run. Failures make the exit status nonzero, so
+`python replay.py` doubles as a headless check of the tools.
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+import zlib
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+
+from PySide2.QtCore import QEvent, QObject, QPointF, Qt
+from PySide2.QtGui import QColor, QFont, QKeyEvent, QMouseEvent
+from PySide2.QtWidgets import QApplication
+
+import core
+from imaging import image_array
+from paint import Canvas, MainWindow
+
+RECORDING_VERSION = 1
+
+MOUSE_EVENTS = {
+    QEvent.MouseButtonPress: 'press',
+    QEvent.MouseButtonRelease: 'release',
+    QEvent.MouseButtonDblClick: 'double',
+    QEvent.MouseMove: 'move',
+}
+EVENT_TYPES = {name: kind for kind, name in MOUSE_EVENTS.items()}
+
+PERCENTILES = (50, 95, 99)
+
+
+def canvas_state(canvas):
+    """
+    The mode, colors and settings of a canvas, as JSON.
+    """
+    config = dict(canvas.config, font=canvas.config['font'].family())
+    return {
+        'mode': canvas.mode,
+        'primary': canvas.primary_color.name(QColor.HexArgb),
+        'secondary': canvas.secondary_color.name(QColor.HexArgb) if canvas.secondary_color else None,
+        'config': config,
+    }
+
+
+def set_canvas_colors(canvas, state):
+    canvas.set_primary_color(state['primary'])
+    if state['secondary']:
+        canvas.set_secondary_color(state['secondary'])
+
+
+def set_canvas_state(canvas, state):
+    set_canvas_colors(canvas, state)
+    for key, value in state['config'].items():
+        canvas.config[key] = QFont(value) if key == 'font' else value
+    canvas.set_mode(state['mode'])
+
+
+class Recorder(QObject):
+    '''
+    Event filter noting the input events a canvas receives, and the state they were
+    received in.
+    '''
+
+    def __init__(self, canvas):
+        super(Recorder, self).__init__()
+        self.canvas = canvas
+        self.start = time.perf_counter()
+        self.state = canvas_state(canvas)
+        self.recording = {
+            'version': RECORDING_VERSION,
+            'size': [canvas.width(), canvas.height()],
+            'image': [canvas.image.width(), canvas.image.height()],
+            'zoom': canvas.zoom,
+            'offset': [canvas.offset.x(), canvas.offset.y()],
+            'state': self.state,
+            'events': [],
+        }
+        canvas.installEventFilter(self)
+
+    def eventFilter(self, obj, e):
+        kind = e.type()
+        if kind in MOUSE_EVENTS or kind == QEvent.KeyPress:
+            state = canvas_state(self.canvas)
+            if state != self.state:
+                # Tool, color or setting changed in the toolbars since the last event.
+                self.state = state
+                self.recording['events'].append({'state': state})
+
+            event = {'t': round(time.perf_counter() - self.start, 4)}
+            if kind == QEvent.KeyPress:
+                event.update(type='key', key=int(e.key()), text=e.text(), modifiers=int(e.modifiers()))
+            else:
+                event.update(
+                    type=MOUSE_EVENTS[kind], x=e.localPos().x(), y=e.localPos().y(),
+                    button=int(e.button()), buttons=int(e.buttons()), modifiers=int(e.modifiers()),
+                )
+            self.recording['events'].append(event)
+        return False
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.recording, f)
+
+
+class TimedCanvas(Canvas):
+    '''
+    Canvas noting when each paint finished, and how long it took.
+    '''
+    painted = 0
+
+    def __init__(self, *args, **kwargs):
+        super(TimedCanvas, self).__init__(*args, **kwargs)
+        self.frames = []
+
+    def paintEvent(self, e):
+        start = time.perf_counter()
+        super(TimedCanvas, self).paintEvent(e)
+        self.painted = time.perf_counter()
+        self.frames.append(self.painted - start)
+
+
+def make_event(event):
+    if event['type'] == 'key':
+        return QKeyEvent(QEvent.KeyPress, event['key'], Qt.KeyboardModifiers(event['modifiers']), event['text'])
+    return QMouseEvent(
+        EVENT_TYPES[event['type']], QPointF(event['x'], event['y']), Qt.MouseButton(event['button']),
+        Qt.MouseButtons(event['buttons']), Qt.KeyboardModifiers(event['modifiers'])
+    )
+
+
+def replay(recording):
+    """
+    Replay a recording on a fresh canvas, as fast as it will go.
+    :param recording: dict, as saved by Recorder.
+    :return: dict of per-event latencies and frame times in seconds, the peak Python memory
+        in bytes, and a CRC of the final image.
+    """
+    app = QApplication.instance()
+    canvas = TimedCanvas()
+    set_canvas_colors(canvas, recording['state'])
+    canvas.initialize()
+    canvas.set_image(core.new_image(*recording['image'], color=canvas.background_color))
+    canvas.resize(*recording['size'])
+    canvas.show()
+    canvas.zoom = recording['zoom']
+    canvas.offset = QPointF(*recording['offset'])
+    set_canvas_state(canvas, recording['state'])
+    app.processEvents()
+    canvas.frames = []
+
+    latencies = []
+    tracemalloc.start()
+    for event in recording['events']:
+        if 'state' in event:
+            set_canvas_state(canvas, event['state'])
+            continue
+
+        start = time.perf_counter()
+        app.postEvent(canvas, make_event(event))
+        # Handled once the queue is empty, including the stroke timer, then repainted.
+        app.processEvents()
+        app.processEvents()
+        canvas.repaint()
+        latencies.append(time.perf_counter() - start)
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    canvas.layers.ensure_all()
+    canvas.layers.compose(canvas.layers.rect())
+    result = {
+        'latencies': latencies,
+        'frames': list(canvas.frames),
+        'peak': peak,
+        'crc': zlib.crc32(np.ascontiguousarray(image_array(canvas.layers.flattened())).tobytes()),
+    }
+    canvas.close()
+    canvas.deleteLater()
+    return result
+
+
+# Built-in sessions, for each tool.
+
+def session(mode, events, config=None, size=(600, 400)):
+    canvas_config = dict(Canvas.config, font='Times')
+    canvas_config.update(config or {})
+    return {
+        'version': RECORDING_VERSION,
+        'size': list(size),
+        'image': list(size),
+        'zoom': 1.0,
+        'offset': [0, 0],
+        'state': {'mode': mode, 'primary': '#ff000000', 'secondary': '#ffffffff', 'config': canvas_config},
+        'events': events,
+    }
+
+
+def mouse(kind, x, y, button=Qt.LeftButton):
+    buttons = Qt.NoButton if kind == 'release' else button
+    return {'type': kind, 'x': float(x), 'y': float(y), 'button': int(button if kind != 'move' else Qt.NoButton),
+            'buttons': int(buttons), 'modifiers': 0}
+
+
+def drag(points):
+    # Press at the first point, move through the rest and release at the last.
+    (x0, y0), (x1, y1) = points[0], points[-1]
+    return [mouse('press', x0, y0)] + [mouse('move', x, y, Qt.LeftButton) for x, y in points[1:]] + [mouse('release', x1, y1)]
+
+
+def zigzag(n, w=600, h=400):
+    return [(20 + (i * 3) % (w - 40), h // 2 + ((i * 7) % 120) - 60) for i in range(n)]
+
+
+def clicks(points):
+    return [event for x, y in points for event in (mouse('press', x, y), mouse('release', x, y))]
+
+
+def sessions():
+    """
+    A short session of each tool.
+    :return: dict of recordings by name.
+    """
+    typed = [{'type': 'key', 'key': 0, 'text': c, 'modifiers': 0} for c in "The quick brown fox"]
+    poly = clicks([(100, 100), (300, 80), (350, 250)]) + [mouse('double', 150, 300), mouse('release', 150, 300)]
+    return {
+        'pen': session('pen', drag(zigzag(300)), {'size': 3}),
+        'brush': session('brush', drag(zigzag(300)), {'size': 5}),
+        'spray': session('spray', drag(zigzag(100)), {'size': 3, 'spray_seed': 0}),
+        'fill': session('fill', clicks([(300, 200), (10, 10), (590, 390)]), {'tolerance': 10}),
+        'line': session('line', drag([(50, 50), (200, 150), (400, 300)]), {'size': 4}),
+        'rect': session('rect', drag([(50, 50), (200, 150), (400, 300)]), {'size': 2}),
+        'ellipse': session('ellipse', drag([(50, 50), (200, 150), (400, 300)]), {'size': 2}),
+        'polygon': session('polygon', poly, {'size': 2}),
+        'text': session('text', clicks([(100, 200)])[:1] + typed + clicks([(100, 200)])[:1], {'fontsize': 24}),
+    }
+
+
+def report(name, result, file=sys.stdout):
+    latencies = np.array(result['latencies']) * 1000
+    frames = np.array(result['frames'] or [0]) * 1000
+    print("%-9s %6d %8.2f %s %s %9.0f" % (
+        name, len(latencies), latencies.mean(),
+        ' '.join('%7.2f' % v for v in np.percentile(latencies, PERCENTILES)),
+        ' '.join('%7.2f' % v for v in np.percentile(frames, PERCENTILES)),
+        result['peak'] / 1024,
+    ), file=file)
+
+
+def report_header(file=sys.stdout):
+    print("%-9s %6s %8s %7s %7s %7s %7s %7s %7s %9s" % (
+        'tool', 'events', 'mean ms', 'p50', 'p95', 'p99', 'frame50', 'frame95', 'frame99', 'peak KB'), file=file)
+
+
+def check_tools():
+    """
+    Replay the built-in session of each tool twice, reporting the timings of the second.
+    :return: list of problems, empty if every tool drew the same both times.
+    """
+    blank = replay(session('pen', []))['crc']
+    problems = []
+    report_header()
+    for name, recording in sessions().items():
+        first, second = replay(recording), replay(recording)
+        report(name, second)
+        if first['crc'] == blank:
+            problems.append("%s drew nothing" % name)
+        elif first['crc'] != second['crc']:
+            problems.append("%s drew differently on the second replay" % name)
+    return problems
+
+
+def main(argv):
+    app = QApplication([])
+
+    if len(argv) > 2 and argv[1] == 'record':
+        window = MainWindow()
+        recorder = Recorder(window.canvas)
+        app.exec_()
+        recorder.save(argv[2])
+        return 0
+
+    if len(argv) > 2 and argv[1] == 'play':
+        with open(argv[2]) as f:
+            recording = json.load(f)
+        report_header()
+        report(os.path.basename(argv[2]), replay(recording))
+        return 0
+
+    problems = check_tools()
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
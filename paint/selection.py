@@ -0,0 +1,167 @@
+"""
+Selections for the paint canvas.
+
+A selection keeps a mask covering only its bounding rectangle, drawn once when the
+selection is made and kept for as long as it is. Copying, moving, flipping,
+rotating and deleting the selected pixels all work on numpy slices of that
+rectangle of the image, rather than on a bitmap the size of the whole canvas.
+"""
+import numpy as np
+
+from PySide2.QtCore import QPointF, QRect, QRectF, Qt
+from PySide2.QtGui import QImage, QPainter, QPolygonF, QTransform
+
+from imaging import image_array
+
+
+def corners(rect):
+    # Corners of a rectangle in edge coordinates, clockwise from the top left.
+    return QPolygonF([rect.topLeft(), rect.topRight(), rect.bottomRight(), rect.bottomLeft()])
+
+
+class Selection:
+    """
+    An area of the image: its bounding rectangle, a mask over it, and its outline for
+    the marching ants. The rectangle may reach off the image once the selection has
+    been moved, the parts off it are left out of everything.
+    """
+
+    def __init__(self, rect, mask, outline):
+        """
+        :param rect: QRect in image coordinates.
+        :param mask: (height, width) bool array over rect, True where selected.
+        :param outline: QPolygonF in image coordinates, through pixel centres.
+        """
+        self.rect = rect
+        self.mask = mask
+        self.outline = outline
+
+    @classmethod
+    def from_rect(cls, rect, bounds):
+        """
+        :param rect: QRect in image coordinates, may be unnormalized.
+        :param bounds: QRect of the image.
+        :return: Selection, or None if it is empty.
+        """
+        rect = rect.normalized() & bounds
+        if rect.isEmpty():
+            return None
+        mask = np.ones((rect.height(), rect.width()), dtype=bool)
+        outline = QPolygonF([QPointF(rect.topLeft()), QPointF(rect.topRight()),
+                             QPointF(rect.bottomRight()), QPointF(rect.bottomLeft())])
+        return cls(rect, mask, outline)
+
+    @classmethod
+    def from_polygon(cls, polygon, bounds):
+        """
+        :param polygon: QPolygon in image coordinates.
+        :param bounds: QRect of the image.
+        :return: Selection, or None if it is empty.
+        """
+        rect = polygon.boundingRect() & bounds
+        if rect.isEmpty():
+            return None
+
+        # Only the bounding rectangle is drawn, outline included as the polygon shows it.
+        image = QImage(rect.size(), QImage.Format_ARGB32_Premultiplied)
+        image.fill(0)
+        p = QPainter(image)
+        p.translate(-rect.topLeft())
+        p.setPen(Qt.black)
+        p.setBrush(Qt.black)
+        p.drawPolygon(polygon)
+        p.end()
+
+        mask = image_array(image) != 0
+        return cls(rect, mask, QPolygonF(polygon))
+
+    def contains(self, pos):
+        x, y = pos.x() - self.rect.x(), pos.y() - self.rect.y()
+        return 0 <= y < self.mask.shape[0] and 0 <= x < self.mask.shape[1] and bool(self.mask[y, x])
+
+    def clipped(self, bounds):
+        """
+        The part of the selection on the image.
+        :param bounds: QRect of the image.
+        :return: the QRect on the image, and the slices of the mask it covers.
+        """
+        rect = self.rect & bounds
+        x, y = rect.x() - self.rect.x(), rect.y() - self.rect.y()
+        return rect, (slice(y, y + rect.height()), slice(x, x + rect.width()))
+
+    def view(self, image):
+        # The pixels under the selection, and the mask for them.
+        rect, inside = self.clipped(image.rect())
+        pixels = image_array(image)[rect.top():rect.bottom() + 1, rect.left():rect.right() + 1]
+        return pixels, self.mask[inside]
+
+    def lift(self, image):
+        """
+        Copy the selected pixels out of the image.
+        :return: (height, width) uint32 array over rect, zero outside the mask or the image.
+        """
+        pixels = np.zeros(self.mask.shape, dtype=np.uint32)
+        rect, inside = self.clipped(image.rect())
+        if not rect.isEmpty():
+            view, mask = self.view(image)
+            pixels[inside] = np.where(mask, view, 0)
+        return pixels
+
+    def copy(self, image):
+        """
+        The selected pixels as an image the size of the bounding rectangle, transparent
+        outside the mask.
+        """
+        copy = QImage(self.rect.size(), QImage.Format_ARGB32_Premultiplied)
+        copy.fill(0)
+        p = QPainter(copy)
+        p.setCompositionMode(QPainter.CompositionMode_Source)
+        p.drawImage(0, 0, image, self.rect.x(), self.rect.y(), self.rect.width(), self.rect.height())
+        p.end()
+
+        pixels = image_array(copy)
+        pixels[~self.mask] = 0
+        return copy
+
+    def clear(self, image, value):
+        """
+        Set the selected pixels to a value, e.g. the background color.
+        :param value: pixel value in the image's format (see imaging.pixel_value).
+        """
+        if not (self.rect & image.rect()).isEmpty():
+            view, mask = self.view(image)
+            view[mask] = value
+
+    def paste(self, image, pixels):
+        """
+        Write pixels over the selection, where it is selected.
+        :param pixels: (height, width) array the size of the bounding rectangle.
+        """
+        rect, inside = self.clipped(image.rect())
+        if not rect.isEmpty():
+            view, mask = self.view(image)
+            np.copyto(view, pixels[inside], where=mask)
+
+    def translated(self, dx, dy):
+        return Selection(self.rect.translated(dx, dy), self.mask, self.outline.translated(dx, dy))
+
+    def transformed(self, fn):
+        """
+        The selection flipped or rotated about its centre.
+        :param fn: one of the geometry filters (see filters.py), which works on any 2D array.
+        :return: the new Selection, and a function doing the same to lifted pixels.
+        """
+        mask = fn(self.mask.copy())
+        h, w = mask.shape
+        rect = QRect(self.rect.x() + (self.rect.width() - w) // 2, self.rect.y() + (self.rect.height() - h) // 2, w, h)
+
+        # Follow the corners to the outline's transform, they all move the same way.
+        labels = fn(np.arange(4).reshape(2, 2))
+        before, after = corners(QRectF(self.rect)), corners(QRectF(rect))
+        moved = QPolygonF([after[[0, 1, 3, 2].index(list(labels.ravel()).index(n))] for n in (0, 1, 3, 2)])
+        transform = QTransform()
+        QTransform.quadToQuad(before, moved, transform)
+
+        # Outline points are pixel centres.
+        outline = QPolygonF([transform.map(point + QPointF(0.5, 0.5)) - QPointF(0.5, 0.5) for point in self.outline])
+        return Selection(rect, mask, outline), lambda pixels: fn(pixels.copy())
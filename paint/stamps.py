@@ -0,0 +1,166 @@
+"""
+Stamp images for the paint stamp tool.
+
+Stamps are decoded, scaled and tinted on a thread pool and kept in a small LRU
+cache, so cycling through stamps or changing their size never waits on the disk
+or on resampling in the GUI thread. Results are QImages rather than QPixmaps, as
+only QImage can be made outside the GUI thread, and stamps are drawn onto the
+canvas QImage anyway.
+"""
+from collections import OrderedDict
+import os
+import sys
+import traceback
+
+from PySide2.QtCore import QObject, QRunnable, Qt, QThreadPool, Signal, Slot
+from PySide2.QtGui import QColor, QImage, QImageReader
+
+from imaging import tint
+
+# Number of decoded images (originals and variants) kept in memory.
+STAMP_CACHE_SIZE = 32
+
+# Stamp sizes on offer, as a percentage of the original image.
+STAMP_SCALES = [25, 50, 75, 100, 150, 200]
+
+
+def stamp_variant(image, scale=100, color=None):
+    """
+    Scale and tint a stamp image.
+    :param image: QImage of the original stamp.
+    :param scale: size as a percentage of the original.
+    :param color: QColor to tint with, or None.
+    :return: QImage
+    """
+    if scale != 100:
+        image = image.scaled(
+            max(1, image.width() * scale // 100), max(1, image.height() * scale // 100),
+            Qt.IgnoreAspectRatio, Qt.SmoothTransformation
+        )
+
+    if color is not None:
+        image = tint(image, color)
+
+    return image
+
+
+class StampSignals(QObject):
+    '''
+    Defines the signals available from a running stamp worker.
+    '''
+    result = Signal(object, QImage)
+    error = Signal(object, tuple)
+
+
+class StampWorker(QRunnable):
+    '''
+    Worker thread for loading a stamp, and making a variant of it.
+    '''
+
+    def __init__(self, key, original=None):
+        """
+        :param key: (path, scale, rgba) of the image wanted, see StampLibrary.key.
+        :param original: the already decoded original image, if it is cached.
+        """
+        super(StampWorker, self).__init__()
+        self.signals = StampSignals()
+        self.key = key
+        self.original = original
+
+    @Slot()
+    def run(self):
+        path, scale, rgba = self.key
+        try:
+            image = self.original
+            if image is None:
+                reader = QImageReader(path)
+                image = reader.read()
+                if image.isNull():
+                    raise IOError("Could not read stamp %s: %s" % (path, reader.errorString()))
+
+                image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+                self.signals.result.emit((path, 100, None), image)
+
+            if (scale, rgba) != (100, None):
+                color = QColor.fromRgba(rgba) if rgba is not None else None
+                self.signals.result.emit(self.key, stamp_variant(image, scale, color))
+
+        except Exception:
+            exctype, value = sys.exc_info()[:2]
+            self.signals.error.emit(self.key, (exctype, value, traceback.format_exc()))
+
+
+class StampLibrary(QObject):
+    """
+    The stamps in a folder, loaded on demand.
+
+    get() never blocks: it returns the image if it is cached, and otherwise starts
+    loading it and returns None. The ready signal fires with the key once it arrives,
+    or failed with the key and an error message if it can't be read.
+    """
+    ready = Signal(object)
+    failed = Signal(object, str)
+
+    def __init__(self, directory, cache_size=STAMP_CACHE_SIZE):
+        super(StampLibrary, self).__init__()
+        self.paths = sorted(
+            os.path.join(directory, f) for f in os.listdir(directory)
+            if QImageReader.imageFormat(os.path.join(directory, f))
+        )
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        # Workers still running, by the key they are loading.
+        self.loading = {}
+        self.threadpool = QThreadPool()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def key(self, n, scale=100, color=None):
+        """
+        Cache key for a stamp.
+        :param n: index of the stamp.
+        :param scale: size as a percentage of the original.
+        :param color: QColor to tint with, or None.
+        :return: tuple
+        """
+        return self.paths[n], scale, color.rgba() if color is not None else None
+
+    def get(self, key):
+        """
+        The image for a key, if it is ready.
+        :param key: from key().
+        :return: QImage, or None while it is loading.
+        """
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        self.load(key)
+
+    def load(self, key):
+        """
+        Start loading the image for a key, unless it is cached or already on its way.
+        """
+        if key in self.cache or key in self.loading:
+            return
+
+        worker = StampWorker(key, self.cache.get((key[0], 100, None)))
+        worker.signals.result.connect(self.loaded)
+        worker.signals.error.connect(self.load_failed)
+        self.loading[key] = worker
+        self.threadpool.start(worker)
+
+    def loaded(self, key, image):
+        self.loading.pop(key, None)
+        self.cache[key] = image
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        self.ready.emit(key)
+
+    def load_failed(self, key, error):
+        self.loading.pop(key, None)
+        exctype, value, tb = error
+        self.failed.emit(key, str(value))
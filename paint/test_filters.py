@@ -0,0 +1,68 @@
+"""
+Tests of the image filters on the images the app works with.
+"""
+from PySide2.QtGui import QColor, QImage
+
+import core
+import filters
+from imagefile import LoadWorker
+from paint import Canvas
+
+# A half transparent color, and its inverse.
+COLOR = QColor(200, 100, 50, 128)
+INVERTED = QColor(55, 155, 205, 128)
+
+
+def rgba_file(tmp_path):
+    # A PNG with alpha, which Qt reads as unpremultiplied ARGB.
+    image = QImage(20, 10, QImage.Format_ARGB32)
+    image.fill(COLOR)
+    path = str(tmp_path / 'rgba.png')
+    assert image.save(path)
+    assert QImage(path).format() == QImage.Format_ARGB32
+    return path
+
+
+def assert_color(image, color, tolerance=2):
+    # Premultiplied pixels lose a little precision at partial alpha.
+    found = image.pixelColor(5, 5)
+    assert found.alpha() == color.alpha()
+    for channel in ('red', 'green', 'blue'):
+        assert abs(getattr(found, channel)() - getattr(color, channel)()) <= tolerance, found.getRgb()
+
+
+def test_invert_rgba_file(tmp_path):
+    image = core.load_image(rgba_file(tmp_path))
+    assert image.format() == QImage.Format_ARGB32_Premultiplied
+    assert_color(core.apply_filters(image, ['invert']), INVERTED)
+
+
+def test_invert_rgba_file_loaded_in_background(tmp_path):
+    worker = LoadWorker(rgba_file(tmp_path))
+    loaded = []
+    worker.signals.finished.connect(loaded.append)
+    worker.run()
+    image, = loaded
+    assert image.format() == QImage.Format_ARGB32_Premultiplied
+    assert_color(filters.apply(image, [filters.invert]), INVERTED)
+
+
+def test_invert_rgba_image_on_canvas(app, tmp_path):
+    canvas = Canvas()
+    canvas.initialize()
+    canvas.set_image(QImage(rgba_file(tmp_path)))
+    canvas.apply_filters([filters.invert])
+    assert_color(canvas.image, INVERTED)
+    canvas.undo()
+    assert_color(canvas.image, COLOR)
+
+
+def test_invert_opaque_matches_qt():
+    image = QImage(300, 200, QImage.Format_RGB32)
+    image.fill(QColor(30, 60, 90))
+    for y in range(image.height()):
+        for x in range(0, image.width(), 7):
+            image.setPixel(x, y, 0xff000000 | (x * 40503 + y * 2654435) & 0xffffff)
+    expected = image.copy()
+    expected.invertPixels()
+    assert filters.apply(image, [filters.invert]) == expected
@@ -0,0 +1,40 @@
+"""
+Tests of saving images in the background.
+"""
+import os
+
+from PySide2.QtGui import QColor, QImage
+
+from imagefile import SaveWorker
+
+
+def saved(image, path):
+    # Run a save worker where it is, giving what it signalled.
+    worker = SaveWorker(image, path)
+    finished, errors = [], []
+    worker.signals.finished.connect(finished.append)
+    worker.signals.error.connect(errors.append)
+    worker.run()
+    return finished, errors
+
+
+def test_save(tmp_path):
+    image = QImage(30, 20, QImage.Format_RGB32)
+    image.fill(QColor('#336699'))
+    path = str(tmp_path / 'image.png')
+    finished, errors = saved(image, path)
+    assert finished and not errors
+    assert QImage(path).convertToFormat(QImage.Format_RGB32) == image
+    assert os.listdir(str(tmp_path)) == ['image.png']
+
+
+def test_failed_save_leaves_no_partial_file(tmp_path):
+    image = QImage(30, 20, QImage.Format_RGB32)
+    image.fill(QColor('#336699'))
+    # A folder can't be replaced by the written file.
+    path = tmp_path / 'image.png'
+    path.mkdir()
+    finished, errors = saved(image, str(path))
+    assert errors and not finished
+    assert os.listdir(str(tmp_path)) == ['image.png']
+    assert path.is_dir()
@@ -0,0 +1,124 @@
+"""
+Tests of undoing changes to the layers, and of keeping them in projects.
+"""
+from PySide2.QtCore import QRect
+from PySide2.QtGui import QColor, QImage, QPainter
+
+import filters
+from paint import Canvas
+from project import Project
+
+
+def new_canvas():
+    canvas = Canvas()
+    canvas.initialize()
+    image = QImage(60, 40, QImage.Format_RGB32)
+    image.fill(QColor('#ffffff'))
+    canvas.set_image(image)
+    return canvas
+
+
+def draw(canvas, rect, color):
+    # An undoable change to the active layer, as the tools make.
+    canvas.touch(rect)
+    p = QPainter(canvas.image)
+    p.fillRect(rect, QColor(color))
+    p.end()
+    canvas.commit()
+
+
+def state(canvas):
+    canvas.layers.ensure_all()
+    return [layer.image.copy() for layer in canvas.layers.layers], canvas.layers.active
+
+
+def test_undo_layer_added_after_rotating(app):
+    canvas = new_canvas()
+    before = state(canvas)
+    canvas.apply_filters([filters.rotate_90])
+    canvas.change_layers('add')
+    after = state(canvas)
+    assert {layer.size for layer in canvas.layers.layers} == {QImage(40, 60, QImage.Format_RGB32).size()}
+
+    canvas.undo()
+    assert len(canvas.layers.layers) == 1
+    canvas.undo()
+    assert state(canvas) == before
+    assert not canvas.undo_stack.undo_deltas
+
+    canvas.redo()
+    canvas.redo()
+    assert state(canvas) == after
+
+
+def test_undo_remove_layer(app):
+    canvas = new_canvas()
+    canvas.change_layers('add')
+    draw(canvas, QRect(5, 5, 10, 10), '#ff0000')
+    drawn = state(canvas)
+    canvas.change_layers('remove', 1)
+    assert len(canvas.layers.layers) == 1
+
+    # Each step changes what is shown, the drawing on the removed layer comes back first.
+    canvas.undo()
+    assert state(canvas) == drawn
+    canvas.undo()
+    assert state(canvas) != drawn
+    canvas.undo()
+    assert len(canvas.layers.layers) == 1
+
+    for _ in range(3):
+        canvas.redo()
+    assert len(canvas.layers.layers) == 1
+    canvas.undo()
+    assert state(canvas) == drawn
+
+
+def test_undo_move_layer(app):
+    canvas = new_canvas()
+    canvas.change_layers('add')
+    canvas.change_layers('add')
+    layers = list(canvas.layers.layers)
+    canvas.change_layers('move', 2, 0)
+    assert canvas.layers.layers == [layers[2], layers[0], layers[1]]
+    canvas.undo()
+    assert canvas.layers.layers == layers
+    assert canvas.layers.active == 2
+
+
+def test_project_keeps_removed_layer(app, tmp_path):
+    canvas = new_canvas()
+    canvas.change_layers('add')
+    draw(canvas, QRect(20, 10, 8, 8), '#0000ff')
+    drawn = state(canvas)
+    canvas.change_layers('remove', 1)
+
+    path = str(tmp_path / 'drawing.piecasso')
+    project = Project(path)
+    project.save(canvas.layers, canvas.undo_stack).run()
+    project.save_finished()
+
+    project, layers, undo, redo = Project.open(path)
+    opened = new_canvas()
+    opened.set_layers(layers)
+    opened.undo_stack.restore(undo, redo)
+    assert len(opened.layers.layers) == 1
+    opened.undo()
+    assert state(opened) == drawn
+
+
+def test_clear_image_clears_active_layer(app):
+    canvas = new_canvas()
+    draw(canvas, QRect(5, 5, 10, 10), '#ff0000')
+    canvas.change_layers('add')
+    draw(canvas, QRect(20, 10, 8, 8), '#0000ff')
+    drawn = state(canvas)
+
+    canvas.clear_image()
+    images, _ = state(canvas)
+    assert images[0] == drawn[0][0]
+    assert images[1].pixel(24, 14) == 0
+    assert len(canvas.undo_stack.undo_deltas) == 4
+
+    canvas.undo()
+    assert state(canvas) == drawn
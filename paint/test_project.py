@@ -0,0 +1,83 @@
+"""
+Tests that project files are let go of once nothing reads from them.
+"""
+import zipfile
+
+import pytest
+
+from PySide2.QtCore import QRect
+from PySide2.QtGui import QColor, QImage, QPainter
+
+from paint import Canvas
+from project import Project
+
+
+def new_canvas():
+    canvas = Canvas()
+    canvas.initialize()
+    image = QImage(60, 40, QImage.Format_RGB32)
+    image.fill(QColor('#ffffff'))
+    canvas.set_image(image)
+    return canvas
+
+
+def draw(canvas, rect, color):
+    canvas.touch(rect)
+    p = QPainter(canvas.image)
+    p.fillRect(rect, QColor(color))
+    p.end()
+    canvas.commit()
+
+
+def save(project, canvas):
+    project.save(canvas.layers, canvas.undo_stack).run()
+    project.save_finished()
+
+
+def is_closed(archive):
+    return archive.fp is None
+
+
+def test_save_again_closes_previous_archive(app, tmp_path):
+    canvas = new_canvas()
+    project = Project(str(tmp_path / 'drawing.piecasso'))
+    save(project, canvas)
+    first = project.archive
+
+    draw(canvas, QRect(5, 5, 10, 10), '#ff0000')
+    save(project, canvas)
+    assert project.archive is not first
+    assert is_closed(first)
+    assert not is_closed(project.archive)
+
+
+def test_save_as_closes_opened_archive(app, tmp_path):
+    canvas = new_canvas()
+    draw(canvas, QRect(5, 5, 10, 10), '#ff0000')
+    path = str(tmp_path / 'drawing.piecasso')
+    save(Project(path), canvas)
+
+    opened, layers, undo, redo = Project.open(path)
+    canvas = new_canvas()
+    canvas.set_layers(layers)
+    canvas.undo_stack.restore(undo, redo)
+
+    copy = Project(str(tmp_path / 'copy.piecasso'))
+    save(copy, canvas)
+    assert is_closed(opened.archive)
+    # The layers read what they have left to read from the new file.
+    canvas.layers.ensure_all()
+    assert canvas.layers.layers[0].image.pixelColor(7, 7) == QColor('#ff0000')
+
+
+def test_open_failure_closes_archive(app, tmp_path, monkeypatch):
+    path = str(tmp_path / 'other.piecasso')
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('readme.txt', 'not a project')
+
+    archives = []
+    opener = zipfile.ZipFile
+    monkeypatch.setattr(zipfile, 'ZipFile', lambda *args: archives.append(opener(*args)) or archives[-1])
+    with pytest.raises(Exception):
+        Project.open(path)
+    assert archives and all(is_closed(archive) for archive in archives)
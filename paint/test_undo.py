@@ -0,0 +1,182 @@
+"""
+Tests that undo and redo give back exactly the pixels before and after each kind of
+step, and that the history keeps to its memory budget.
+"""
+from functools import partial
+import random
+
+import numpy as np
+import pytest
+
+from PySide2.QtCore import QEvent, QPointF, QRect, Qt
+from PySide2.QtGui import QColor, QImage, QMouseEvent, QPainter, QPen, QTransform
+from PySide2.QtWidgets import QApplication
+
+import filters
+from imaging import image_array
+from paint import Canvas
+from undo import Swap, UndoStack
+
+WIDTH, HEIGHT = 600, 400
+
+
+def speckled_image(seed=0):
+    # White with scattered black pixels, and a clear patch in the middle to fill from.
+    rng = np.random.default_rng(seed)
+    image = QImage(WIDTH, HEIGHT, QImage.Format_RGB32)
+    image_array(image)[:] = np.where(rng.random((HEIGHT, WIDTH)) < 0.3, 0xff000000, 0xffffffff)
+    image_array(image)[HEIGHT // 2 - 2:HEIGHT // 2 + 3, WIDTH // 2 - 2:WIDTH // 2 + 3] = 0xffffffff
+    return image
+
+
+def layer_images(canvas):
+    # Copies of every layer of the canvas, to compare before and after a step.
+    canvas.layers.ensure_all()
+    return [layer.image.copy() for layer in canvas.layers.layers]
+
+
+def drag(canvas, mode, points):
+    # The tool's mouse events, as the canvas receives them.
+    app = QApplication.instance()
+    canvas.set_mode(mode)
+    kinds = [QEvent.MouseButtonPress] + [QEvent.MouseMove] * (len(points) - 2) + [QEvent.MouseButtonRelease]
+    for kind, (x, y) in zip(kinds, points):
+        app.sendEvent(canvas, QMouseEvent(kind, QPointF(x, y), Qt.LeftButton, Qt.LeftButton, Qt.NoModifier))
+        # Strokes are drawn once the queued events have been handled.
+        app.processEvents()
+
+
+# Steps of each kind, in order, on a canvas which gains a second layer part way through.
+STEPS = [
+    ('brush', partial(drag, mode='brush', points=[(40, 40), (120, 90), (200, 60), (260, 150)])),
+    ('fill', partial(drag, mode='fill', points=[(WIDTH // 2, HEIGHT // 2)] * 2)),
+    ('rectangle', partial(drag, mode='rect', points=[(300, 100), (360, 160), (420, 250)])),
+    ('stamp', partial(drag, mode='stamp', points=[(500, 300)] * 2)),
+    ('invert', lambda canvas: canvas.apply_filters([filters.invert])),
+    ('new layer', lambda canvas: canvas.change_layers('add')),
+    ('brush on layer 2', partial(drag, mode='brush', points=[(10, 300), (300, 320), (590, 200)])),
+    ('ellipse on layer 2', partial(drag, mode='ellipse', points=[(100, 50), (250, 200)])),
+    ('invert layer 2', lambda canvas: canvas.apply_filters([filters.invert])),
+    ('flip horizontal', lambda canvas: canvas.apply_filters([filters.flip_horizontal])),
+    ('flip vertical', lambda canvas: canvas.apply_filters([filters.flip_vertical])),
+    ('rotate 90', lambda canvas: canvas.apply_filters([filters.rotate_90])),
+    ('move layer down', lambda canvas: canvas.change_layers('move', 1, 0)),
+    ('stamp after rotating', partial(drag, mode='stamp', points=[(150, 150)] * 2)),
+    ('rotate 270', lambda canvas: canvas.apply_filters([filters.rotate_270])),
+    ('remove layer', lambda canvas: canvas.change_layers('remove', 0)),
+]
+
+
+@pytest.fixture
+def canvas(app):
+    canvas = Canvas()
+    canvas.initialize()
+    canvas.resize(WIDTH, HEIGHT)
+    canvas.set_image(speckled_image())
+    canvas.set_config('size', 6)
+    canvas.set_secondary_color('#2080ff')
+
+    stamp = QImage(60, 40, QImage.Format_ARGB32_Premultiplied)
+    stamp.fill(QColor(200, 40, 120, 160))
+    canvas.set_stamp(stamp)
+    return canvas
+
+
+def test_each_step(canvas):
+    for name, step in STEPS:
+        before = layer_images(canvas)
+        count = len(canvas.undo_stack.undo_deltas)
+        step(canvas)
+        after = layer_images(canvas)
+        assert after != before, name
+        assert len(canvas.undo_stack.undo_deltas) == count + 1, name
+
+        canvas.undo()
+        assert layer_images(canvas) == before, "undoing %s" % name
+        canvas.redo()
+        assert layer_images(canvas) == after, "redoing %s" % name
+
+
+def test_every_step_at_once(canvas):
+    original = layer_images(canvas)
+    for name, step in STEPS:
+        step(canvas)
+    final = layer_images(canvas)
+
+    while canvas.undo_stack.undo_deltas:
+        canvas.undo()
+    assert layer_images(canvas) == original
+    while canvas.undo_stack.redo_deltas:
+        canvas.redo()
+    assert layer_images(canvas) == final
+
+
+def scribble(stack, image, rng):
+    # A step of random dots in a 100px square, a few KB once compressed.
+    x, y = rng.randrange(WIDTH - 100), rng.randrange(HEIGHT - 100)
+    stack.touch(image, QRect(x, y, 100, 100))
+    p = QPainter(image)
+    for _ in range(200):
+        p.setPen(QPen(QColor(rng.randrange(1 << 24)), 3))
+        p.drawPoint(x + rng.randrange(100), y + rng.randrange(100))
+    p.end()
+    return stack.commit(image)
+
+
+def test_budget_drops_oldest_steps():
+    rng = random.Random(0)
+    image = QImage(WIDTH, HEIGHT, QImage.Format_RGB32)
+    image.fill(QColor('#ffffff'))
+    # Room for a few of the steps drawn here.
+    stack = UndoStack(budget=16 * 1024)
+
+    states = [image.copy()]
+    pushed = []
+    for _ in range(20):
+        scribble(stack, image, rng)
+        pushed.append(stack.undo_deltas[-1])
+        states.append(image.copy())
+
+    kept = list(stack.undo_deltas)
+    assert 1 < len(kept) < len(pushed)
+    assert kept == pushed[-len(kept):]
+    assert stack.memory == sum(step.nbytes for step in kept) <= stack.budget
+
+    for state in reversed(states[-len(kept) - 1:-1]):
+        image, _ = stack.undo(image)
+        assert image == state
+
+
+def test_step_over_budget_kept_alone():
+    rng = random.Random(0)
+    image = QImage(WIDTH, HEIGHT, QImage.Format_RGB32)
+    image.fill(QColor('#ffffff'))
+    stack = UndoStack(budget=16 * 1024)
+    for _ in range(3):
+        scribble(stack, image, rng)
+    stack.undo(image)
+
+    before = image.copy()
+    stack.touch(image, image.rect())
+    image_array(image)[:] = np.random.default_rng(0).integers(0, 1 << 24, (HEIGHT, WIDTH), dtype=np.uint32) | 0xff000000
+    rect = stack.commit(image)
+    assert [step.rect for step in stack.undo_deltas] == [rect]
+    assert not stack.redo_deltas
+    image, _ = stack.undo(image)
+    assert image == before
+
+
+def test_swap_image_of_another_size():
+    image = speckled_image()
+    stack = UndoStack()
+    before = image.copy()
+    stack.push(Swap(image))
+    image = image.transformed(QTransform().rotate(90))
+    after = image.copy()
+
+    image, rect = stack.undo(image)
+    assert image == before
+    assert rect == before.rect()
+    image, rect = stack.redo(image)
+    assert image == after
+    assert rect == after.rect()
@@ -0,0 +1,161 @@
+"""
+Whole-image operations run in parallel, a strip of the image at a time.
+
+An operation is written as a generator of stages. Each stage it yields is a list of
+tasks, callables which are independent of one another, and the generator is sent
+back the list of their results before it yields the next stage. Its return value is
+the result of the whole operation. Tasks work on their own strip of the numpy view
+of the image (see imaging.image_array), so they write straight into the QImage
+buffer and there are no pieces to stitch back together afterwards.
+
+NumPy releases the GIL for the array passes the tasks spend their time in, so
+running them on a QThreadPool spreads them over the cores, without the cost of
+pickling strips over to worker processes and back.
+"""
+import sys
+import traceback
+
+from PySide2.QtCore import QObject, QRunnable, Signal, Slot
+
+
+def run(stages):
+    """
+    Run an operation on the calling thread, one task after another.
+    :param stages: generator of stages, as described above.
+    :return: the result of the operation.
+    """
+    results = None
+    try:
+        while True:
+            results = [task() for task in stages.send(results)]
+    except StopIteration as e:
+        return e.value
+
+
+class TileSignals(QObject):
+    '''
+    Defines the signals available from a running tile worker.
+    '''
+    finished = Signal(int, object)
+    error = Signal(int, tuple)
+
+
+class TileWorker(QRunnable):
+    '''
+    Worker thread for one task of a stage. Tasks which haven't started by the time
+    their job is cancelled are skipped.
+    '''
+
+    def __init__(self, job, index, task):
+        super(TileWorker, self).__init__()
+        self.signals = TileSignals()
+        self.job = job
+        self.index = index
+        self.task = task
+
+    @Slot()
+    def run(self):
+        if self.job.is_cancelled:
+            self.signals.finished.emit(self.index, None)
+            return
+
+        try:
+            result = self.task()
+        except Exception:
+            exctype, value = sys.exc_info()[:2]
+            self.signals.error.emit(self.index, (exctype, value, traceback.format_exc()))
+            return
+
+        self.signals.finished.emit(self.index, result)
+
+
+class TileJob(QObject):
+    '''
+    An operation running on a thread pool, a stage at a time. The generator is only
+    ever resumed on the thread which owns the job (the GUI thread), so code between
+    stages can safely touch widgets and the undo history.
+    '''
+    progress = Signal(float)
+    finished = Signal(object)
+    cancelled = Signal()
+    error = Signal(tuple)
+
+    def __init__(self, threadpool, stages, count=1):
+        """
+        :param threadpool: QThreadPool to run the tasks on.
+        :param stages: generator of stages, as described above.
+        :param count: number of stages the generator yields, for the progress.
+        """
+        super(TileJob, self).__init__()
+        self.threadpool = threadpool
+        self.stages = stages
+        self.count = max(count, 1)
+        self.stage = 0
+        self.is_cancelled = False
+        self.failure = None
+
+        # Workers of the running stage are held on to until they report back.
+        self.workers = {}
+        self.results = []
+
+    def start(self):
+        self.next_stage(None)
+
+    def cancel(self):
+        """
+        Stop the job. Tasks already running finish first, then cancelled is emitted.
+        """
+        self.is_cancelled = True
+
+    def next_stage(self, results):
+        try:
+            tasks = self.stages.send(results)
+        except StopIteration as e:
+            self.progress.emit(1.0)
+            self.finished.emit(e.value)
+            return
+        except Exception:
+            exctype, value = sys.exc_info()[:2]
+            self.error.emit((exctype, value, traceback.format_exc()))
+            return
+
+        if not tasks:
+            return self.next_stage([])
+
+        self.results = [None] * len(tasks)
+        self.workers = {}
+        for index, task in enumerate(tasks):
+            worker = TileWorker(self, index, task)
+            worker.signals.finished.connect(self.task_finished)
+            worker.signals.error.connect(self.task_failed)
+            self.workers[index] = worker
+
+        for worker in list(self.workers.values()):
+            self.threadpool.start(worker)
+
+    def task_finished(self, index, result):
+        self.results[index] = result
+        self.workers.pop(index, None)
+        if not self.is_cancelled:
+            done = len(self.results) - len(self.workers)
+            self.progress.emit(min((self.stage + done / len(self.results)) / self.count, 1.0))
+
+        if self.workers:
+            return
+
+        if self.is_cancelled:
+            self.stages.close()
+            if self.failure:
+                self.error.emit(self.failure)
+            else:
+                self.cancelled.emit()
+        else:
+            self.stage += 1
+            self.next_stage(self.results)
+
+    def task_failed(self, index, error):
+        # Skip the rest, and report the first error once the running tasks are done.
+        if self.failure is None:
+            self.failure = error
+        self.is_cancelled = True
+        self.task_finished(index, None)
@@ -0,0 +1,330 @@
+"""
+Undo history for the paint canvas, stored as compressed region deltas.
+
+Rather than a snapshot of the whole image per step, each operation keeps only
+the XOR of its before and after pixels, over the bounding box of what changed.
+Unchanged pixels XOR to zero so the delta compresses to almost nothing outside
+the drawn area, and applying the same delta again flips the image between the
+two states, so one copy serves for both undo and redo.
+
+Operations which change the size of the image (e.g. rotations) can't be stored
+as a difference, so they keep the whole image they replaced, compressed.
+
+Each step can have a target, an object with an image attribute (a paint layer),
+which it then applies to rather than the image passed to undo and redo. That way
+one history covers every layer of a drawing, and adding, removing and reordering
+the layers are steps in it too.
+"""
+from collections import deque
+import zlib
+
+import numpy as np
+
+from PySide2.QtCore import QRect
+from PySide2.QtGui import QImage
+
+from imaging import image_array, mask_bounds
+
+# Size of the blocks the before-pixels are saved in, as an operation draws.
+TILE_SIZE = 64
+
+# Default memory allowed for the compressed history, in bytes.
+UNDO_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# zlib level, deltas are mostly zeros so the fastest level compresses them well.
+COMPRESSION_LEVEL = 1
+
+
+class Delta:
+    """
+    One undoable operation: the zlib-compressed XOR of the pixels before and after it.
+    """
+    __slots__ = ('rect', 'data', 'target')
+
+    def __init__(self, rect, difference, target=None):
+        self.rect = rect
+        self.target = target
+        self.data = zlib.compress(np.ascontiguousarray(difference).tobytes(), COMPRESSION_LEVEL)
+
+    @classmethod
+    def from_data(cls, rect, data, target=None):
+        # A delta from its already compressed data, e.g. read back from a project file.
+        delta = cls.__new__(cls)
+        delta.rect, delta.data, delta.target = rect, data, target
+        return delta
+
+    @property
+    def nbytes(self):
+        return len(self.data)
+
+    def apply(self, image):
+        """
+        Flip the image between the before and after states of this operation.
+        :param image: QImage the delta was recorded on, unless it has a target.
+        :return: the QImage (changed in place), and the QRect which changed.
+        """
+        if self.target is not None:
+            image = self.target.image
+
+        r = self.rect
+        pixels = image_array(image)[r.top():r.bottom() + 1, r.left():r.right() + 1]
+        difference = np.frombuffer(zlib.decompress(self.data), dtype=np.uint32)
+        pixels ^= difference.reshape(pixels.shape)
+        return image, QRect(r)
+
+
+class Swap:
+    """
+    One undoable operation which replaced the whole image: the other image, compressed.
+    """
+    __slots__ = ('size', 'format', 'data', 'target')
+
+    def __init__(self, image, target=None):
+        self.target = target
+        self.store(image)
+
+    def store(self, image):
+        self.size = image.size()
+        self.format = image.format()
+        self.data = zlib.compress(np.ascontiguousarray(image_array(image)).tobytes(), COMPRESSION_LEVEL)
+
+    @classmethod
+    def from_data(cls, size, format, data, target=None):
+        swap = cls.__new__(cls)
+        swap.size, swap.format, swap.data, swap.target = size, format, data, target
+        return swap
+
+    @property
+    def nbytes(self):
+        return len(self.data)
+
+    def apply(self, image):
+        """
+        Swap the image for the stored one, storing the image in its place.
+        :param image: QImage shown after (or before) the operation, unless it has a target.
+        :return: the other QImage, and its full QRect.
+        """
+        if self.target is not None:
+            image = self.target.image
+
+        other = QImage(self.size, self.format)
+        image_array(other)[:] = np.frombuffer(zlib.decompress(self.data), dtype=np.uint32).reshape(
+            self.size.height(), self.size.width())
+        self.store(image)
+
+        if self.target is not None:
+            self.target.image = other
+        return other, other.rect()
+
+
+class Group:
+    """
+    One undoable operation made of several, on different targets, applied together.
+    """
+    __slots__ = ('entries',)
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    @property
+    def nbytes(self):
+        return sum(entry.nbytes for entry in self.entries)
+
+    def apply(self, image):
+        rect = QRect()
+        for entry in self.entries:
+            image, r = entry.apply(image)
+            rect |= r
+        return image, rect
+
+
+class Restack:
+    """
+    One undoable change to the layers themselves, adding, removing or reordering them:
+    the other list of layers, and which of them was active.
+
+    Layers taken out of the stack are only held here, so they are kept compressed.
+    Every other step's target is then either in the stack or held by a Restack which has
+    to be undone first, so no step can apply to a layer which isn't shown.
+    """
+    __slots__ = ('target', 'layers', 'active', 'nbytes')
+
+    def __init__(self, stack, layers, active):
+        """
+        :param stack: LayerStack which changed, as its target.
+        :param layers: its list of layers before the change, bottom first.
+        :param active: index of its active layer before the change.
+        """
+        self.target = stack
+        self.layers = layers
+        self.active = active
+        self.pack_removed()
+        # Fixed when recorded, so the history's memory adds up as steps come and go.
+        self.nbytes = sum(layer.nbytes for layer in layers if layer not in stack.layers)
+
+    @classmethod
+    def from_data(cls, stack, layers, active):
+        restack = cls.__new__(cls)
+        restack.target, restack.layers, restack.active = stack, layers, active
+        restack.nbytes = sum(layer.nbytes for layer in layers if layer not in stack.layers)
+        return restack
+
+    def pack_removed(self):
+        for layer in self.layers:
+            if layer not in self.target.layers:
+                layer.pack()
+
+    def apply(self, image):
+        """
+        Swap the stack's layers for the stored ones, storing its layers in their place.
+        :return: the image of the layer now active, and the full QRect of the stack.
+        """
+        stack = self.target
+        layers, active = stack.layers, stack.active
+        stack.layers, stack.active = self.layers, self.active
+        self.layers, self.active = layers, active
+        self.pack_removed()
+        stack.pack_hidden()
+        stack.reset_cache()
+        return stack.active_layer.image, stack.rect()
+
+
+class UndoStack:
+    """
+    Undo and redo stacks of Deltas, within a memory budget.
+
+    Drawing code calls touch() with the area it is about to change, before changing it,
+    and commit() when the operation is complete. The first touch of each tile during an
+    operation saves its pixels; commit compares those with the result.
+    """
+
+    def __init__(self, budget=UNDO_MEMORY_BUDGET):
+        self.budget = budget
+        self.undo_deltas = deque()
+        self.redo_deltas = []
+        self.memory = 0
+
+        # Pixels saved during the current operation, by tile (column, row).
+        self.pending = {}
+
+    def touch(self, image, rect):
+        """
+        Save the current pixels of every tile under rect not yet saved in this operation.
+        :param image: QImage about to be drawn on.
+        :param rect: QRect in image coordinates which is about to change.
+        """
+        rect = rect.normalized() & image.rect()
+        if rect.isEmpty():
+            return
+
+        pixels = image_array(image)
+        for row in range(rect.top() // TILE_SIZE, rect.bottom() // TILE_SIZE + 1):
+            for col in range(rect.left() // TILE_SIZE, rect.right() // TILE_SIZE + 1):
+                if (col, row) not in self.pending:
+                    y, x = row * TILE_SIZE, col * TILE_SIZE
+                    self.pending[col, row] = pixels[y:y + TILE_SIZE, x:x + TILE_SIZE].copy()
+
+    def commit(self, image, target=None):
+        """
+        Close the current operation, storing whatever it changed as a delta.
+        :param image: QImage the operation was drawn on.
+        :param target: object holding the image, which undo and redo apply the delta to.
+        :return: QRect of the changed area, null if nothing changed.
+        """
+        if not self.pending:
+            return QRect()
+
+        cols = [col for col, row in self.pending]
+        rows = [row for col, row in self.pending]
+        x0, y0 = min(cols) * TILE_SIZE, min(rows) * TILE_SIZE
+        x1 = min(image.width(), (max(cols) + 1) * TILE_SIZE)
+        y1 = min(image.height(), (max(rows) + 1) * TILE_SIZE)
+
+        # Tiles in the bounding box which were never touched are unchanged, and stay zero.
+        pixels = image_array(image)
+        difference = np.zeros((y1 - y0, x1 - x0), dtype=np.uint32)
+        for (col, row), before in self.pending.items():
+            y, x = row * TILE_SIZE, col * TILE_SIZE
+            h, w = before.shape
+            np.bitwise_xor(before, pixels[y:y + h, x:x + w], out=difference[y - y0:y - y0 + h, x - x0:x - x0 + w])
+        self.pending = {}
+
+        # Shrink to the pixels which really changed.
+        rect = mask_bounds(difference != 0)
+        if rect.isNull():
+            return rect
+
+        difference = difference[rect.top():rect.bottom() + 1, rect.left():rect.right() + 1]
+        rect.translate(x0, y0)
+        self.push(Delta(rect, difference, target))
+        return rect
+
+    def rollback(self, image):
+        """
+        Abandon the current operation, putting back the pixels saved as it drew.
+        :param image: QImage the operation was drawn on.
+        """
+        pixels = image_array(image)
+        for (col, row), before in self.pending.items():
+            y, x = row * TILE_SIZE, col * TILE_SIZE
+            h, w = before.shape
+            pixels[y:y + h, x:x + w] = before
+        self.pending = {}
+
+    def push(self, delta):
+        self.undo_deltas.append(delta)
+        self.memory += delta.nbytes
+
+        # A new operation replaces anything which had been undone.
+        self.memory -= sum(d.nbytes for d in self.redo_deltas)
+        self.redo_deltas = []
+
+        # Drop the oldest steps to stay within budget, but always keep the latest one.
+        while self.memory > self.budget and len(self.undo_deltas) > 1:
+            self.memory -= self.undo_deltas.popleft().nbytes
+
+    def step(self, source, destination, image):
+        # Apply the latest operation on one stack, moving it to the other.
+        if not source:
+            return image, QRect()
+
+        delta = source.pop()
+        self.memory -= delta.nbytes
+        image, rect = delta.apply(image)
+        self.memory += delta.nbytes
+        destination.append(delta)
+        return image, rect
+
+    def undo(self, image):
+        """
+        Revert the most recent operation.
+        :param image: QImage to apply it to.
+        :return: the resulting QImage, which is new if the operation replaced the image,
+            and the QRect of the changed area, null if there was nothing to undo.
+        """
+        return self.step(self.undo_deltas, self.redo_deltas, image)
+
+    def redo(self, image):
+        """
+        Re-apply the most recently undone operation.
+        :param image: QImage to apply it to.
+        :return: the resulting QImage and the QRect of the changed area, as for undo.
+        """
+        return self.step(self.redo_deltas, self.undo_deltas, image)
+
+    def restore(self, undo_deltas, redo_deltas):
+        """
+        Replace the history, e.g. with one read back from a project file.
+        :param undo_deltas: steps to undo, oldest first.
+        :param redo_deltas: steps to redo, the next one last.
+        """
+        self.undo_deltas = deque(undo_deltas)
+        self.redo_deltas = list(redo_deltas)
+        self.pending = {}
+        self.memory = sum(d.nbytes for d in self.undo_deltas) + sum(d.nbytes for d in self.redo_deltas)
+
+    def clear(self):
+        self.undo_deltas.clear()
+        self.redo_deltas = []
+        self.pending = {}
+        self.memory = 0